@@ -57,7 +57,9 @@ create table public.backstories (
   demographics jsonb default '{}'::jsonb, -- Pre-labeled tags: { "age": "...", "gender": "..." }
   custom_tags jsonb default '{}'::jsonb, -- Dynamic tags: { "owns_tesla": true }
   embedding vector(1536), -- Optional: for semantic search
-  created_at timestamp with time zone default timezone('utc'::text, now()) not null
+  token_counts jsonb default '{}'::jsonb, -- Content length per tokenizer family: { "cl100k_base": 1834 }
+  created_at timestamp with time zone default timezone('utc'::text, now()) not null,
+  updated_at timestamp with time zone default timezone('utc'::text, now()) not null -- High-water mark for incremental index refresh
 );
 
 -- Execution & Results
@@ -71,6 +73,7 @@ create table public.survey_runs (
   status text default 'QUEUED', -- 'QUEUED', 'MATCHING', 'INFERENCE', 'COMPLETED', 'FAILED'
   run_config jsonb default '{}'::jsonb, -- e.g. { "model_name": "gpt-4-turbo", "temperature": 0.7 }
   tokens_used int default 0,
+  matched_backstory_ids bigint[], -- Backstories chosen by matching; persisted so resumed runs skip re-matching
   created_at timestamp with time zone default timezone('utc'::text, now()) not null,
   completed_at timestamp with time zone
 );
@@ -89,7 +92,9 @@ create table public.results (
 -- Indexes for performance
 create index idx_backstories_demographics on public.backstories using gin (demographics);
 create index idx_backstories_custom_tags on public.backstories using gin (custom_tags);
+create index idx_backstories_updated_at on public.backstories(updated_at, id);
 create index idx_results_run_id on public.results(run_id);
+create index idx_results_run_pair on public.results(run_id, probe_id, backstory_id);
 create index idx_survey_runs_status on public.survey_runs(status);
 
 -- RLS Policies (Basic Setup - to be refined)
@@ -101,6 +106,17 @@ alter table public.backstories enable row level security;
 alter table public.survey_runs enable row level security;
 alter table public.results enable row level security;
 
+-- Keep backstories.updated_at current for writers that bypass the worker ORM
+create or replace function public.touch_updated_at() returns trigger as $$
+begin
+  new.updated_at = timezone('utc'::text, now());
+  return new;
+end;
+$$ language plpgsql;
+
+create trigger backstories_touch_updated_at before update on public.backstories
+  for each row execute function public.touch_updated_at();
+
 -- Configurations: Global settings (e.g. key=PRICING_MODEL)
 create table public.configurations (
   key text primary key,
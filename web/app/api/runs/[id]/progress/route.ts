@@ -0,0 +1,70 @@
+import Redis from "ioredis"
+
+// Progress events are published by the worker (worker/modules/progress.py)
+// on `run_progress:<runId>`; the latest one is also kept under `<channel>:latest`.
+const TERMINAL_STATUSES = ["COMPLETED", "FAILED"]
+
+export const dynamic = "force-dynamic"
+
+// Lazy load Redis connection for regular commands
+let redisClient: Redis | null = null;
+
+function getRedis() {
+    if (!redisClient) {
+        redisClient = new Redis(process.env.REDIS_URL || "redis://localhost:6379")
+    }
+    return redisClient
+}
+
+export async function GET(req: Request, { params }: { params: Promise<{ id: string }> }) {
+    const { id } = await params
+    const channel = `run_progress:${id}`
+    const redisUrl = process.env.REDIS_URL || "redis://localhost:6379"
+
+    // Subscriber connections can't issue regular commands, so use a dedicated one per stream
+    const subscriber = new Redis(redisUrl)
+    const encoder = new TextEncoder()
+
+    const stream = new ReadableStream({
+        async start(controller) {
+            let closed = false
+
+            const close = () => {
+                if (closed) return
+                closed = true
+                subscriber.disconnect()
+                controller.close()
+            }
+
+            const send = (payload: string) => {
+                if (closed) return
+                controller.enqueue(encoder.encode(`data: ${payload}\n\n`))
+                try {
+                    if (TERMINAL_STATUSES.includes(JSON.parse(payload).status)) close()
+                } catch {
+                    // Ignore malformed events
+                }
+            }
+
+            req.signal.addEventListener("abort", close)
+
+            subscriber.on("message", (_channel: string, message: string) => send(message))
+            await subscriber.subscribe(channel)
+
+            // Replay the latest snapshot so the client doesn't wait for the next event
+            const latest = await getRedis().get(`${channel}:latest`).catch(() => null)
+            if (latest) send(latest)
+        },
+        cancel() {
+            subscriber.disconnect()
+        }
+    })
+
+    return new Response(stream, {
+        headers: {
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache, no-transform",
+            "Connection": "keep-alive"
+        }
+    })
+}
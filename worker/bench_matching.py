@@ -0,0 +1,304 @@
+"""
+Matching benchmark suite.
+
+Builds synthetic backstory pools and target populations and times weight computation,
+assignment and end-to-end matching, recording peak memory per step. Results are written
+as JSON lines (one record per step and pool size) so runs can be diffed or plotted.
+
+    python bench_matching.py                                  # fake data source, 10^2..10^5
+    python bench_matching.py --sizes 1000 10000 --targets 500 --output bench.jsonl
+    python bench_matching.py --source postgres                # seeds DATABASE_URL, then cleans up
+    python bench_matching.py --scale --no-trace               # 10^4 targets x 10^5 candidates, time-boxed
+
+The fake source serves the pool from memory (no prefilter), so it runs fully offline.
+The postgres source inserts the pool under a unique model_signature and deletes it afterwards;
+use a local database, since other backstories in the table take part in matching too.
+"""
+import sys
+import os
+import gc
+import json
+import time
+import uuid
+import platform
+import argparse
+import resource
+import subprocess
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Trait -> number of distinct values, roughly as seen in survey demographics
+TRAIT_CARDINALITIES = {
+    "age": 73,
+    "gender": 4,
+    "state": 50,
+    "political_party": 5,
+    "education": 7,
+    "income": 10,
+    "race": 7,
+    "religion": 12
+}
+
+# The population-scale case matching has to handle, and its time budget per matching step
+SCALE_CASE = {"sizes": [100000], "targets": 10000}
+SCALE_BUDGET_SECONDS = 10.0
+# Steps checked against --max-seconds
+TIMED_STEPS = ("assign_min_cost_flow", "end_to_end_db")
+
+def trait_values(trait: str) -> List[str]:
+    if trait == "age":
+        return [str(age) for age in range(18, 18 + TRAIT_CARDINALITIES["age"])]
+    return [f"{trait}_{i}" for i in range(TRAIT_CARDINALITIES[trait])]
+
+def zipf_probs(n: int, rng: np.random.Generator) -> np.ndarray:
+    """Skewed category frequencies, shuffled so the popular value differs per trait."""
+    probs = 1.0 / np.arange(1, n + 1)
+    rng.shuffle(probs)
+    return probs / probs.sum()
+
+def make_pool(
+    size: int,
+    seed: int = 0,
+    distribution_rate: float = 0.3,
+    missing_rate: float = 0.1,
+    empty_rate: float = 0.05
+) -> List[Dict[str, Any]]:
+    """
+    Synthetic backstories: each trait is deterministic, a distribution over 2-4 values
+    (as produced by demographic inference), or missing; a few have no demographics at all.
+    """
+    rng = np.random.default_rng(seed)
+    values = {trait: trait_values(trait) for trait in TRAIT_CARDINALITIES}
+    probs = {trait: zipf_probs(len(v), rng) for trait, v in values.items()}
+
+    pool = []
+    for i in range(size):
+        demographics = {}
+        if rng.random() >= empty_rate:
+            for trait, options in values.items():
+                roll = rng.random()
+                if roll < missing_rate:
+                    continue
+                if roll < missing_rate + distribution_rate:
+                    k = int(rng.integers(2, 5))
+                    picks = rng.choice(len(options), size=k, replace=False, p=probs[trait])
+                    weights = rng.dirichlet(np.ones(k))
+                    demographics[trait] = {options[p]: round(float(w), 4) for p, w in zip(picks, weights)}
+                else:
+                    demographics[trait] = options[rng.choice(len(options), p=probs[trait])]
+        pool.append({
+            "id": i + 1,
+            "content": f"Synthetic backstory {i + 1}.",
+            "demographics": demographics,
+            "custom_tags": {}
+        })
+    return pool
+
+def make_constraints(seed: int = 0, n_traits: int = 4) -> Dict[str, Any]:
+    """
+    A demographic config with distribution-valued constraints over the first `n_traits` traits.
+    """
+    rng = np.random.default_rng(seed + 1)
+    constraints = {}
+    for trait in list(TRAIT_CARDINALITIES)[:n_traits]:
+        options = trait_values(trait)
+        constraints[trait] = {v: round(float(p), 6) for v, p in zip(options, zipf_probs(len(options), rng))}
+    return constraints
+
+def measure(fn: Callable[[], Any], trace: bool = True) -> Dict[str, Any]:
+    """
+    Wall time and peak traced allocation (Python and NumPy) of one call.
+    Tracing slows allocation-heavy Python code; pass trace=False for clean timings.
+    """
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - started
+    peak = None
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak = round(peak / 2**20, 3)
+    return {"seconds": round(seconds, 6), "peak_mb": peak, "result": result}
+
+class FakeSource:
+    """
+    Stands in for the backstories table: serves the pool from memory.
+    """
+
+    def __init__(self, pool: List[Dict[str, Any]]):
+        self.by_id = {b["id"]: b for b in pool}
+
+    def install(self, matcher):
+        matcher.fetch_candidates = lambda db, targets, min_candidates, candidate_ids=None: [
+            {"id": b["id"], "demographics": b["demographics"]} for b in self.by_id.values()
+        ]
+        matcher.fetch_backstories = lambda ids: [self.by_id[i] for i in ids if i in self.by_id]
+
+class PostgresSource:
+    """
+    Seeds the pool into the configured database and removes it again.
+    """
+
+    def __init__(self, pool: List[Dict[str, Any]]):
+        from sqlalchemy import insert
+        from database import SessionLocal, Backstory
+        self.signature = f"benchmark:{uuid.uuid4()}"
+        db = SessionLocal()
+        try:
+            rows = [
+                {
+                    "content": b["content"],
+                    "model_signature": self.signature,
+                    "demographics": b["demographics"],
+                    "custom_tags": b["custom_tags"]
+                }
+                for b in pool
+            ]
+            for start in range(0, len(rows), 5000):
+                db.execute(insert(Backstory.__table__), rows[start:start + 5000])
+            db.commit()
+        finally:
+            db.close()
+
+    def install(self, matcher):
+        pass
+
+    def cleanup(self):
+        from database import SessionLocal, Backstory
+        db = SessionLocal()
+        try:
+            db.query(Backstory).filter(Backstory.model_signature == self.signature).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+def run_size(
+    n_candidates: int,
+    n_targets: int,
+    source: str,
+    seed: int = 0,
+    capacity: int = 1,
+    top_k: int = 50,
+    trace: bool = True
+) -> List[Dict[str, Any]]:
+    from modules.matcher import Matcher, EncodedCandidates, DENSE_MATCH_LIMIT
+    from modules.backstory_index import BackstoryIndex
+
+    matcher = Matcher()
+    pool = make_pool(n_candidates, seed=seed)
+    targets = matcher.sample_population(make_constraints(seed), n_targets, seed=seed)
+    candidates = [{"id": b["id"], "demographics": b["demographics"]} for b in pool]
+    base = {"candidates": n_candidates, "targets": n_targets, "capacity": capacity, "top_k": top_k, "source": source}
+    records = []
+
+    def record(step: str, stats: Dict[str, Any], **extra):
+        result = stats.pop("result")
+        if isinstance(result, list):
+            extra.setdefault("matched", len(result))
+        records.append({**base, "step": step, **stats, **extra})
+        memory = f"{stats['peak_mb']:>9.1f}MB" if stats["peak_mb"] is not None else ""
+        print(f"[Bench] n={n_candidates:>7} {step:<22} {stats['seconds']:>9.3f}s {memory}", file=sys.stderr)
+
+    stats = measure(lambda: EncodedCandidates(candidates), trace)
+    encoded = stats["result"]
+    record("encode", stats)
+
+    if n_targets * n_candidates <= DENSE_MATCH_LIMIT:
+        record("log_weights_dense", measure(lambda: matcher.compute_log_weights(targets, encoded), trace))
+        if capacity <= 1:
+            record("assign_hungarian", measure(lambda: matcher.perform_matching(targets, candidates, encoded=encoded), trace))
+
+    record("assign_min_cost_flow", measure(
+        lambda: matcher.match_population(targets, candidates, capacity=capacity, top_k=top_k, encoded=encoded),
+        trace
+    ))
+
+    # Trait index build from raw rows (what BackstoryIndex.refresh applies)
+    rows = [SimpleNamespace(id=b["id"], demographics=b["demographics"], custom_tags=b["custom_tags"]) for b in pool]
+    index = BackstoryIndex()
+    record("index_build", measure(lambda: index._apply(rows), trace))
+
+    if source == "postgres":
+        backing = PostgresSource(pool)
+    else:
+        backing = FakeSource(pool)
+    backing.install(matcher)
+    try:
+        record("end_to_end_db", measure(lambda: matcher.match_against_db(targets, capacity=capacity, top_k=top_k), trace))
+    finally:
+        if source == "postgres":
+            backing.cleanup()
+
+    return records
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    import scipy
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "machine": platform.machine(),
+        "timestamp": time.time()
+    }
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark backstory matching.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--targets", type=int, default=1000, help="Target population size (capped at the pool size)")
+    parser.add_argument("--capacity", type=int, default=1)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--source", choices=["fake", "postgres"], default="fake")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON lines file to append to (default: stdout)")
+    parser.add_argument("--no-trace", action="store_true", help="Skip memory tracing for undisturbed timings")
+    parser.add_argument("--scale", action="store_true", help=f"Run {SCALE_CASE['targets']} targets x {SCALE_CASE['sizes'][0]} candidates with a {SCALE_BUDGET_SECONDS:.0f}s budget")
+    parser.add_argument("--max-seconds", type=float, help=f"Exit non-zero if any of {', '.join(TIMED_STEPS)} takes longer")
+    args = parser.parse_args(argv)
+    if args.scale:
+        args.sizes, args.targets = SCALE_CASE["sizes"], SCALE_CASE["targets"]
+        args.max_seconds = args.max_seconds or SCALE_BUDGET_SECONDS
+
+    if args.source == "fake":
+        # Importing the matcher pulls in database.py; keep the fake run offline-safe
+        os.environ.setdefault("DATABASE_URL", "postgresql://offline@localhost:1/offline")
+
+    env = environment()
+    out = open(args.output, "a") if args.output else sys.stdout
+    over_budget = []
+    try:
+        for size in args.sizes:
+            n_targets = min(args.targets, size * args.capacity)
+            for record in run_size(size, n_targets, args.source, args.seed, args.capacity, args.top_k, not args.no_trace):
+                out.write(json.dumps({**env, **record}) + "\n")
+                out.flush()
+                if args.max_seconds and record["step"] in TIMED_STEPS and record["seconds"] > args.max_seconds:
+                    over_budget.append(record)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"[Bench] Max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB", file=sys.stderr)
+    for record in over_budget:
+        print(f"[Bench Error] n={record['candidates']} {record['step']} took {record['seconds']:.1f}s (budget {args.max_seconds:.1f}s)", file=sys.stderr)
+    if over_budget:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -27,6 +27,7 @@ class DemographicConfig(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey("profiles.id"))
     name = Column(Text)
     constraints = Column(JSONB, default={})
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
 
 class Survey(Base):
     __tablename__ = "surveys"
@@ -50,6 +51,9 @@ class Backstory(Base):
     model_signature = Column(Text)
     demographics = Column(JSONB, default={})
     custom_tags = Column(JSONB, default={})
+    token_counts = Column(JSONB, default={}) # {tokenizer family: tokens in content}, see modules/context_budget.py
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     # embedding = Column(Vector(1536)) # PGVector needs special handling or ignore in vanilla sqlalchemy
 
 class SurveyRun(Base):
@@ -61,6 +65,7 @@ class SurveyRun(Base):
     status = Column(Text)
     run_config = Column(JSONB, default={})
     tokens_used = Column(Integer, default=0)
+    matched_backstory_ids = Column(ARRAY(BigInteger), nullable=True) # Persisted matching, reused on resume
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
 
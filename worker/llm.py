@@ -1,58 +1,163 @@
 import os
+import math
+import time
 import openai
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import groupby
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple
 
 # Configuration
 # Configuration
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-VLLM_BASE_URL = os.getenv("VLLM_BASE_URL") # e.g., http://vllm:8000/v1
+VLLM_BASE_URL = os.getenv("VLLM_BASE_URL") # e.g., http://vllm:8000/v1; VLLM_ENDPOINTS config lists replicas
 
 # Primary Client (OpenAI)
+# Retries are handled by create_chat_completion so throttling is visible to the rate limiter
 openai_client = openai.OpenAI(
-    api_key=OPENAI_API_KEY
+    api_key=OPENAI_API_KEY,
+    max_retries=0
 )
 
-# Local Client (vLLM)
+# Local models (vLLM) are routed across replicas by modules/replica_router.py
 from modules.config_manager import config_manager
-
-vllm_client = None
-if VLLM_BASE_URL:
-    vllm_client = openai.OpenAI(
-        api_key="EMPTY",
-        base_url=VLLM_BASE_URL
-    )
+from modules.response_cache import ResponseCache, get_response_cache
+from modules.rate_limiter import get_rate_limiter, backoff_delay
+from modules.replica_router import get_replica_router
+from modules.tokens import estimate_message_tokens
 
 def get_local_models():
     return config_manager.get_local_models()
 
+def is_local_model(model: str) -> bool:
+    return model in get_local_models() or model.startswith("local/")
+
+# Errors worth retrying; 429/503 additionally shrink the model's concurrency
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+def estimate_request_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """
+    Rough token reservation for rate limiting: ~4 characters per prompt token plus the output cap.
+    """
+    return estimate_message_tokens(messages) + max_tokens
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def create_chat_completion(client: Optional[openai.OpenAI], model: str, messages: List[Dict[str, str]], max_tokens: int, **params):
+    """
+    Calls the chat completions API through the model's shared rate limiter,
+    retrying throttled and transient failures with jittered exponential backoff.
+    Raises the last error once retries are exhausted or the error is not retryable.
+    With client=None (local models, see get_chat_client) every attempt is routed to a
+    vLLM replica, so a retry after a replica failure goes to a healthy one.
+    """
+    def request(api: openai.OpenAI):
+        return api.chat.completions.create(model=model, messages=messages, max_tokens=max_tokens, **params)
+
+    if client is None:
+        call = lambda: get_replica_router().call(model, request, affinity_key=prefix_key(messages))
+    else:
+        call = lambda: request(client)
+    return call_with_limits(model, estimate_request_tokens(messages, max_tokens * params.get("n", 1)), call)
+
+def call_with_limits(model: str, estimated_tokens: int, call: Callable[[], Any]):
+    """
+    Runs one API call (chat or embeddings) under the model's rate limiter with retries.
+    """
+    limiter = get_rate_limiter(model)
+    retry = config_manager.get_retry_settings()
+
+    attempt = 0
+    while True:
+        limiter.acquire(estimated_tokens)
+        try:
+            response = call()
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            throttled = isinstance(e, openai.RateLimitError) or status in THROTTLE_STATUS_CODES
+            retryable = throttled or status in RETRYABLE_STATUS_CODES or isinstance(e, openai.APIConnectionError)
+            limiter.release(estimated_tokens, throttled=throttled)
+
+            if not retryable or attempt >= retry["max_retries"]:
+                raise
+            delay = backoff_delay(attempt, retry["base_delay"], retry["max_delay"], _retry_after(e))
+            print(f"[LLM] {model} request failed ({status or type(e).__name__}); retry {attempt + 1}/{retry['max_retries']} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        actual_tokens = response.usage.total_tokens if response.usage else estimated_tokens
+        limiter.release(estimated_tokens, actual_tokens=actual_tokens)
+        return response
+
+def get_chat_client(model: str) -> Optional[openai.OpenAI]:
+    """
+    The client for a model, or None when it is served by vLLM replicas (routed per request).
+    """
+    client = openai_client
+
+    # Check if model should be routed to vLLM
+    if is_local_model(model):
+        if get_replica_router().has_replicas(model):
+            client = None
+        else:
+            print(f"[LLM Warning] Local model {model} requested but no vLLM endpoints are configured. Falling back to OpenAI (this will likely fail).")
+    return client
+
 def chat_completion(
     messages: List[Dict[str, str]],
     model: str = "gpt-3.5-turbo",
     temperature: float = 0.7,
-    max_tokens: int = 1000
+    max_tokens: int = 1000,
+    use_cache: bool = False,
+    n: int = 1,
+    response_format: Optional[Dict[str, Any]] = None
 ) -> Dict[str, Any]:
     """
-    Wrapper for OpenAI-compatible chat completion with routing.
+    Wrapper for OpenAI-compatible chat completion with routing, shared
+    per-model rate limiting and retries (see create_chat_completion).
+    With use_cache, identical (model, messages, temperature, max_tokens) requests are
+    served from the response cache. Hits report zero billable tokens in `usage`;
+    the original counts are kept as cached_prompt_tokens / cached_completion_tokens.
+    With n > 1, several samples come back from one request as `choices` (`content` is
+    the first) and `usage` covers all of them; such requests are never cached.
+    `response_format` is passed through (e.g. {"type": "json_object"} for JSON mode).
     """
+    cache_key = None
+    if use_cache and n == 1 and response_format is None:
+        cache_key = ResponseCache.make_key(model, messages, temperature, max_tokens)
+        cached = get_response_cache().get(cache_key)
+        if cached is not None:
+            return {
+                "content": cached["content"],
+                "usage": {
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "total_tokens": 0,
+                    "cached_prompt_tokens": cached["usage"].get("prompt_tokens", 0),
+                    "cached_completion_tokens": cached["usage"].get("completion_tokens", 0)
+                },
+                "cached": True
+            }
+
     try:
-        client = openai_client
-
-        # Check if model should be routed to vLLM
-        local_models = get_local_models()
-        if model in local_models or model.startswith("local/"):
-            if vllm_client:
-                client = vllm_client
-                print(f"[LLM] Routing to vLLM for model: {model}")
-            else:
-                print(f"[LLM Warning] Local model {model} requested but VLLM_BASE_URL not set. Falling back to OpenAI (this will likely fail).")
-
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages,
+        response = create_chat_completion(
+            get_chat_client(model),
+            model,
+            messages,
+            max_tokens,
             temperature=temperature,
-            max_tokens=max_tokens
+            **({"n": n} if n > 1 else {}),
+            **({"response_format": response_format} if response_format else {})
         )
-        return {
+        result = {
             "content": response.choices[0].message.content,
             "usage": {
                 "prompt_tokens": response.usage.prompt_tokens,
@@ -60,23 +165,231 @@ def chat_completion(
                 "total_tokens": response.usage.total_tokens
             }
         }
+        if n > 1:
+            result["choices"] = [choice.message.content for choice in sorted(response.choices, key=lambda c: c.index)]
+        if cache_key:
+            get_response_cache().set(cache_key, result)
+        return result
     except Exception as e:
         print(f"[LLM ERROR] {e}")
+        # Callers must check `error` rather than treat the content as a model answer
         return {
             "content": f"[Error generating response: {str(e)}]",
-            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            "error": str(e)
         }
 
-def get_embedding(text: str, model: str = "text-embedding-3-small") -> List[float]:
+def _label_key(text: str) -> str:
+    return text.strip().strip(".,:;!\"'").lower()
+
+def label_probabilities(top_logprobs: List[Tuple[str, float]], labels: List[str], temperature: float = 1.0) -> Dict[str, float]:
     """
-    Wrapper for embeddings.
+    Turns the first output token's top logprobs into a distribution over `labels`.
+    A token counts towards a label when it is the label or a prefix only that label has
+    ("Y" -> Yes, "Unk" -> Unknown; "no" never counts towards "Unknown"). Mass on other
+    tokens is dropped and the rest renormalized, with temperature scaling (p^(1/T)) for
+    per-model calibration. Empty if no top token maps to a label.
+    """
+    keys = {label: _label_key(label) for label in labels}
+    mass = {label: 0.0 for label in labels}
+    for token, logprob in top_logprobs:
+        token_key = _label_key(token)
+        if not token_key:
+            continue
+        matches = [label for label, key in keys.items() if key == token_key]
+        if not matches:
+            matches = [label for label, key in keys.items() if key.startswith(token_key)]
+        if len(matches) == 1:
+            mass[matches[0]] += math.exp(logprob)
+
+    if not any(mass.values()):
+        return {}
+    scaled = {label: p ** (1.0 / temperature) for label, p in mass.items()}
+    total = sum(scaled.values())
+    return {label: p / total for label, p in scaled.items()}
+
+def classify(
+    messages: List[Dict[str, str]],
+    labels: List[str],
+    model: str = "gpt-3.5-turbo",
+    top_logprobs: int = 10
+) -> Dict[str, Any]:
+    """
+    Single-token classification: the model may emit one token (temperature 0), and the
+    answer is read from that token's logprobs rather than from the text, so the caller
+    gets calibrated probabilities over `labels` for one output token of cost.
+    The prompt must ask for exactly one of the labels.
+    Returns {"label", "probs", "usage"}; when the server returns no logprobs, the text is
+    matched instead (probability 1). On failure `error` is set and `probs` is empty.
     """
     try:
-        response = client.embeddings.create(
-            input=text,
-            model=model
+        response = create_chat_completion(
+            get_chat_client(model),
+            model,
+            messages,
+            1,
+            temperature=0.0,
+            logprobs=True,
+            top_logprobs=top_logprobs
         )
-        return response.data[0].embedding
+        choice = response.choices[0]
+        usage = {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens
+        }
+    except Exception as e:
+        print(f"[LLM ERROR] {e}")
+        return {
+            "label": None,
+            "probs": {},
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            "error": str(e)
+        }
+
+    probs = {}
+    content = getattr(choice, "logprobs", None) and choice.logprobs.content
+    if content:
+        probs = label_probabilities(
+            [(top.token, top.logprob) for top in content[0].top_logprobs],
+            labels,
+            config_manager.get_classifier_temperature(model)
+        )
+    if not probs:
+        probs = label_probabilities([(choice.message.content or "", 0.0)], labels)
+
+    return {
+        "label": max(probs, key=probs.get) if probs else None,
+        "probs": probs,
+        "usage": usage
+    }
+
+def prefix_key(messages: List[Dict[str, str]]) -> Optional[str]:
+    """
+    The shared prompt prefix of a request: its leading system message, if any.
+    """
+    if messages and messages[0].get("role") == "system":
+        return messages[0]["content"]
+    return None
+
+def imap_chat_completions(
+    requests: Iterable[List[Dict[str, str]]],
+    model: str = "gpt-3.5-turbo",
+    temperature: float = 0.7,
+    max_tokens: int = 1000,
+    max_concurrency: Optional[int] = None,
+    prefix_batching: Optional[bool] = None,
+    use_cache: bool = False,
+    response_format: Optional[Dict[str, Any]] = None
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Runs many chat completions concurrently.
+    Yields (index, response) pairs in completion order, where index is the
+    position of the messages in `requests`. At most `max_concurrency` calls
+    are in flight (defaults to the model's configured limit), and the input
+    is consumed lazily so very large grids are never materialised at once.
+
+    With prefix batching (on by default for models served by vLLM), adjacent
+    requests sharing a system prompt are submitted as one batch: the first
+    request of the batch goes out alone so the server prefills and caches the
+    shared prefix, then the rest of the batch is released together and hits
+    vLLM's automatic prefix cache instead of recomputing it. Callers should
+    order requests so that requests sharing a prefix are adjacent.
+    """
+    def _call(messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        return chat_completion(
+            messages, model=model, temperature=temperature, max_tokens=max_tokens,
+            use_cache=use_cache, response_format=response_format
+        )
+
+    return _imap(requests, _call, model, max_concurrency, prefix_batching)
+
+def imap_classify(
+    requests: Iterable[List[Dict[str, str]]],
+    labels: List[str],
+    model: str = "gpt-3.5-turbo",
+    max_concurrency: Optional[int] = None,
+    prefix_batching: Optional[bool] = None
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Concurrent `classify` over many requests, scheduled like imap_chat_completions.
+    """
+    return _imap(requests, lambda messages: classify(messages, labels, model=model), model, max_concurrency, prefix_batching)
+
+def _imap(
+    requests: Iterable[List[Dict[str, str]]],
+    call: Callable[[List[Dict[str, str]]], Dict[str, Any]],
+    model: str,
+    max_concurrency: Optional[int],
+    prefix_batching: Optional[bool]
+) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    limit = max_concurrency or config_manager.get_model_concurrency(model)
+    limit = max(1, limit)
+    if prefix_batching is None:
+        prefix_batching = is_local_model(model)
+
+    def _call(index: int, messages: List[Dict[str, str]]) -> Tuple[int, Dict[str, Any]]:
+        return index, call(messages)
+
+    indexed = enumerate(requests)
+    if prefix_batching:
+        batches = (list(batch) for _, batch in groupby(indexed, key=lambda item: prefix_key(item[1])))
+    else:
+        batches = ([item] for item in indexed)
+
+    with ThreadPoolExecutor(max_workers=limit) as pool:
+        # Each in-flight future maps to the rest of its batch, released once it completes
+        pending: Dict[Any, List[Tuple[int, List[Dict[str, str]]]]] = {}
+
+        def _drain() -> Iterator[Tuple[int, Dict[str, Any]]]:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for index, messages in pending.pop(future):
+                    pending[pool.submit(_call, index, messages)] = []
+                yield future.result()
+
+        for batch in batches:
+            (index, messages), rest = batch[0], batch[1:]
+            pending[pool.submit(_call, index, messages)] = rest
+            # Keep a small backlog queued so workers never idle, without buffering the whole grid
+            while len(pending) >= limit * 2:
+                yield from _drain()
+
+        while pending:
+            yield from _drain()
+
+def get_embeddings(texts: List[str], model: Optional[str] = None, batch_size: Optional[int] = None) -> List[List[float]]:
+    """
+    Embeds many texts with one API request per `batch_size` inputs (order preserved).
+    Routed like chat (local models go to vLLM) and rate limited / retried the same way.
+    Raises once retries are exhausted; callers decide what a failed batch means.
+    """
+    settings = config_manager.get_embedding_settings()
+    model = model or settings["model"]
+    batch_size = batch_size or int(settings["batch_size"])
+
+    router = get_replica_router() if is_local_model(model) else None
+
+    embeddings = []
+    for start in range(0, len(texts), batch_size):
+        # The API rejects empty strings
+        batch = [text or " " for text in texts[start:start + batch_size]]
+        estimated_tokens = sum(len(text) for text in batch) // 4
+        request = lambda api: api.embeddings.create(input=batch, model=model)
+        response = call_with_limits(
+            model,
+            estimated_tokens,
+            (lambda: router.call(model, request)) if router else (lambda: request(openai_client))
+        )
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    return embeddings
+
+def get_embedding(text: str, model: Optional[str] = None) -> List[float]:
+    """
+    Wrapper for embeddings.
+    """
+    try:
+        return get_embeddings([text], model=model)[0]
     except Exception as e:
         print(f"[Embedding ERROR] {e}")
         return []
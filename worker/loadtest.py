@@ -0,0 +1,355 @@
+"""
+End-to-end load test for the survey worker.
+
+Starts the offline LLM stub (stub_llm_server.py) and N redis_worker.py processes pointed
+at it, seeds a synthetic backstory pool, survey and demographic config into the local
+database, pushes RUN_SURVEY jobs onto the Redis queue the way the web app does, and
+watches the runs to completion. Reports throughput (pairs/s), p50/p99 run latency (enqueue
+to COMPLETED, at poll resolution), result rows written per second and worker memory, as one
+JSON record. Everything it created is deleted afterwards unless --keep is given.
+
+    python loadtest.py                                        # 10 ALTERITY runs, 50 personas x 10 probes
+    python loadtest.py --runs 40 --workers 4 --latency-ms 800 --rate-limit-rate 0.05 --output load.jsonl
+    python loadtest.py --llm-url http://127.0.0.1:8010/v1     # reuse a stub that is already running
+
+Needs DATABASE_URL (schema applied) and REDIS_URL; use local instances only, since the
+workers consume the shared 'alterity_jobs' queue and the pool takes part in matching.
+"""
+import sys
+import os
+import json
+import time
+import uuid
+import argparse
+import threading
+import subprocess
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import redis
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_matching import make_pool, make_constraints, environment
+
+WORKER_DIR = os.path.dirname(os.path.abspath(__file__))
+QUEUE = "alterity_jobs"
+TERMINAL = ("COMPLETED", "FAILED")
+
+class Fixture:
+    """
+    Synthetic survey, probes, demographic config and backstory pool, tagged for cleanup.
+    """
+
+    def __init__(self, pool_size: int, n_probes: int, seed: int = 0, user_id: Optional[str] = None):
+        from sqlalchemy import insert
+        from database import SessionLocal, Backstory, Survey, Probe, DemographicConfig, Profile
+        self.signature = f"loadtest:{uuid.uuid4()}"
+        self.run_ids: List[int] = []
+
+        db = SessionLocal()
+        try:
+            # Surveys and configs belong to a user; any existing profile will do
+            user_id = user_id or db.query(Profile.id).limit(1).scalar()
+            if user_id is None:
+                raise RuntimeError("No profile to own the load-test survey; sign up a user or pass --user-id.")
+
+            rows = [
+                {
+                    "content": f"{b['content']} " + " ".join(f"My {k} is {v}." for k, v in b["demographics"].items() if isinstance(v, str)),
+                    "model_signature": self.signature,
+                    "demographics": b["demographics"],
+                    "custom_tags": b["custom_tags"]
+                }
+                for b in make_pool(pool_size, seed=seed)
+            ]
+            for start in range(0, len(rows), 5000):
+                db.execute(insert(Backstory.__table__), rows[start:start + 5000])
+
+            survey = Survey(user_id=user_id, name=self.signature, status="ACTIVE")
+            db.add(survey)
+            db.flush()
+            db.add_all([
+                Probe(survey_id=survey.id, content=f"Question {i + 1}: how do you feel about topic {i + 1}?", type="open")
+                for i in range(n_probes)
+            ])
+            config = DemographicConfig(user_id=user_id, name=self.signature, constraints=make_constraints(seed))
+            db.add(config)
+            db.commit()
+            self.survey_id, self.config_id = survey.id, config.id
+        finally:
+            db.close()
+
+    def create_runs(self, n_runs: int, methodology: str, run_config: Dict[str, Any]) -> List[int]:
+        from database import SessionLocal, SurveyRun
+        db = SessionLocal()
+        try:
+            runs = [
+                SurveyRun(
+                    survey_id=self.survey_id,
+                    config_id=self.config_id,
+                    methodology=methodology,
+                    run_config=run_config,
+                    status="QUEUED"
+                )
+                for _ in range(n_runs)
+            ]
+            db.add_all(runs)
+            db.commit()
+            self.run_ids = [run.id for run in runs]
+            return self.run_ids
+        finally:
+            db.close()
+
+    def cleanup(self):
+        from database import SessionLocal, Backstory, Survey, Probe, SurveyRun, Result, DemographicConfig
+        db = SessionLocal()
+        try:
+            if self.run_ids:
+                db.query(Result).filter(Result.run_id.in_(self.run_ids)).delete(synchronize_session=False)
+                db.query(SurveyRun).filter(SurveyRun.id.in_(self.run_ids)).delete(synchronize_session=False)
+            db.query(Probe).filter(Probe.survey_id == self.survey_id).delete(synchronize_session=False)
+            db.query(Survey).filter(Survey.id == self.survey_id).delete(synchronize_session=False)
+            db.query(DemographicConfig).filter(DemographicConfig.id == self.config_id).delete(synchronize_session=False)
+            db.query(Backstory).filter(Backstory.model_signature == self.signature).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+class WorkerProcess:
+    """
+    One redis_worker.py subprocess; its output goes to `log` and readiness is taken
+    from the "Listening" line.
+    """
+
+    def __init__(self, env: Dict[str, str], log):
+        self.process = subprocess.Popen(
+            [sys.executable, "redis_worker.py"],
+            cwd=WORKER_DIR,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
+        )
+        self.ready = threading.Event()
+        self.peak_rss_mb = 0.0
+        self._log = log
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            if "Listening" in line:
+                self.ready.set()
+            if self._log:
+                self._log.write(f"[{self.process.pid}] {line}")
+
+    def sample_memory(self) -> Optional[float]:
+        """
+        Current RSS in MB (Linux /proc); the peak is kept in peak_rss_mb.
+        """
+        try:
+            with open(f"/proc/{self.process.pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        rss = int(line.split()[1]) / 1024
+                        self.peak_rss_mb = max(self.peak_rss_mb, rss)
+                        return rss
+        except OSError:
+            return None
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+def start_stub(args) -> subprocess.Popen:
+    command = [
+        sys.executable, "stub_llm_server.py",
+        "--port", str(args.stub_port),
+        "--latency-ms", str(args.latency_ms),
+        "--ms-per-token", str(args.ms_per_token),
+        "--output-tokens", str(args.output_tokens),
+        "--error-rate", str(args.error_rate),
+        "--rate-limit-rate", str(args.rate_limit_rate),
+        "--seed", str(args.seed)
+    ]
+    stub = subprocess.Popen(command, cwd=WORKER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{args.stub_port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"{url}/v1/models", timeout=1)
+            return stub
+        except OSError:
+            time.sleep(0.2)
+    stub.kill()
+    raise RuntimeError("LLM stub did not come up within 30s.")
+
+def stub_stats(llm_url: str) -> Optional[Dict[str, Any]]:
+    try:
+        with urllib.request.urlopen(llm_url.rstrip("/").rsplit("/v1", 1)[0] + "/stats", timeout=2) as response:
+            return json.loads(response.read())
+    except OSError:
+        return None
+
+def watch(run_ids: List[int], enqueued: Dict[int, float], workers: List[WorkerProcess], poll_interval: float, timeout: float) -> Dict[str, Any]:
+    """
+    Polls run status and result counts until every run is terminal (or the timeout).
+    """
+    from sqlalchemy import func
+    from database import SessionLocal, SurveyRun, Result
+
+    finished: Dict[int, float] = {}
+    statuses: Dict[int, str] = {}
+    writes: List[tuple] = [] # (time, results so far)
+    started = min(enqueued.values())
+
+    db = SessionLocal()
+    try:
+        while len(finished) < len(run_ids) and time.monotonic() - started < timeout:
+            time.sleep(poll_interval)
+            now = time.monotonic()
+            for run_id, status in db.query(SurveyRun.id, SurveyRun.status).filter(SurveyRun.id.in_(run_ids)).all():
+                statuses[run_id] = status
+                if status in TERMINAL and run_id not in finished:
+                    finished[run_id] = now
+            writes.append((now, db.query(func.count(Result.id)).filter(Result.run_id.in_(run_ids)).scalar() or 0))
+            db.rollback() # end the snapshot so the next poll sees new commits
+            for worker in workers:
+                worker.sample_memory()
+    finally:
+        db.close()
+
+    pairs = writes[-1][1] if writes else 0
+    wall = (max(finished.values()) if finished else time.monotonic()) - started
+    latencies = [finished[run_id] - enqueued[run_id] for run_id in finished]
+    # Write rate over the span in which rows were actually landing, plus the best poll interval
+    landed = [(t, n) for t, n in writes if n > 0]
+    write_span = landed[-1][0] - landed[0][0] + poll_interval if landed else 0.0
+    interval_rates = [(n1 - n0) / (t1 - t0) for (t0, n0), (t1, n1) in zip(writes, writes[1:]) if t1 > t0]
+
+    return {
+        "runs_completed": sum(1 for run_id in finished if statuses.get(run_id) == "COMPLETED"),
+        "runs_failed": sum(1 for run_id in finished if statuses.get(run_id) == "FAILED"),
+        "runs_unfinished": len(run_ids) - len(finished),
+        "pairs": pairs,
+        "wall_seconds": round(wall, 3),
+        "pairs_per_second": round(pairs / wall, 2) if wall > 0 else None,
+        "run_latency_p50": round(float(np.percentile(latencies, 50)), 3) if latencies else None,
+        "run_latency_p99": round(float(np.percentile(latencies, 99)), 3) if latencies else None,
+        "db_rows_per_second": round(landed[-1][1] / write_span, 2) if write_span else None,
+        "db_rows_per_second_peak": round(max(interval_rates), 2) if interval_rates else None,
+        "worker_peak_rss_mb": [round(worker.peak_rss_mb, 1) for worker in workers]
+    }
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="End-to-end load test of the survey worker against the LLM stub.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--methodology", choices=["ALTERITY", "DEMOGRAPHIC_FORCING"], default="ALTERITY")
+    parser.add_argument("--population", type=int, default=50, help="Personas per ALTERITY run")
+    parser.add_argument("--probes", type=int, default=10)
+    parser.add_argument("--pool", type=int, default=2000, help="Synthetic backstories to seed")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--model", default="gpt-4-turbo")
+    parser.add_argument("--concurrency", type=int, help="Per-run cap on in-flight requests (run_config.concurrency)")
+    parser.add_argument("--arrival-rate", type=float, help="Runs enqueued per second (default: all at once)")
+    parser.add_argument("--llm-url", help="Use an already running OpenAI-compatible server instead of starting the stub")
+    parser.add_argument("--stub-port", type=int, default=8010)
+    parser.add_argument("--latency-ms", type=float, default=300.0)
+    parser.add_argument("--ms-per-token", type=float, default=5.0)
+    parser.add_argument("--output-tokens", type=int, default=120)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=1800.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--user-id", help="Profile that owns the seeded survey (default: any existing one)")
+    parser.add_argument("--worker-log", help="File for worker output (default: discarded)")
+    parser.add_argument("--keep", action="store_true", help="Keep the seeded data and runs")
+    parser.add_argument("--output", help="JSON lines file to append to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    stub = None
+    if args.llm_url:
+        llm_url = args.llm_url
+    else:
+        stub = start_stub(args)
+        llm_url = f"http://127.0.0.1:{args.stub_port}/v1"
+
+    env = {**os.environ, "OPENAI_BASE_URL": llm_url, "OPENAI_API_KEY": "stub", "PYTHONUNBUFFERED": "1"}
+    log = open(args.worker_log, "a") if args.worker_log else None
+    fixture = None
+    workers: List[WorkerProcess] = []
+    try:
+        print(f"[LoadTest] Seeding {args.pool} backstories and {args.probes} probes...", file=sys.stderr)
+        fixture = Fixture(args.pool, args.probes, seed=args.seed, user_id=args.user_id)
+        run_config = {"model_name": args.model, "population_size": args.population}
+        if args.concurrency:
+            run_config["concurrency"] = args.concurrency
+        run_ids = fixture.create_runs(args.runs, args.methodology, run_config)
+
+        workers = [WorkerProcess(env, log) for _ in range(args.workers)]
+        for worker in workers:
+            if not worker.ready.wait(timeout=60):
+                raise RuntimeError("A worker did not start listening within 60s.")
+
+        queue = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379"))
+        enqueued = {}
+        print(f"[LoadTest] Enqueuing {len(run_ids)} {args.methodology} runs for {args.workers} workers...", file=sys.stderr)
+        for run_id in run_ids:
+            queue.lpush(QUEUE, json.dumps({
+                "job_type": "RUN_SURVEY",
+                "run_id": run_id,
+                "methodology": args.methodology,
+                "run_config": run_config
+            }))
+            enqueued[run_id] = time.monotonic()
+            if args.arrival_rate:
+                time.sleep(1.0 / args.arrival_rate)
+
+        report = watch(run_ids, enqueued, workers, args.poll_interval, args.timeout)
+        llm_stats = stub_stats(llm_url)
+    finally:
+        for worker in workers:
+            worker.stop()
+        if fixture and not args.keep:
+            fixture.cleanup()
+        if log:
+            log.close()
+        if stub:
+            stub.terminate()
+
+    record = {
+        "runs": args.runs,
+        "methodology": args.methodology,
+        "population": args.population,
+        "probes": args.probes,
+        "workers": args.workers,
+        "model": args.model,
+        "concurrency": args.concurrency,
+        "stub": None if args.llm_url else {
+            "latency_ms": args.latency_ms,
+            "ms_per_token": args.ms_per_token,
+            "output_tokens": args.output_tokens,
+            "error_rate": args.error_rate,
+            "rate_limit_rate": args.rate_limit_rate
+        },
+        **report,
+        "llm_stats": llm_stats,
+        "environment": environment()
+    }
+
+    line = json.dumps(record)
+    if args.output:
+        with open(args.output, "a") as out:
+            out.write(line + "\n")
+    else:
+        print(line)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,116 @@
 import sys
 import os
-from typing import List, Dict, Any
+import re
+import random
+from typing import List, Dict, Any, Optional, Tuple
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from llm import chat_completion
+from llm import chat_completion, classify, imap_chat_completions, imap_classify
 from database import SessionLocal, Backstory
+from modules.config_manager import config_manager
+from modules.tokens import estimate_tokens, truncate_to_tokens
+from modules.trait_extractor import trait_extractor
+
+CRITIC_MODEL = "gpt-3.5-turbo"
+CRITIC_LABELS = ["YES", "NO"]
+
+INTERVIEW_SYSTEM_PROMPT = "You are participating in an interview. Answer the interviewer's questions naturally and consistently with your previous answers."
+
+# Facts the critic should always see, however long the interview gets
+FACT_PATTERNS = {
+    "birth_year": re.compile(r"\bborn (?:in|around) ((?:19|20)\d\d)\b", re.I),
+    "age": re.compile(r"\bI(?:'m| am) (\d{1,2}) (?:years old|now)\b", re.I),
+    "location": re.compile(r"\bI (?:live|grew up|was raised|was born) in ([A-Z][\w .'-]{1,40}?)(?=[,.;!?]|\s(?:and|but|with|where|since)\b)"),
+    "occupation": re.compile(r"\bI work ((?:as an?|at) [\w &'-]{2,40}?)(?=[,.;!?])")
+}
+
+SUMMARY_TOKENS_PER_TURN = 40
+
+class InterviewContext:
+    """
+    Interview state kept incrementally across turns.
+
+    - `messages` grows by one question/answer pair per turn and its system prompt
+      (with the persona seed) never changes, so the prompt prefix stays byte-identical
+      and the server's prefix cache can reuse it.
+    - The critic sees a bounded view: extracted facts, a rolling extractive summary of
+      older turns and the most recent turns verbatim, all within `critic_budget` tokens.
+    """
+
+    def __init__(self, seed_bio: str, critic_budget: int = 1500, recent_turns: int = 2):
+        self.messages = [{
+            "role": "system",
+            "content": f"{INTERVIEW_SYSTEM_PROMPT}\n\nPersona Seed: {seed_bio}"
+        }]
+        self.critic_budget = critic_budget
+        self.recent_turns = recent_turns
+        self.facts: Dict[str, str] = {"seed": seed_bio}
+        self._recent: List[str] = []
+        self._summary: List[str] = []
+        self._critic_view: Optional[str] = ""
+
+    def messages_for(self, question: str) -> List[Dict[str, str]]:
+        return self.messages + [{"role": "user", "content": question}]
+
+    def add_turn(self, question: str, answer: str):
+        self.messages.append({"role": "user", "content": question})
+        self.messages.append({"role": "assistant", "content": answer})
+
+        for fact, pattern in FACT_PATTERNS.items():
+            if fact not in self.facts:
+                match = pattern.search(answer)
+                if match:
+                    self.facts[fact] = match.group(1).strip()
+
+        self._recent.append(f"Q: {question}\nA: {answer}")
+        while len(self._recent) > self.recent_turns:
+            oldest = self._recent.pop(0)
+            question_line, _, old_answer = oldest.partition("\nA: ")
+            # First sentence or two of each older answer, kept short
+            self._summary.append(f"{question_line[3:][:80]} -> {truncate_to_tokens(old_answer, SUMMARY_TOKENS_PER_TURN)}")
+        self._critic_view = None
+
+    def critic_view(self) -> str:
+        """
+        Token-budgeted context for the critic; rebuilt at most once per turn.
+        """
+        if self._critic_view is not None:
+            return self._critic_view
+
+        facts = "Known facts: " + "; ".join(f"{k}: {v}" for k, v in self.facts.items())
+        # Recent turns share what the facts (and section headers) leave over, capped at two thirds of the budget
+        remaining = self.critic_budget - estimate_tokens(facts) - 16
+        per_turn = min(remaining, self.critic_budget * 2 // 3) // max(1, len(self._recent)) - 1
+        recent = "\n".join(truncate_to_tokens(turn, per_turn) for turn in self._recent)
+        remaining -= estimate_tokens(recent)
+
+        # Most recent summary lines first, until the budget is spent
+        summary = []
+        for line in reversed(self._summary):
+            remaining -= estimate_tokens(line) + 1
+            if remaining < 0:
+                break
+            summary.append(line)
+        summary.reverse()
+
+        parts = [facts]
+        if summary:
+            parts.append("Earlier answers (summarised):\n" + "\n".join(summary))
+        if recent:
+            parts.append("Recent turns:\n" + recent)
+        self._critic_view = "\n\n".join(parts)
+        return self._critic_view
 
 class BackstoryGenerator:
-    def __init__(self, model_name: str = "gpt-4-turbo"):
+    def __init__(self, model_name: str = "gpt-4-turbo", speculative_candidates: int = 1, critic_context_tokens: int = 1500):
         self.model_name = model_name
+        # Upper bound on the interview context shown to the critic (see InterviewContext)
+        self.critic_context_tokens = critic_context_tokens
+        # > 1: sample this many answers per question up front and critique them in one call
+        self.speculative_candidates = speculative_candidates
+        self.speculation_stats = {"questions": 0, "candidates": 0, "completion_tokens": 0, "extra_completion_tokens": 0}
         # Questions from Alterity Paper Appendix A
         self.questions = [
             "To start, I would like to begin with a big question: tell me the story of your life. Start from the beginning–from your childhood, to education, to family and relationships, and to any major life events you may have had.",
@@ -25,17 +125,7 @@ class BackstoryGenerator:
             "Some people say they struggle with depression, anxiety, or something else like that. How about for you?"
         ]
 
-    def _format_context(self, history: List[Dict[str, str]]) -> List[Dict[str, str]]:
-        messages = [{"role": "system", "content": "You are participating in an interview. Answer the interviewer's questions naturally and consistently with your previous answers."}]
-        for turn in history:
-            messages.append({"role": "user", "content": turn["question"]})
-            messages.append({"role": "assistant", "content": turn["answer"]})
-        return messages
-
-    def critique_response(self, context_str: str, response: str) -> bool:
-        """
-        Uses a critic model to check for consistency and relevance.
-        """
+    def _critic_messages(self, context_str: str, response: str) -> List[Dict[str, str]]:
         system_prompt = (
             "You are a strict critic. Check the following interview response for:"
             "1. Internal consistency with previous context.\n"
@@ -45,106 +135,285 @@ class BackstoryGenerator:
         )
         content = f"Context:\n{context_str}\n\nResponse:\n{response}"
 
-        messages = [
+        return [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": content}
         ]
 
+    def _critic_verdict(self, resp: Dict[str, Any]) -> bool:
+        """
+        Reads a single-token `classify` result; accepts when P(YES) >= 0.5.
+        """
+        if resp.get("error") or not resp.get("probs"):
+            return True # Same fail-open policy when the critic call itself fails
+        return resp["probs"]["YES"] >= 0.5
+
+    def critique_response(self, context_str: str, response: str) -> bool:
+        """
+        Uses a critic model to check for consistency and relevance.
+        """
+        messages = self._critic_messages(context_str, response)
+
         try:
-            # Using a faster/cheaper model for critique
-            resp = chat_completion(messages, model="gpt-3.5-turbo")
-            return "YES" in resp["content"].strip().upper()
+            # Using a faster/cheaper model for critique; one output token is enough
+            resp = classify(messages, CRITIC_LABELS, model=CRITIC_MODEL)
+            return self._critic_verdict(resp)
         except Exception as e:
             print(f"[Critic Error] {e}")
             return True # Fail open if critic breaks? Or fail closed? Falling open for prototype.
 
+    def critique_candidates(self, context_str: str, candidates: List[str]) -> Optional[int]:
+        """
+        Critiques several candidate answers in a single critic call.
+        Returns the index of the first acceptable candidate, or None if all were rejected.
+        """
+        listing = "\n\n".join(f"Candidate {n + 1}:\n{c}" for n, c in enumerate(candidates))
+        messages = self._critic_messages(context_str, listing)
+        messages[0]["content"] += (
+            "\nSeveral candidate responses follow. Judge each one separately and answer with one line "
+            "per candidate in the form '<number>: YES' or '<number>: NO'."
+        )
+
+        try:
+            # About six tokens per "<n>: YES" line
+            resp = chat_completion(messages, model=CRITIC_MODEL, max_tokens=8 * len(candidates) + 8)
+        except Exception as e:
+            print(f"[Critic Error] {e}")
+            return 0
+        if resp.get("error"):
+            return 0 # Fail open, as in critique_response
+
+        verdicts = {int(n) - 1: v.upper() == "YES" for n, v in re.findall(r"(\d+)\s*[:.)-]\s*(YES|NO)", resp["content"], re.I)}
+        for n in range(len(candidates)):
+            if verdicts.get(n):
+                return n
+        return None
+
+    def _speculative_answer(self, messages: List[Dict[str, str]], context: InterviewContext, i: int) -> str:
+        """
+        One round trip per question: k samples from a single `n` request (topped up with
+        parallel requests if the server returns fewer), then one batched critic call.
+        Falls back to the first candidate when the critic rejects them all.
+        """
+        k = self.speculative_candidates
+        resp_data = chat_completion(messages, model=self.model_name, n=k)
+        candidates = [] if resp_data.get("error") else resp_data.get("choices") or [resp_data["content"]]
+        completion_tokens = resp_data["usage"]["completion_tokens"]
+
+        if len(candidates) < k:
+            for _, extra in imap_chat_completions([messages] * (k - len(candidates)), model=self.model_name):
+                if not extra.get("error"):
+                    candidates.append(extra["content"])
+                    completion_tokens += extra["usage"]["completion_tokens"]
+
+        if not candidates:
+            raise RuntimeError(f"Generation failed for Q{i+1}: {resp_data.get('error')}")
+
+        chosen = self.critique_candidates(context.critic_view(), candidates)
+        if chosen is None:
+            print(f"[Critic] Rejected all {len(candidates)} candidates for Q{i+1}. Accepting the first.")
+            chosen = 0
+
+        # Tokens spent on candidates that were thrown away, apportioned by length
+        total_chars = sum(len(c) for c in candidates) or 1
+        stats = self.speculation_stats
+        stats["questions"] += 1
+        stats["candidates"] += len(candidates)
+        stats["completion_tokens"] += completion_tokens
+        stats["extra_completion_tokens"] += round(completion_tokens * (1 - len(candidates[chosen]) / total_chars))
+        return candidates[chosen]
+
+    def _new_context(self, seed_bio: str) -> InterviewContext:
+        return InterviewContext(seed_bio, critic_budget=self.critic_context_tokens)
+
     def generate_interview(self, seed_bio: str) -> str:
-        history = []
-        # Pre-seed the history optionally, or just let the first question drive it
-        # based on a system prompt that includes the seed.
+        # The seed lives in the (fixed) system prompt, so every turn shares the same prefix
+        context = self._new_context(seed_bio)
 
         full_transcript = []
 
         print(f"[Generator] Starting interview for seed: {seed_bio[:30]}...")
 
         for i, question in enumerate(self.questions):
-            messages = self._format_context(history)
-            # Inject the seed instructions only in the very first system message or first user message
-            if i == 0:
-                messages[0]["content"] += f"\n\nPersona Seed: {seed_bio}"
-
-            messages.append({"role": "user", "content": question})
+            messages = context.messages_for(question)
 
             valid = False
             attempts = 0
             best_response = ""
+            candidate = None
+
+            if self.speculative_candidates > 1:
+                candidate = best_response = self._speculative_answer(messages, context, i)
+                valid = True
 
             while not valid and attempts < 3:
                 resp_data = chat_completion(messages, model=self.model_name)
+                if resp_data.get("error"):
+                    print(f"[Generator] Generation failed for Q{i+1}: {resp_data['error']}")
+                    attempts += 1
+                    continue
                 candidate = resp_data["content"]
 
-                # Context string for critic
-                context_str = "\n".join([f"Q: {h['question']}\nA: {h['answer']}" for h in history])
-                if self.critique_response(context_str, candidate):
+                # Bounded context for critic
+                if self.critique_response(context.critic_view(), candidate):
                     best_response = candidate
                     valid = True
                 else:
                     print(f"[Critic] Rejected response for Q{i+1}. Retrying...")
                     attempts += 1
 
+            if candidate is None:
+                raise RuntimeError(f"Generation failed for Q{i+1} after 3 attempts")
             if not valid:
                 print(f"[Generator] Valid response failed for Q{i+1} after 3 attempts. Accepting last candidate.")
                 best_response = candidate
 
-            history.append({"question": question, "answer": best_response})
+            context.add_turn(question, best_response)
             full_transcript.append(f"Interviewer: {question}\nParticipant: {best_response}")
             print(f"[Generator] Completed Q{i+1}/10")
 
+        if self.speculative_candidates > 1:
+            stats = self.speculation_stats
+            print(
+                f"[Generator] Speculation so far: {stats['candidates']} candidates for {stats['questions']} questions, "
+                f"~{stats['extra_completion_tokens']}/{stats['completion_tokens']} completion tokens on discarded candidates."
+            )
+
         return "\n\n".join(full_transcript)
 
-    def run_pipeline(self, num_backstories: int = 1, model_name: str = None) -> List[Dict[str, Any]]:
+    def generate_interviews(self, seed_bios: List[str], max_concurrency: Optional[int] = None) -> List[Optional[str]]:
+        """
+        Runs many interviews at once, wave by wave. Questions stay sequential within each
+        persona, but question i is issued for every persona as one concurrent wave (then
+        their critic calls as a second wave), which is how vLLM reaches its throughput.
+        Same retry/critic policy as generate_interview; a persona whose generation keeps
+        failing is dropped (None) instead of aborting the whole batch.
+        """
+        contexts = [self._new_context(seed_bio) for seed_bio in seed_bios]
+        transcripts: List[List[str]] = [[] for _ in seed_bios]
+        active = list(range(len(seed_bios)))
+
+        print(f"[Generator] Starting {len(seed_bios)} interviews in parallel...")
+
+        for i, question in enumerate(self.questions):
+            messages = {p: contexts[p].messages_for(question) for p in active}
+            candidates: Dict[int, str] = {}
+            accepted: Dict[int, str] = {}
+            pending = list(active)
+
+            for _ in range(3):
+                if not pending:
+                    break
+
+                # Generation wave
+                generated = {}
+                for n, resp_data in imap_chat_completions(
+                    [messages[p] for p in pending], model=self.model_name, max_concurrency=max_concurrency
+                ):
+                    if resp_data.get("error"):
+                        print(f"[Generator] Generation failed for Q{i+1}: {resp_data['error']}")
+                        continue
+                    generated[pending[n]] = resp_data["content"]
+                candidates.update(generated)
+
+                # Critic wave
+                reviewed = list(generated)
+                verdicts = {}
+                for n, resp in imap_classify(
+                    [self._critic_messages(contexts[p].critic_view(), generated[p]) for p in reviewed],
+                    CRITIC_LABELS,
+                    model=CRITIC_MODEL,
+                    max_concurrency=max_concurrency
+                ):
+                    verdicts[reviewed[n]] = self._critic_verdict(resp)
+
+                for p in reviewed:
+                    if verdicts.get(p, True):
+                        accepted[p] = generated[p]
+                rejected = [p for p in reviewed if p not in accepted]
+                if rejected:
+                    print(f"[Critic] Rejected {len(rejected)} responses for Q{i+1}. Retrying...")
+                pending = [p for p in pending if p not in accepted]
+
+            for p in pending:
+                if p in candidates:
+                    print(f"[Generator] Valid response failed for Q{i+1} after 3 attempts. Accepting last candidate.")
+                    accepted[p] = candidates[p]
+                else:
+                    print(f"[Generator] Generation failed for Q{i+1} after 3 attempts. Dropping persona.")
+
+            active = [p for p in active if p in accepted]
+            for p in active:
+                contexts[p].add_turn(question, accepted[p])
+                transcripts[p].append(f"Interviewer: {question}\nParticipant: {accepted[p]}")
+            print(f"[Generator] Completed Q{i+1}/{len(self.questions)} for {len(active)} personas")
+
+        completed = set(active)
+        return ["\n\n".join(transcripts[p]) if p in completed else None for p in range(len(seed_bios))]
+
+    def run_pipeline(
+        self,
+        num_backstories: int = 1,
+        model_name: str = None,
+        personas_in_flight: Optional[int] = None,
+        speculative_candidates: Optional[int] = None,
+        seeds: Optional[List[Tuple[str, Dict[str, Any]]]] = None,
+        custom_tags: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Generates and saves `num_backstories` backstories, running up to `personas_in_flight`
+        interviews at once (defaults to the model's concurrency limit; 1 = one at a time).
+        `speculative_candidates` applies to one-at-a-time interviews (see generate_interview).
+        `seeds` gives explicit (seed bio, demographics) pairs, e.g. targeted seeds from the
+        pool replenisher; otherwise seeds are drawn at random from the configured SEED_POOL.
+        """
         # Override model if provided
         if model_name:
             self.model_name = model_name
+        if speculative_candidates is not None:
+            self.speculative_candidates = speculative_candidates
+        if personas_in_flight is None:
+            personas_in_flight = config_manager.get_model_concurrency(self.model_name)
+        personas_in_flight = max(1, personas_in_flight)
+
+        # 1. Selection / Seeding
+        if seeds is None:
+            seed_pool = config_manager.get_seed_pool()
+            seeds = [(random.choice(seed_pool), {}) for _ in range(num_backstories)]
 
         db = SessionLocal()
         results = []
 
         try:
-            for _ in range(num_backstories):
-                # 1. Selection / Seeding
-                import random
-                SEED_POOL = [
-                    "A 30-year-old nurse from Ohio who votes Independent.",
-                    "A 55-year-old truck driver from Alabama, strictly Republican.",
-                    "A 22-year-old college student in California studying Art, very liberal.",
-                    "A 40-year-old software engineer in Seattle, libertarian leaning.",
-                    "A 65-year-old retiree in Florida, concerned about social security.",
-                    "A 28-year-old teacher in Chicago, active in unions.",
-                    "A 45-year-old small business owner in Texas.",
-                    "A 35-year-old stay-at-home parent in Utah.",
-                    "A 50-year-old factory worker in Michigan.",
-                    "A 25-year-old barista in Portland, Oregon."
-                ]
-                seed = random.choice(SEED_POOL)
+            for start in range(0, len(seeds), personas_in_flight):
+                wave = seeds[start:start + personas_in_flight]
 
                 # 2. Multi-turn Generation
-                transcript = self.generate_interview(seed)
-
-                # 3. Save
-                # In a real app we'd parse demographics using `dynamic_labeler`.
-                # For now using the seed as placeholder or extracted elsewhere.
-                demographics = {}
-
-                backstory = Backstory(
-                    content=transcript,
-                    model_signature=self.model_name,
-                    demographics=demographics,
-                    custom_tags={"seed": seed}
-                )
-                db.add(backstory)
-                results.append(backstory)
-                db.commit() # Commit each one
+                if len(wave) == 1:
+                    transcripts = [self.generate_interview(wave[0][0])]
+                else:
+                    transcripts = self.generate_interviews([seed for seed, _ in wave])
+
+                # 3. Structured trait extraction, one batched call per backstory in the wave
+                done = [n for n, transcript in enumerate(transcripts) if transcript is not None]
+                extracted = dict(zip(done, trait_extractor.extract_batch([transcripts[n] for n in done])))
+
+                # 4. Save
+                for n in done:
+                    seed, seed_demographics = wave[n]
+                    # Targeted seeds keep the cells they were written for (in the demand's own
+                    # vocabulary); extraction fills in everything else
+                    demographics = {**extracted[n], **seed_demographics}
+
+                    backstory = Backstory(
+                        content=transcripts[n],
+                        model_signature=self.model_name,
+                        demographics=demographics,
+                        custom_tags={**(custom_tags or {}), "seed": seed}
+                    )
+                    db.add(backstory)
+                    results.append(backstory)
+                db.commit() # Commit each wave
 
             print(f"[Generator] Saved {len(results)} backstories.")
 
@@ -0,0 +1,309 @@
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import tuple_
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal, Backstory
+from modules.matcher import TraitTable, EncodedCandidates
+
+INDEX_DIR = os.getenv("BACKSTORY_INDEX_DIR", "/tmp/alterity_backstory_index")
+
+# Rows committed slightly out of updated_at order are caught by re-reading this window
+REFRESH_OVERLAP = timedelta(seconds=60)
+# Superseded snapshot versions are kept this many deep, and older ones only deleted once
+# they are past the grace period, so a sibling process mid-load never loses its files
+SNAPSHOT_KEEP_VERSIONS = 3
+SNAPSHOT_GRACE_SECONDS = 600
+
+class BackstoryIndex:
+    """
+    Long-lived, compact in-memory index of the backstory pool for matching.
+
+    Holds, per backstory row: its id, whether it has demographics, and every
+    demographics / custom_tags trait encoded as TraitTables (NumPy arrays).
+    `refresh()` applies only rows whose updated_at is past the high-water mark;
+    deleted rows leave no trace there, so `reconcile()` drops ids no longer in the table.
+    Snapshots are plain .npy files plus a JSON manifest; sibling worker processes
+    load them with mmap so the arrays are shared through the page cache.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.has_demographics = np.empty(0, dtype=bool)
+        self.demographics: Dict[str, TraitTable] = {}
+        self.custom_tags: Dict[str, TraitTable] = {}
+        self.high_water: Optional[datetime] = None
+        self._row_of: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    # --- Refresh ---
+
+    def refresh(self, batch_size: int = 5000) -> int:
+        """
+        Pulls new or changed backstories (id, demographics, custom_tags only) in keyset
+        pages ordered by (updated_at, id). Returns the number of rows applied.
+        """
+        since = self.high_water - REFRESH_OVERLAP if self.high_water else None
+        cursor = (since, 0) if since else None
+        applied = 0
+
+        db = SessionLocal()
+        try:
+            while True:
+                query = db.query(Backstory.id, Backstory.demographics, Backstory.custom_tags, Backstory.updated_at)
+                if cursor:
+                    query = query.filter(tuple_(Backstory.updated_at, Backstory.id) > tuple_(*cursor))
+                rows = query.order_by(Backstory.updated_at, Backstory.id).limit(batch_size).all()
+                if not rows:
+                    break
+
+                with self._lock:
+                    self._apply(rows)
+                applied += len(rows)
+                cursor = (rows[-1].updated_at, rows[-1].id)
+                self.high_water = max(self.high_water or cursor[0], cursor[0])
+        finally:
+            db.close()
+
+        if applied:
+            print(f"[BackstoryIndex] Applied {applied} rows; index holds {len(self)} backstories.")
+        return applied
+
+    def _apply(self, rows: List[Any]):
+        positions = []
+        new_ids = []
+        for row in rows:
+            position = self._row_of.get(row.id)
+            if position is None:
+                position = len(self.ids) + len(new_ids)
+                self._row_of[row.id] = position
+                new_ids.append(row.id)
+            positions.append(position)
+
+        n_rows = len(self.ids) + len(new_ids)
+        self.ids = np.concatenate([self.ids, np.asarray(new_ids, dtype=np.int64)])
+        self.has_demographics = np.concatenate([self.has_demographics, np.zeros(len(new_ids), dtype=bool)])
+        positions = np.asarray(positions, dtype=np.int64)
+        self.has_demographics[positions] = [bool(row.demographics) for row in rows]
+
+        for namespace, column in ((self.demographics, "demographics"), (self.custom_tags, "custom_tags")):
+            values = [getattr(row, column) or {} for row in rows]
+            for trait in {key for v in values for key in v} - namespace.keys():
+                namespace[trait] = TraitTable()
+            for trait, table in namespace.items():
+                table.set_rows(positions, [v.get(trait) for v in values])
+                table.pad(n_rows)
+
+    def reconcile(self) -> int:
+        """
+        Removes indexed ids that no longer exist in the backstories table (one id-only scan).
+        Returns the number of rows removed.
+        """
+        db = SessionLocal()
+        try:
+            live = np.asarray([backstory_id for (backstory_id,) in db.query(Backstory.id).all()], dtype=np.int64)
+        finally:
+            db.close()
+        with self._lock:
+            gone = self.ids[~np.isin(self.ids, live)]
+        return self.remove(gone)
+
+    def remove(self, backstory_ids: List[int]) -> int:
+        """
+        Drops rows by id. Tables are rebuilt rather than edited, so an EncodedCandidates
+        view handed out earlier stays consistent with its own candidates list.
+        """
+        with self._lock:
+            keep = ~np.isin(self.ids, np.asarray(list(backstory_ids), dtype=np.int64))
+            removed = int(len(keep) - keep.sum())
+            if not removed:
+                return 0
+            self.ids = np.array(self.ids[keep])
+            self.has_demographics = np.array(self.has_demographics[keep])
+            self.demographics = {trait: table.take_rows(keep) for trait, table in self.demographics.items()}
+            self.custom_tags = {trait: table.take_rows(keep) for trait, table in self.custom_tags.items()}
+            self._row_of = {int(i): n for n, i in enumerate(self.ids)}
+        print(f"[BackstoryIndex] Removed {removed} deleted backstories; index holds {len(self)} backstories.")
+        return removed
+
+    # --- Matching view ---
+
+    def encoded(self) -> EncodedCandidates:
+        """
+        Demographics and custom tags view for Matcher.compute_log_weights / match_population,
+        aligned with `candidates()`.
+        """
+        with self._lock:
+            return EncodedCandidates.from_tables(self.has_demographics.copy(), self.demographics, self.custom_tags)
+
+    def candidates(self) -> List[Dict[str, Any]]:
+        return [{"id": int(i)} for i in self.ids]
+
+    # --- Snapshots ---
+
+    def save_snapshot(self, directory: str = INDEX_DIR):
+        """
+        Writes the index as a new versioned snapshot and atomically repoints CURRENT at it.
+        """
+        os.makedirs(directory, exist_ok=True)
+        version = tempfile.mkdtemp(prefix="v", dir=directory)
+
+        with self._lock:
+            manifest = {
+                "high_water": self.high_water.isoformat() if self.high_water else None,
+                "namespaces": {}
+            }
+            np.save(os.path.join(version, "ids.npy"), self.ids)
+            np.save(os.path.join(version, "has_demographics.npy"), self.has_demographics)
+            for name, namespace in (("demographics", self.demographics), ("custom_tags", self.custom_tags)):
+                manifest["namespaces"][name] = {}
+                for n, (trait, table) in enumerate(namespace.items()):
+                    prefix = f"{name}.{n}"
+                    for field in ("det_codes", "dist_rows", "dist_codes", "dist_probs"):
+                        np.save(os.path.join(version, f"{prefix}.{field}.npy"), getattr(table, field))
+                    manifest["namespaces"][name][trait] = {
+                        "prefix": prefix,
+                        "lower_vocab": list(table.lower_vocab),
+                        "exact_vocab": list(table.exact_vocab)
+                    }
+
+        with open(os.path.join(version, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        pointer = os.path.join(directory, "CURRENT")
+        with open(pointer + ".tmp", "w") as f:
+            f.write(os.path.basename(version))
+        os.replace(pointer + ".tmp", pointer)
+
+        self._prune_snapshots(directory, os.path.basename(version))
+        print(f"[BackstoryIndex] Saved snapshot of {len(self)} backstories to {version}.")
+
+    @staticmethod
+    def _prune_snapshots(directory: str, current: str):
+        """
+        Deletes superseded versions beyond the newest SNAPSHOT_KEEP_VERSIONS that are also
+        older than SNAPSHOT_GRACE_SECONDS. A reader that resolved CURRENT just before the
+        swap still finds every file of its version while it loads.
+        """
+        versions = sorted(
+            (entry for entry in os.scandir(directory) if entry.is_dir() and entry.name != current),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        cutoff = time.time() - SNAPSHOT_GRACE_SECONDS
+        for entry in versions[SNAPSHOT_KEEP_VERSIONS - 1:]:
+            if entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    @classmethod
+    def load_snapshot(cls, directory: str = INDEX_DIR) -> Optional["BackstoryIndex"]:
+        """
+        Maps the CURRENT snapshot read-only (mmap); returns None if there is none.
+        If the version is pruned mid-load (only possible past the grace period), CURRENT
+        is read again.
+        """
+        pointer = os.path.join(directory, "CURRENT")
+        for attempt in range(3):
+            if not os.path.exists(pointer):
+                return None
+            try:
+                return cls._load_version(os.path.join(directory, open(pointer).read().strip()))
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                print("[BackstoryIndex] Snapshot changed while loading; retrying.")
+
+    @classmethod
+    def _load_version(cls, version: str) -> "BackstoryIndex":
+        with open(os.path.join(version, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        index = cls()
+        index.ids = np.load(os.path.join(version, "ids.npy"), mmap_mode="r")
+        index.has_demographics = np.load(os.path.join(version, "has_demographics.npy"), mmap_mode="r")
+        index.high_water = datetime.fromisoformat(manifest["high_water"]) if manifest["high_water"] else None
+        index._row_of = {int(i): n for n, i in enumerate(index.ids)}
+
+        for name, traits in manifest["namespaces"].items():
+            namespace = getattr(index, name)
+            for trait, meta in traits.items():
+                table = TraitTable()
+                for field in ("det_codes", "dist_rows", "dist_codes", "dist_probs"):
+                    setattr(table, field, np.load(os.path.join(version, f"{meta['prefix']}.{field}.npy"), mmap_mode="r"))
+                table.lower_vocab = {v: n for n, v in enumerate(meta["lower_vocab"])}
+                table.exact_vocab = {v: n for n, v in enumerate(meta["exact_vocab"])}
+                namespace[trait] = table
+
+        print(f"[BackstoryIndex] Mapped snapshot of {len(index)} backstories from {version}.")
+        return index
+
+class IndexManager:
+    """
+    Process-wide index: loaded from the shared snapshot (or built) on first use,
+    refreshed incrementally at most every `min_refresh_interval` seconds, and
+    re-snapshotted at most every `snapshot_interval` seconds when it changed.
+    Deleted backstories are reconciled away every `reconcile_interval` seconds.
+    """
+
+    def __init__(self, min_refresh_interval: float = 5.0, snapshot_interval: float = 300.0, reconcile_interval: float = 60.0):
+        self.min_refresh_interval = min_refresh_interval
+        self.snapshot_interval = snapshot_interval
+        self.reconcile_interval = reconcile_interval
+        self._index: Optional[BackstoryIndex] = None
+        self._last_refresh = 0.0
+        self._last_reconcile = 0.0
+        self._last_snapshot = time.monotonic()
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def get(self) -> BackstoryIndex:
+        with self._lock:
+            if self._index is None:
+                self._index = BackstoryIndex.load_snapshot() or BackstoryIndex()
+                self._dirty = not len(self._index)
+
+            now = time.monotonic()
+            if now - self._last_refresh >= self.min_refresh_interval:
+                self._dirty |= self._index.refresh() > 0
+                self._last_refresh = now
+            if now - self._last_reconcile >= self.reconcile_interval:
+                self._dirty |= self._index.reconcile() > 0
+                self._last_reconcile = now
+
+            if self._dirty and now - self._last_snapshot >= self.snapshot_interval:
+                try:
+                    self._index.save_snapshot()
+                    self._dirty = False
+                except Exception as e:
+                    print(f"[BackstoryIndex Error] Snapshot failed: {e}")
+                self._last_snapshot = now
+
+            return self._index
+
+    def remove(self, backstory_ids: List[int]) -> int:
+        """
+        Drops ids found missing outside a reconciliation (e.g. at hydration time).
+        """
+        with self._lock:
+            if self._index is None:
+                return 0
+            removed = self._index.remove(backstory_ids)
+            self._dirty |= removed > 0
+            return removed
+
+# Singleton
+backstory_index = IndexManager()
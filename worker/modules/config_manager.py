@@ -1,10 +1,17 @@
 
 import os
+import copy
 import json
-from typing import Any, Dict, List
+import time
+import threading
+from typing import Any, Callable, Dict, List, Tuple
 from sqlalchemy.orm import Session
 from database import SessionLocal, Configuration, FeatureFlag
 
+# Settings are read on hot paths (every LLM call and retry), so lookups are cached per
+# process this long instead of costing a pooled DB connection and a round trip each time
+CONFIG_TTL_SECONDS = float(os.getenv("CONFIG_TTL_SECONDS", "30"))
+
 class ConfigManager:
     _instance = None
 
@@ -21,6 +28,11 @@ class ConfigManager:
         "A 22-year-old college student in California studying Art, very liberal.",
         "A 40-year-old software engineer in Seattle, libertarian leaning.",
         "A 65-year-old retiree in Florida, concerned about social security.",
+        "A 28-year-old teacher in Chicago, active in unions.",
+        "A 45-year-old small business owner in Texas.",
+        "A 35-year-old stay-at-home parent in Utah.",
+        "A 50-year-old factory worker in Michigan.",
+        "A 25-year-old barista in Portland, Oregon."
     ]
 
     DEFAULT_QUESTIONS = [
@@ -34,23 +46,151 @@ class ConfigManager:
         "meta-llama/Meta-Llama-3-70B-Instruct"
     ]
 
+    # Traits extracted from every new backstory, with their allowed values
+    # (vocabulary matches supabase/seed.sql and the demographic configs)
+    DEFAULT_STANDARD_TRAITS = {
+        "age": ["18-24", "25-34", "35-44", "45-54", "55-64", "65+"],
+        "gender": ["Male", "Female", "Non-binary"],
+        "political_party": ["Republican", "Democrat", "Independent", "Libertarian", "Green"],
+        "region": ["Northeast", "Midwest", "South", "West"],
+        "education": ["Less than high school", "High school", "Some college", "Bachelor's degree", "Graduate degree"],
+        "race": ["White", "Black", "Hispanic", "Asian", "Native American", "Multiracial", "Other"],
+        "income": ["Under $30k", "$30k-$60k", "$60k-$100k", "$100k-$150k", "Over $150k"]
+    }
+
+    # Max in-flight requests per model across the whole worker process
+    DEFAULT_MODEL_CONCURRENCY = {
+        "default": 8
+    }
+
+    # Client-side request/token budgets per model (None = unlimited)
+    DEFAULT_RATE_LIMITS = {
+        "default": {"requests_per_minute": None, "tokens_per_minute": None}
+    }
+
+    # Retries for throttled / transient LLM errors
+    DEFAULT_RETRY = {
+        "max_retries": 6,
+        "base_delay": 1.0,
+        "max_delay": 60.0
+    }
+
+    # Response cache tunables (see modules/response_cache.py)
+    DEFAULT_RESPONSE_CACHE = {
+        "max_entries": 10000,
+        "max_bytes": 64 * 1024 * 1024,
+        "ttl_seconds": 7 * 24 * 3600,
+        "disk_max_bytes": 1024 * 1024 * 1024
+    }
+
+    # Temperature scaling of single-token classifier probabilities per model (1.0 = raw logprobs)
+    DEFAULT_CLASSIFIER_CALIBRATION = {
+        "default": 1.0
+    }
+
+    # vLLM replicas per local model, e.g. {"meta-llama/Meta-Llama-3-8B-Instruct": ["http://vllm-a:8000/v1", ...],
+    # "default": [...]}; empty falls back to the VLLM_BASE_URL env var (see modules/replica_router.py)
+    DEFAULT_VLLM_ENDPOINTS = {}
+
+    DEFAULT_REPLICA_ROUTING = {
+        "prefix_affinity": True,
+        "affinity_slack": 2,
+        "affinity_entries": 10000,
+        "latency_alpha": 0.2,
+        "eject_seconds": 10,
+        "max_eject_seconds": 300,
+        "health_check_interval": 5,
+        "health_timeout": 5
+    }
+
+    # Context window (prompt + completion tokens) per model
+    DEFAULT_CONTEXT_WINDOWS = {
+        "gpt-4-turbo": 128000,
+        "gpt-4o": 128000,
+        "gpt-4o-mini": 128000,
+        "gpt-4": 8192,
+        "gpt-3.5-turbo": 16385,
+        "meta-llama/Meta-Llama-3-8B-Instruct": 8192,
+        "meta-llama/Meta-Llama-3-70B-Instruct": 8192,
+        "default": 8192
+    }
+
+    # Per-request prompt planning (see modules/context_budget.py); the margin covers
+    # tokenizer mismatch for models counted with a related tokenizer
+    DEFAULT_CONTEXT_BUDGET = {
+        "max_output_tokens": 1000,
+        "safety_margin": 256
+    }
+
+    # Embedding model for backstory vectors (must match the 1536-dim column in schema.sql)
+    DEFAULT_EMBEDDING = {
+        "model": "text-embedding-3-small",
+        "batch_size": 256
+    }
+
+    # Background pool replenishment (see modules/pool_replenisher.py)
+    DEFAULT_POOL_REPLENISHMENT = {
+        "interval_seconds": 600,
+        "lookback_days": 14,
+        "default_population_size": 5,
+        "coverage_factor": 3.0,
+        "max_backstories_per_cycle": 20,
+        "max_backstories_per_day": 200,
+        "model_name": "gpt-4-turbo"
+    }
+
+    # Cascade labelling: embedding classifier first, LLM only when unsure (see modules/trait_probe.py)
+    DEFAULT_LABEL_CASCADE = {
+        "seed_size": 200,
+        "round_size": 500,
+        "confidence": 0.9,
+        "max_llm_share": 0.2,
+        "audit_size": 100,
+        "l2": 0.1,
+        "write_batch_size": 1000
+    }
+
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(ConfigManager, cls).__new__(cls)
+            cls._instance._cache = {}
+            cls._instance._cache_lock = threading.Lock()
         return cls._instance
 
+    def _cached(self, key: Tuple, load: Callable[[], Any]) -> Any:
+        """
+        `load()` at most once per CONFIG_TTL_SECONDS per key; callers get their own copy.
+        Failed loads raise and are not cached.
+        """
+        now = time.monotonic()
+        with self._cache_lock:
+            hit = self._cache.get(key)
+        if hit is None or hit[0] <= now:
+            hit = (now + CONFIG_TTL_SECONDS, load())
+            with self._cache_lock:
+                self._cache[key] = hit
+        return copy.deepcopy(hit[1])
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
     def _get_config(self, key: str, default: Any) -> Any:
-        db: Session = SessionLocal()
+        def load():
+            db: Session = SessionLocal()
+            try:
+                config = db.query(Configuration).filter(Configuration.key == key).first()
+                if config:
+                    return config.value
+                return default
+            finally:
+                db.close()
+
         try:
-            config = db.query(Configuration).filter(Configuration.key == key).first()
-            if config:
-                return config.value
-            return default
+            return self._cached(("config", key), load)
         except Exception as e:
             print(f"[ConfigManager Error] Failed to fetch {key}: {e}")
             return default
-        finally:
-            db.close()
 
     def get_pricing(self) -> Dict[str, Dict[str, float]]:
         return self._get_config("PRICING_MODEL", self.DEFAULT_PRICING)
@@ -61,20 +201,67 @@ class ConfigManager:
     def get_interview_questions(self) -> List[str]:
         return self._get_config("INTERVIEW_QUESTIONS", self.DEFAULT_QUESTIONS)
 
+    def get_standard_traits(self) -> Dict[str, List[str]]:
+        return self._get_config("STANDARD_TRAITS", self.DEFAULT_STANDARD_TRAITS)
+
     def get_local_models(self) -> List[str]:
         return self._get_config("LOCAL_MODELS", self.DEFAULT_LOCAL_MODELS)
 
+    def get_model_concurrency(self, model: str) -> int:
+        limits = self._get_config("MODEL_CONCURRENCY", self.DEFAULT_MODEL_CONCURRENCY)
+        return int(limits.get(model, limits.get("default", self.DEFAULT_MODEL_CONCURRENCY["default"])))
+
+    def get_rate_limits(self, model: str) -> Dict[str, Any]:
+        limits = self._get_config("RATE_LIMITS", self.DEFAULT_RATE_LIMITS)
+        return limits.get(model, limits.get("default", self.DEFAULT_RATE_LIMITS["default"]))
+
+    def get_retry_settings(self) -> Dict[str, float]:
+        return {**self.DEFAULT_RETRY, **self._get_config("LLM_RETRY", {})}
+
+    def get_response_cache_settings(self) -> Dict[str, int]:
+        return {**self.DEFAULT_RESPONSE_CACHE, **self._get_config("RESPONSE_CACHE", {})}
+
+    def get_classifier_temperature(self, model: str) -> float:
+        temperatures = self._get_config("CLASSIFIER_CALIBRATION", self.DEFAULT_CLASSIFIER_CALIBRATION)
+        return float(temperatures.get(model, temperatures.get("default", 1.0)))
+
+    def get_vllm_endpoints(self) -> Dict[str, List[str]]:
+        return self._get_config("VLLM_ENDPOINTS", self.DEFAULT_VLLM_ENDPOINTS)
+
+    def get_replica_routing_settings(self) -> Dict[str, Any]:
+        return {**self.DEFAULT_REPLICA_ROUTING, **self._get_config("REPLICA_ROUTING", {})}
+
+    def get_context_window(self, model: str) -> int:
+        windows = self._get_config("CONTEXT_WINDOWS", self.DEFAULT_CONTEXT_WINDOWS)
+        return int(windows.get(model, windows.get("default", self.DEFAULT_CONTEXT_WINDOWS["default"])))
+
+    def get_context_budget_settings(self) -> Dict[str, Any]:
+        return {**self.DEFAULT_CONTEXT_BUDGET, **self._get_config("CONTEXT_BUDGET", {})}
+
+    def get_embedding_settings(self) -> Dict[str, Any]:
+        return {**self.DEFAULT_EMBEDDING, **self._get_config("EMBEDDING", {})}
+
+    def get_pool_replenishment_settings(self) -> Dict[str, Any]:
+        return {**self.DEFAULT_POOL_REPLENISHMENT, **self._get_config("POOL_REPLENISHMENT", {})}
+
+    def get_label_cascade_settings(self) -> Dict[str, Any]:
+        return {**self.DEFAULT_LABEL_CASCADE, **self._get_config("LABEL_CASCADE", {})}
+
     def is_flag_enabled(self, flag_name: str, default: bool = False) -> bool:
-        db: Session = SessionLocal()
+        def load():
+            db: Session = SessionLocal()
+            try:
+                flag = db.query(FeatureFlag).filter(FeatureFlag.name == flag_name).first()
+                if flag:
+                    return flag.is_enabled
+                return default
+            finally:
+                db.close()
+
         try:
-            flag = db.query(FeatureFlag).filter(FeatureFlag.name == flag_name).first()
-            if flag:
-                return flag.is_enabled
-            return default
+            return self._cached(("flag", flag_name, default), load)
         except Exception as e:
             print(f"[ConfigManager Error] Failed to fetch flag {flag_name}: {e}")
             return default
-        finally:
-            db.close()
 
 config_manager = ConfigManager()
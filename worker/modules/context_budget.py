@@ -0,0 +1,163 @@
+import sys
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, cast, func, or_, update
+from sqlalchemy.dialects.postgresql import JSONB
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal, Backstory
+from modules.config_manager import config_manager
+from modules.tokens import compact_to_tokens, count_message_tokens, count_tokens, has_tokenizer, tokenizer_family
+
+def save_token_counts(db, family: str, counts: Dict[int, int]):
+    """
+    Merges {family: count} into token_counts for each backstory id (one executemany UPDATE). Caller commits.
+    """
+    table = Backstory.__table__
+    merge_counts = (
+        update(table)
+        .where(table.c.id == bindparam("b_id"))
+        .values(token_counts=func.coalesce(table.c.token_counts, cast({}, JSONB)).op("||")(bindparam("counts", type_=JSONB)))
+    )
+    db.execute(merge_counts, [{"b_id": backstory_id, "counts": {family: count}} for backstory_id, count in counts.items()])
+
+def backstory_token_counts(backstories: List[Dict[str, Any]], model: str) -> Dict[int, int]:
+    """
+    Content token counts for the model's tokenizer family. Stored counts are reused; missing
+    ones are counted now and stored for next time (only when a real tokenizer is available).
+    """
+    family = tokenizer_family(model)
+    counts: Dict[int, int] = {}
+    missing: Dict[int, int] = {}
+    for b in backstories:
+        if b["id"] in counts:
+            continue
+        stored = (b.get("token_counts") or {}).get(family)
+        if stored is not None:
+            counts[b["id"]] = int(stored)
+        else:
+            counts[b["id"]] = missing[b["id"]] = count_tokens(b["content"], model)
+
+    if missing and has_tokenizer(model):
+        db = SessionLocal()
+        try:
+            save_token_counts(db, family, missing)
+            db.commit()
+        except Exception as e:
+            print(f"[ContextBudget Error] Failed to store token counts: {e}")
+            db.rollback()
+        finally:
+            db.close()
+    return counts
+
+def count_backstory_tokens(models: List[str], batch_size: int = 500, limit: Optional[int] = None) -> int:
+    """
+    Fills token_counts for every tokenizer family used by `models`, for rows missing it.
+    Walks the table by id in batches, committing each (like embed_backstories).
+    Returns the number of counts written.
+    """
+    written = 0
+    for family, model in {tokenizer_family(model): model for model in models}.items():
+        if not has_tokenizer(model):
+            print(f"[ContextBudget] No tokenizer for {family}; skipping.")
+            continue
+        db = SessionLocal()
+        last_id = 0
+        try:
+            while limit is None or written < limit:
+                size = batch_size if limit is None else min(batch_size, limit - written)
+                rows = (
+                    db.query(Backstory.id, Backstory.content)
+                    .filter(
+                        or_(Backstory.token_counts.is_(None), ~Backstory.token_counts.has_key(family)),
+                        Backstory.id > last_id
+                    )
+                    .order_by(Backstory.id)
+                    .limit(size)
+                    .all()
+                )
+                if not rows:
+                    break
+                last_id = rows[-1].id
+                save_token_counts(db, family, {row.id: count_tokens(row.content, model) for row in rows})
+                db.commit()
+                written += len(rows)
+                print(f"[ContextBudget] Counted {family} tokens for {written} backstories (up to id {last_id}).")
+        except Exception as e:
+            print(f"[ContextBudget Error] {e}")
+            db.rollback()
+        finally:
+            db.close()
+    return written
+
+def plan_context(
+    model: str,
+    probes: List[Tuple[int, str]],
+    build_messages: Callable[[str, str], List[Dict[str, str]]],
+    backstories: Optional[List[Dict[str, Any]]] = None,
+    max_output_tokens: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Plans every request of a run to fit the model's context window before anything is sent.
+
+    The backstory budget is window - output cap - safety margin - fixed prompt text - the
+    longest probe. Backstories over it are compacted (middle cut out, see compact_to_tokens);
+    the rest are used as is. `build_messages(backstory, probe)` gives the prompt shape.
+    Returns the (possibly compacted) content per backstory id plus the token counts that
+    estimate_run needs.
+    """
+    settings = config_manager.get_context_budget_settings()
+    max_output = int(max_output_tokens or settings["max_output_tokens"])
+    window = config_manager.get_context_window(model)
+
+    probe_tokens = {probe_id: count_tokens(content, model) for probe_id, content in probes}
+    overhead = count_message_tokens(build_messages("", ""), model)
+    budget = window - max_output - int(settings["safety_margin"]) - overhead - max(probe_tokens.values(), default=0)
+    if budget <= 0:
+        print(f"[ContextBudget Warning] Probes alone exceed {model}'s {window}-token window; backstories will be dropped from prompts.")
+        budget = 0
+
+    contents: Dict[int, str] = {}
+    backstory_tokens: Dict[int, int] = {}
+    compacted = []
+    counts = backstory_token_counts(backstories or [], model)
+    for b in backstories or []:
+        if b["id"] in contents:
+            continue
+        if counts[b["id"]] > budget:
+            contents[b["id"]] = compact_to_tokens(b["content"], budget, model)
+            backstory_tokens[b["id"]] = budget
+            compacted.append(b["id"])
+        else:
+            contents[b["id"]] = b["content"]
+            backstory_tokens[b["id"]] = counts[b["id"]]
+
+    if compacted:
+        print(f"[ContextBudget] Compacted {len(compacted)} backstories to {budget} tokens to fit {model} ({window} tokens).")
+    return {
+        "model": model,
+        "contents": contents,
+        "backstory_tokens": backstory_tokens,
+        "probe_tokens": probe_tokens,
+        "overhead": overhead,
+        "max_output_tokens": max_output,
+        "compacted": compacted
+    }
+
+def estimate_run(plan: Dict[str, Any], pairs: List[Tuple[int, Optional[int]]]) -> Dict[str, int]:
+    """
+    Prompt tokens for the given (probe_id, backstory_id) pairs and the completion-token
+    upper bound (every answer hitting the output cap).
+    """
+    prompt_tokens = sum(
+        plan["overhead"] + plan["probe_tokens"][probe_id] + plan["backstory_tokens"].get(backstory_id, 0)
+        for probe_id, backstory_id in pairs
+    )
+    return {
+        "pairs": len(pairs),
+        "prompt_tokens": prompt_tokens,
+        "max_completion_tokens": len(pairs) * plan["max_output_tokens"]
+    }
@@ -1,4 +1,4 @@
-from typing import Dict, Any
+from typing import Dict, Any, List
 import sys
 import os
 
@@ -24,18 +24,24 @@ def construct_system_prompt(demographics: Dict[str, Any], prompt_template: str =
 
     return base_prompt
 
-def run_demographic_forcing(probe_question: str, demographics: Dict[str, Any], model: str = "gpt-3.5-turbo") -> Dict[str, Any]:
+def build_messages(probe_question: str, demographics: Dict[str, Any]) -> List[Dict[str, str]]:
     """
-    Executes a probe using simple demographic forcing.
+    Builds the chat messages for a demographic forcing probe.
     """
     system_prompt = construct_system_prompt(demographics)
 
-    messages = [
+    return [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": probe_question}
     ]
 
-    print(f"[LLM CALL] System: {system_prompt}")
+def run_demographic_forcing(probe_question: str, demographics: Dict[str, Any], model: str = "gpt-3.5-turbo") -> Dict[str, Any]:
+    """
+    Executes a probe using simple demographic forcing.
+    """
+    messages = build_messages(probe_question, demographics)
+
+    print(f"[LLM CALL] System: {messages[0]['content']}")
 
     # Real LLM Call
     response_data = chat_completion(messages, model=model)
@@ -1,86 +1,419 @@
 import sys
 import os
-from typing import List, Dict, Any, Union
+import re
+import json
+from typing import List, Dict, Any, Optional, Union
+
+import numpy as np
+from sqlalchemy import bindparam, cast, func, or_, update
+from sqlalchemy.dialects.postgresql import JSONB, array
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from llm import chat_completion
+from llm import classify, imap_chat_completions, imap_classify, get_embeddings
 from database import SessionLocal, Backstory
+from modules.config_manager import config_manager
+from modules.trait_extractor import CERTAIN
+from modules.trait_probe import run_cascade
+from modules.vector_index import get_vector_index, trait_query
+
+LABEL_MODEL = "gpt-3.5-turbo"
+TRAIT_LABELS = ["Yes", "No", "Unknown"]
+
+# Characters of each backstory shown to the classifier (as in check_trait)
+LABEL_CHARS = 2000
+
+def normalize_label(value: Any) -> str:
+    """
+    Maps the many ways a model says yes/no (True, "yes.", "NO", "unknown") to Yes/No/Unknown.
+    """
+    if isinstance(value, bool):
+        return "Yes" if value else "No"
+    cleaned = str(value).strip().lower()
+    if cleaned.startswith(("yes", "true")):
+        return "Yes"
+    if cleaned.startswith(("no", "false")) and not cleaned.startswith("not sure"):
+        return "No"
+    return "Unknown"
+
+def trait_tag(probs: Dict[str, float]) -> Union[bool, str, Dict[str, float]]:
+    """
+    custom_tags value for single-token classifier probabilities: True/False when (nearly)
+    certain, otherwise a {"True": p, "False": 1 - p} distribution, keyed like str(target)
+    so Matcher.calculate_weight can weigh it. "Unknown" when that is the likeliest answer.
+    """
+    if not probs or max(probs, key=probs.get) == "Unknown":
+        return "Unknown"
+    p_yes = probs.get("Yes", 0.0) / ((probs.get("Yes", 0.0) + probs.get("No", 0.0)) or 1.0)
+    if p_yes >= CERTAIN:
+        return True
+    if p_yes <= 1 - CERTAIN:
+        return False
+    return {"True": round(p_yes, 4), "False": round(1 - p_yes, 4)}
+
+def _key(text: str) -> str:
+    return re.sub(r"[\s_\-]+", " ", str(text)).strip().lower()
 
 class DynamicLabeler:
     def __init__(self):
         pass
 
-    def check_trait(self, backstory_content: str, trait: str) -> str:
+    def _batch_messages(self, texts: List[str], traits: List[str]) -> List[Dict[str, str]]:
+        trait_list = "\n".join(f"- {json.dumps(trait)}" for trait in traits)
+        # Everything that doesn't depend on the texts lives in the system prompt (shared prefix)
+        system_prompt = (
+            "You are a zero-shot classifier. For each numbered text, decide for every trait below "
+            "whether the author explicitly or implicitly indicates it. Answer Yes, No, or Unknown.\n"
+            f"Traits:\n{trait_list}\n"
+            'Respond with a JSON object mapping each text number to an object of trait -> answer, '
+            'e.g. {"1": {"trait": "Yes"}}.'
+        )
+        body = "\n\n".join(f"Text {n + 1}:\n{text[:LABEL_CHARS]}" for n, text in enumerate(texts))
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": body}
+        ]
+
+    def parse_labels(self, content: str, n_texts: int, traits: List[str]) -> List[Dict[str, str]]:
         """
-        Uses an LLM to check if the text implies a specific trait.
-        Returns 'Yes', 'No', or 'Unknown'.
+        Robustly reads a batched answer into one {trait: Yes/No/Unknown} dict per text.
+        Accepts "1"/"Text 1"/"text_1" style keys, a bare trait object for a single text,
+        and loosely spelled trait names; anything missing is Unknown.
+        """
+        labels = [{trait: "Unknown" for trait in traits} for _ in range(n_texts)]
+        try:
+            raw = json.loads(content)
+        except (TypeError, ValueError):
+            return labels
+        if isinstance(raw, list):
+            raw = {str(n + 1): item for n, item in enumerate(raw)}
+        if not isinstance(raw, dict):
+            return labels
+
+        trait_keys = {_key(trait): trait for trait in traits}
+        if n_texts == 1 and any(_key(k) in trait_keys for k in raw):
+            raw = {"1": raw}
+
+        for key, answers in raw.items():
+            number = re.search(r"\d+", str(key))
+            if not number or not isinstance(answers, dict):
+                continue
+            n = int(number.group()) - 1
+            if not 0 <= n < n_texts:
+                continue
+            for trait_key, answer in answers.items():
+                trait = trait_keys.get(_key(trait_key))
+                if trait:
+                    labels[n][trait] = normalize_label(answer)
+        return labels
+
+    def classify_batch(
+        self,
+        contents: List[str],
+        traits: List[str],
+        pack_size: int = 1,
+        short_chars: int = 600,
+        max_concurrency: Optional[int] = None
+    ) -> List[Optional[Dict[str, str]]]:
         """
+        Classifies every trait for every backstory with one structured call per backstory
+        (instead of one call per backstory x trait). With pack_size > 1, backstories shorter
+        than `short_chars` are packed up to `pack_size` per request. Requests run concurrently.
+        Backstories whose request failed after retries get None, so they stay unlabelled.
+        """
+        packs: List[List[int]] = []
+        open_pack: List[int] = []
+        for n, content in enumerate(contents):
+            if pack_size > 1 and len(content or "") <= short_chars:
+                open_pack.append(n)
+                if len(open_pack) >= pack_size:
+                    packs.append(open_pack)
+                    open_pack = []
+            else:
+                packs.append([n])
+        if open_pack:
+            packs.append(open_pack)
+
+        labels: List[Optional[Dict[str, str]]] = [None] * len(contents)
+        requests = [self._batch_messages([contents[n] or "" for n in pack], traits) for pack in packs]
+        # Room for one short answer per (text, trait) plus JSON punctuation
+        max_tokens = 20 + 12 * len(traits) * max(len(pack) for pack in packs) if packs else 0
+
+        print(f"[Labeler] Classifying {len(traits)} traits over {len(contents)} backstories in {len(packs)} requests...")
+        for i, resp in imap_chat_completions(
+            requests,
+            model=LABEL_MODEL,
+            temperature=0.0,
+            max_tokens=max_tokens,
+            max_concurrency=max_concurrency,
+            response_format={"type": "json_object"}
+        ):
+            if resp.get("error"):
+                continue
+            for n, parsed in zip(packs[i], self.parse_labels(resp["content"], len(packs[i]), traits)):
+                labels[n] = parsed
+        return labels
+
+    def _trait_messages(self, backstory_content: str, trait: str) -> List[Dict[str, str]]:
         prompt = (
             f"Does the author of this text explicitly or implicitly indicate that they '{trait}'? "
             "Answer with exactly one word: Yes, No, or Unknown.\n\n"
-            f"Text: {backstory_content[:2000]}..."
+            f"Text: {(backstory_content or '')[:LABEL_CHARS]}..."
         )
-
-        messages = [
+        return [
             {"role": "system", "content": "You are a zero-shot classifier."},
             {"role": "user", "content": prompt}
         ]
 
-        print(f"[Labeler] Checking trait '{trait}'...")
-        response_data = chat_completion(messages, model="gpt-3.5-turbo")
-        content = response_data["content"]
-
-        # Clean response
-        cleaned = content.strip().lower()
-        if "yes" in cleaned:
-            return "Yes"
-        elif "no" in cleaned:
-            return "No"
-        return "Unknown"
-
-    def label_backstories_in_db(self, trait: str, limit: int = 100):
+    def classify_probabilities(
+        self,
+        contents: List[str],
+        traits: List[str],
+        max_concurrency: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
         """
-        Scans backstories in DB and updates them with the trait tag.
+        One single-token logprob call per (backstory, trait), run concurrently.
+        Returns a {trait: trait_tag(probs)} dict per backstory; traits whose call failed
+        after retries are left out, so they stay unlabelled.
         """
-        db = SessionLocal()
-        try:
-            # Get backstories that don't have this tag yet
-            # JSONB query is a bit complex in pure ORM, so fetching all for now or raw SQL
-            # For simplicity: Fetch all, check if tag exists in custom_tags
-            backstories = db.query(Backstory).all()
-
-            updates = 0
-            for bs in backstories:
-                current_tags = bs.custom_tags or {}
-                if trait in current_tags:
+        tags: List[Dict[str, Any]] = [{} for _ in contents]
+        for trait in traits:
+            for n, resp in imap_classify(
+                [self._trait_messages(content, trait) for content in contents],
+                TRAIT_LABELS,
+                model=LABEL_MODEL,
+                max_concurrency=max_concurrency
+            ):
+                if resp.get("error"):
                     continue
+                tags[n][trait] = trait_tag(resp["probs"])
+        return tags
 
-                result = self.check_trait(bs.content, trait)
+    def _tag_updates(self, backstory_ids: List[int], labels: List[Optional[Dict[str, str]]]) -> List[Dict[str, Any]]:
+        """
+        Yes/No become True/False; Unknown is recorded too, so the row isn't re-queried next pass.
+        Already-converted values (distributions from classify_probabilities) pass through.
+        Rows without labels (failed requests) are skipped, so the next pass retries them.
+        """
+        values = {"Yes": True, "No": False, "Unknown": "Unknown"}
+        return [
+            {
+                "b_id": backstory_id,
+                "tags": {trait: values.get(result, result) if isinstance(result, str) else result for trait, result in label.items()}
+            }
+            for backstory_id, label in zip(backstory_ids, labels)
+            if label
+        ]
 
-                if result == "Yes":
-                    current_tags[trait] = True
-                    updates += 1
-                elif result == "No":
-                    current_tags[trait] = False
-                    updates += 1
-                else:
-                    # Mark as unknown/checked so we don't re-check?
-                    # For now just leaving it absent implies unknown
-                    pass
+    def _missing(self, traits: List[str]):
+        """
+        Rows that lack any of `traits` in custom_tags (JSONB ? / ?&, GIN-indexable).
+        """
+        if len(traits) == 1:
+            labelled = Backstory.custom_tags.has_key(traits[0])
+        else:
+            labelled = Backstory.custom_tags.has_all(array(traits))
+        return or_(Backstory.custom_tags.is_(None), ~labelled)
 
-                # SQLAlchemy requires flagging modified for JSONB mutations sometimes
-                bs.custom_tags = dict(current_tags)
+    def save_labels(self, db, backstory_ids: List[int], labels: List[Optional[Dict[str, str]]]) -> int:
+        """
+        Merges the labels into custom_tags server-side, one executemany UPDATE. Caller commits.
+        Returns the number of backstories updated.
+        """
+        table = Backstory.__table__
+        merge_tags = (
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(custom_tags=func.coalesce(table.c.custom_tags, cast({}, JSONB)).op("||")(bindparam("tags", type_=JSONB)))
+        )
+        updates = self._tag_updates(backstory_ids, labels)
+        if updates:
+            db.execute(merge_tags, updates)
+        return len(updates)
 
-            db.commit()
-            print(f"[Labeler] Updated {updates} backstories with trait '{trait}'.")
+    def label_traits_in_db(
+        self,
+        traits: List[str],
+        limit: Optional[int] = None,
+        batch_size: int = 200,
+        pack_size: int = 4,
+        candidate_ids: Optional[List[int]] = None,
+        probabilities: bool = False
+    ) -> int:
+        """
+        Streams backstories that lack any of `traits` (JSONB ?/?& in the database, keyset
+        pagination by id), classifies each bounded batch concurrently and commits it before
+        fetching the next, so a failure only loses the batch in flight and memory stays flat.
+        Only the traits a row is missing are asked for and merged, so labels already stored
+        (including distributions) are never overwritten. Tags are merged into custom_tags
+        server-side. Returns the number of backstories labelled.
+        With `probabilities`, labels come from single-token logprob calls (classify_probabilities)
+        and uncertain answers are stored as distributions instead of being rounded to Yes/No.
+        """
+        missing = self._missing(traits)
+        db = SessionLocal()
+        processed = 0
+        labelled = 0
+        last_id = 0
+        try:
+            while limit is None or processed < limit:
+                size = batch_size if limit is None else min(batch_size, limit - processed)
+                query = db.query(Backstory.id, Backstory.content, Backstory.custom_tags).filter(missing, Backstory.id > last_id)
+                if candidate_ids is not None:
+                    query = query.filter(Backstory.id.in_(candidate_ids))
+                rows = query.order_by(Backstory.id).limit(size).all()
+                # Don't hold the read transaction open across the LLM calls
+                db.commit()
+                if not rows:
+                    break
+                last_id = rows[-1].id
 
+                # Rows are grouped by which of the traits they still lack
+                groups: Dict[tuple, List[int]] = {}
+                for n, row in enumerate(rows):
+                    lacking = tuple(trait for trait in traits if trait not in (row.custom_tags or {}))
+                    groups.setdefault(lacking, []).append(n)
+                labels: List[Optional[Dict[str, Any]]] = [None] * len(rows)
+                for lacking, members in groups.items():
+                    contents = [rows[n].content for n in members]
+                    if probabilities:
+                        group_labels = self.classify_probabilities(contents, list(lacking))
+                    else:
+                        group_labels = self.classify_batch(contents, list(lacking), pack_size=pack_size)
+                    for n, label in zip(members, group_labels):
+                        labels[n] = label
+                labelled += self.save_labels(db, [row.id for row in rows], labels)
+                db.commit()
+                processed += len(rows)
+                print(f"[Labeler] Labelled {labelled}/{processed} backstories for {traits} (up to id {last_id}).")
         except Exception as e:
             print(f"[Labeler Error] {e}")
             db.rollback()
         finally:
             db.close()
 
+        return labelled
+
+    def cascade_label_in_db(self, trait: str, settings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Labels a trait across the pool with an embedding classifier in front of the LLM
+        (see trait_probe.run_cascade): the LLM labels a seed sample and whatever the
+        classifier is unsure about, the classifier labels the rest. Backstories without an
+        embedding go through the regular streaming path. Each LLM round's answers are
+        committed as they arrive, and no session is held open across LLM calls. Returns the
+        cascade stats plus the number of backstories labelled.
+        """
+        settings = settings or config_manager.get_label_cascade_settings()
+        index = get_vector_index()
+        write_batch_size = int(settings["write_batch_size"])
+
+        db = SessionLocal()
+        try:
+            pending = np.array(
+                [backstory_id for (backstory_id,) in db.query(Backstory.id).filter(self._missing([trait])).order_by(Backstory.id).all()],
+                dtype=np.int64
+            )
+        finally:
+            db.close()
+
+        # Index ids are ascending (loaded in id order), so membership is a binary search
+        positions = np.minimum(np.searchsorted(index.ids, pending), max(len(index) - 1, 0))
+        embedded = (index.ids[positions] == pending) if len(index) else np.zeros(len(pending), dtype=bool)
+        ids, rows = pending[embedded], positions[embedded]
+        saved = set()
+        labelled = 0
+
+        def write(chunk: List[tuple]) -> int:
+            # Short session per write, so no transaction is open while the LLM is called
+            db = SessionLocal()
+            try:
+                count = self.save_labels(db, [backstory_id for backstory_id, _ in chunk], [{trait: label} for _, label in chunk])
+                db.commit()
+                return count
+            except Exception as e:
+                print(f"[Labeler Error] Cascade write failed: {e}")
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+        def ask_llm(selected: np.ndarray) -> List[Optional[str]]:
+            nonlocal labelled
+            wanted = [int(backstory_id) for backstory_id in ids[selected]]
+            db = SessionLocal()
+            try:
+                contents = dict(db.query(Backstory.id, Backstory.content).filter(Backstory.id.in_(wanted)).all())
+            finally:
+                db.close()
+            labels = self.classify_batch([contents.get(backstory_id) or "" for backstory_id in wanted], [trait], pack_size=4)
+            # None (request failed) leaves the row unlabelled for the next pass
+            answers = [label[trait] if label else None for label in labels]
+            # Paid answers are committed as soon as they arrive, so a later failure doesn't lose them
+            answered = [(position, backstory_id, answer) for position, backstory_id, answer in zip(selected, wanted, answers) if answer is not None]
+            if answered:
+                labelled += write([(backstory_id, answer) for _, backstory_id, answer in answered])
+                saved.update(int(position) for position, _, _ in answered)
+            return answers
+
+        if not len(ids):
+            stats = {"labels": [], "llm_calls": 0, "llm_share": 0.0, "agreement": None}
+        else:
+            query = trait_query(trait)
+            query_vector = np.asarray(get_embeddings(["A person who " + query])[0], dtype=np.float32) if query else None
+            stats = run_cascade(index.vectors, ask_llm, settings, query=query_vector, rows=rows)
+
+            # Only the classifier's labels are left to write; LLM answers were saved per round
+            done = [
+                (int(ids[position]), label) for position, label in enumerate(stats["labels"])
+                if label is not None and position not in saved
+            ]
+            for start in range(0, len(done), write_batch_size):
+                labelled += write(done[start:start + write_batch_size])
+
+        agreement = "n/a" if stats["agreement"] is None else f"{stats['agreement']:.1%}"
+        print(
+            f"[Labeler] Cascade for '{trait}': {stats['llm_calls']}/{len(ids)} embedded backstories sent to the LLM "
+            f"({stats['llm_share']:.1%}), classifier agreement on audit {agreement}, "
+            f"{sum(label is None for label in stats['labels'])} left for the next pass."
+        )
+
+        unembedded = [int(backstory_id) for backstory_id in pending[~embedded]]
+        if unembedded:
+            labelled += self.label_traits_in_db([trait], candidate_ids=unembedded)
+        stats = {key: value for key, value in stats.items() if key != "labels"}
+        return {**stats, "labelled": labelled}
+
+    def check_trait(self, backstory_content: str, trait: str) -> str:
+        """
+        Uses an LLM to check if the text implies a specific trait.
+        Returns 'Yes', 'No', or 'Unknown' (the likeliest of the three by logprobs).
+        """
+        print(f"[Labeler] Checking trait '{trait}'...")
+        resp = classify(self._trait_messages(backstory_content, trait), TRAIT_LABELS, model=LABEL_MODEL)
+        return resp["label"] or "Unknown"
+
+    def label_backstories_in_db(
+        self,
+        trait: str,
+        limit: Optional[int] = None,
+        semantic_shortlist: Optional[int] = None,
+        cascade: bool = False,
+        probabilities: bool = False
+    ) -> int:
+        """
+        Labels every backstory that doesn't have the trait yet (streaming; see label_traits_in_db).
+        With `semantic_shortlist`, only the N backstories closest to the trait by embedding
+        similarity are considered, for a quick first pass over a large pool.
+        With `cascade`, an embedding classifier labels the clear-cut rows (see cascade_label_in_db).
+        With `probabilities`, uncertain labels are stored as distributions (see trait_tag).
+        """
+        if cascade:
+            return self.cascade_label_in_db(trait)["labelled"]
+        candidate_ids = None
+        if semantic_shortlist:
+            candidate_ids = get_vector_index().shortlist({trait: True}, semantic_shortlist)
+        return self.label_traits_in_db([trait], limit=limit, candidate_ids=candidate_ids, probabilities=probabilities)
+
 # Singleton
 labeler = DynamicLabeler()
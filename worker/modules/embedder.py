@@ -0,0 +1,60 @@
+import sys
+import os
+from typing import List, Optional
+
+from sqlalchemy import text
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import get_embeddings
+from database import SessionLocal, Backstory
+from modules.config_manager import config_manager
+
+# pgvector accepts its text form through a cast, so no client-side vector type is needed
+UPDATE_EMBEDDING = text("UPDATE backstories SET embedding = CAST(:embedding AS vector) WHERE id = :id")
+
+def to_pgvector(vector: List[float]) -> str:
+    return "[" + ",".join(f"{x:.7g}" for x in vector) + "]"
+
+def embed_backstories(batch_size: Optional[int] = None, limit: Optional[int] = None, max_chars: int = 8000) -> int:
+    """
+    Fills backstories.embedding for every row that doesn't have one yet.
+    Walks the table by id in batches; each batch is one embeddings request and one
+    executemany UPDATE, committed before moving on (so the job can be re-run after a crash).
+    Returns the number of backstories embedded.
+    """
+    batch_size = batch_size or int(config_manager.get_embedding_settings()["batch_size"])
+
+    db = SessionLocal()
+    embedded = 0
+    last_id = 0
+    try:
+        while limit is None or embedded < limit:
+            size = batch_size if limit is None else min(batch_size, limit - embedded)
+            rows = (
+                db.query(Backstory.id, Backstory.content)
+                .filter(text("embedding IS NULL"), Backstory.id > last_id)
+                .order_by(Backstory.id)
+                .limit(size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            vectors = get_embeddings([(row.content or "")[:max_chars] for row in rows], batch_size=len(rows))
+            db.execute(UPDATE_EMBEDDING, [
+                {"id": row.id, "embedding": to_pgvector(vector)}
+                for row, vector in zip(rows, vectors)
+            ])
+            db.commit()
+            embedded += len(rows)
+            print(f"[Embedder] Embedded {embedded} backstories (up to id {last_id}).")
+    except Exception as e:
+        print(f"[Embedder Error] {e}")
+        db.rollback()
+    finally:
+        db.close()
+
+    return embedded
@@ -1,14 +1,200 @@
 import sys
 import os
-from typing import List, Dict, Any, Tuple
+import json
+from typing import List, Dict, Any, Optional, Tuple, Union
 import numpy as np
-from scipy.optimize import linear_sum_assignment
+from scipy import sparse
+from scipy.optimize import linear_sum_assignment, linprog
+from scipy.sparse.csgraph import maximum_flow, min_weight_full_bipartite_matching
+from sqlalchemy import and_, or_, cast
+from sqlalchemy.dialects.postgresql import JSONPATH
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from database import SessionLocal, Backstory
 
+# Probability used when a deterministic trait doesn't match (soft matching)
+SOFT_MATCH_PROB = 0.01
+# Weight given to candidates without any demographics
+NO_DEMOGRAPHICS_WEIGHT = 0.001
+# Stands in for log(0) so impossible pairs stay finite for the assignment solver
+PROB_FLOOR = 1e-12
+# Target keys that are not demographic traits (free-text ones go to semantic retrieval,
+# then are scored against the labeller's custom_tags, see target_traits)
+METADATA_KEYS = ("id", "custom_tags", "custom_trait")
+# Largest targets x candidates problem solved with the dense Hungarian matrix
+DENSE_MATCH_LIMIT = 5_000_000
+# Largest expanded (target x candidate seat) edge count solved as a sparse assignment;
+# beyond it (a few huge profiles) the profile-level transportation LP is used instead
+ASSIGNMENT_EDGE_LIMIT = 20_000_000
+
+def free_text_traits(constraints: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    A config's free-text traits as {trait: wanted value}: the run page saves one as a
+    `custom_trait` string (wanted True), API configs may carry several as a `custom_tags` dict.
+    """
+    custom_tags = constraints.get("custom_tags")
+    traits = dict(custom_tags) if isinstance(custom_tags, dict) else {}
+    custom_trait = constraints.get("custom_trait")
+    if isinstance(custom_trait, str) and custom_trait.strip():
+        traits[custom_trait.strip()] = True
+    return traits
+
+def target_traits(target: Dict[str, Any]) -> List[Tuple[Tuple[str, str], Any]]:
+    """
+    ((namespace, trait), wanted value) pairs a target is scored on: its demographic keys
+    against candidates' demographics, its `custom_tags` against candidates' custom_tags
+    (where the labeller stores Yes/No as True/False or a {"True": p, "False": 1 - p} distribution).
+    """
+    traits = [(("demographics", k), v) for k, v in target.items() if k not in METADATA_KEYS]
+    traits += [(("custom_tags", k), v) for k, v in (target.get("custom_tags") or {}).items()]
+    return traits
+
+class TraitTable:
+    """
+    Integer-coded view of one demographic trait across a list of candidates.
+
+    Deterministic values are coded by their lowercased string (matching is
+    case-insensitive; a missing trait reads as "none", like str(None) does in
+    calculate_weight); distribution values ({value: prob}) are stored as COO
+    triplets keyed by the exact value string. Rows can be re-encoded in place,
+    so long-lived indexes can apply incremental updates.
+    """
+
+    def __init__(self, values: Optional[List[Any]] = None):
+        self.lower_vocab: Dict[str, int] = {}
+        self.exact_vocab: Dict[str, int] = {}
+        self.det_codes = np.empty(0, dtype=np.int32)
+        self.dist_rows = np.empty(0, dtype=np.int64)
+        self.dist_codes = np.empty(0, dtype=np.int64)
+        self.dist_probs = np.empty(0, dtype=np.float64)
+        if values:
+            self.set_rows(np.arange(len(values)), values)
+
+    def __len__(self) -> int:
+        return len(self.det_codes)
+
+    def pad(self, n_rows: int):
+        """
+        Grows the table to `n_rows`; new rows read as a missing trait.
+        """
+        if n_rows > len(self.det_codes):
+            missing = self.lower_vocab.setdefault("none", len(self.lower_vocab))
+            self.det_codes = np.concatenate([
+                self.det_codes,
+                np.full(n_rows - len(self.det_codes), missing, dtype=np.int32)
+            ])
+
+    def set_rows(self, rows: np.ndarray, values: List[Any]):
+        """
+        (Re)encodes `values` at row positions `rows`, growing the table if needed.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if not rows.size:
+            return
+        self.pad(int(rows.max()) + 1)
+        if not self.det_codes.flags.writeable:
+            # Memory-mapped snapshot: copy on first write
+            self.det_codes = np.array(self.det_codes)
+
+        dist_rows, dist_codes, dist_probs = [], [], []
+        for row, value in zip(rows, values):
+            if isinstance(value, dict):
+                self.det_codes[row] = -1
+                for key, prob in value.items():
+                    dist_rows.append(row)
+                    dist_codes.append(self.exact_vocab.setdefault(str(key), len(self.exact_vocab)))
+                    dist_probs.append(float(prob))
+            else:
+                self.det_codes[row] = self.lower_vocab.setdefault(str(value).lower(), len(self.lower_vocab))
+
+        # Drop stale distribution entries of re-encoded rows, then append the new ones
+        keep = ~np.isin(self.dist_rows, rows) if self.dist_rows.size else slice(None)
+        self.dist_rows = np.concatenate([self.dist_rows[keep], np.asarray(dist_rows, dtype=np.int64)])
+        self.dist_codes = np.concatenate([self.dist_codes[keep], np.asarray(dist_codes, dtype=np.int64)])
+        self.dist_probs = np.concatenate([self.dist_probs[keep], np.asarray(dist_probs, dtype=np.float64)])
+
+    def take_rows(self, keep: np.ndarray) -> "TraitTable":
+        """
+        New table with only the rows where `keep` (bool, one per row) is set, renumbered in order.
+        """
+        keep = np.asarray(keep, dtype=bool)
+        new_row = np.cumsum(keep) - 1
+        table = TraitTable()
+        table.lower_vocab = dict(self.lower_vocab)
+        table.exact_vocab = dict(self.exact_vocab)
+        table.det_codes = np.array(self.det_codes[keep])
+        kept = keep[self.dist_rows]
+        table.dist_rows = new_row[self.dist_rows[kept]]
+        table.dist_codes = np.array(self.dist_codes[kept])
+        table.dist_probs = np.array(self.dist_probs[kept])
+        return table
+
+    def log_prob_table(self, target_values: List[str]) -> np.ndarray:
+        """
+        Returns log P(candidate trait = value) with shape (n_candidates, len(target_values)).
+        `target_values` must be distinct strings.
+        """
+        lower_codes = np.array([self.lower_vocab.get(v.lower(), -2) for v in target_values], dtype=np.int32)
+        probs = np.where(self.det_codes[:, None] == lower_codes[None, :], 1.0, SOFT_MATCH_PROB)
+
+        if self.dist_rows.size:
+            probs[self.det_codes == -1] = 0.0
+            code_to_col = np.full(len(self.exact_vocab), -1, dtype=np.int64)
+            for col, value in enumerate(target_values):
+                code = self.exact_vocab.get(value)
+                if code is not None:
+                    code_to_col[code] = col
+            cols = code_to_col[self.dist_codes]
+            keep = cols >= 0
+            probs[self.dist_rows[keep], cols[keep]] = self.dist_probs[keep]
+
+        return np.log(np.maximum(probs, PROB_FLOOR))
+
+class EncodedCandidates:
+    """
+    Candidates' demographics and custom tags encoded into per-trait TraitTables.
+    Built from candidate dicts (tables encoded on demand) or from an index's
+    precomputed tables (see modules/backstory_index.py).
+    """
+
+    def __init__(self, candidates: Optional[List[Dict[str, Any]]] = None):
+        self._values = {
+            namespace: [c.get(namespace) or {} for c in candidates or []]
+            for namespace in ("demographics", "custom_tags")
+        }
+        self.has_demographics = np.array([bool(d) for d in self._values["demographics"]], dtype=bool)
+        self._tables: Dict[Tuple[str, str], TraitTable] = {}
+
+    @classmethod
+    def from_tables(
+        cls,
+        has_demographics: np.ndarray,
+        tables: Dict[str, TraitTable],
+        custom_tags: Optional[Dict[str, TraitTable]] = None
+    ) -> "EncodedCandidates":
+        encoded = cls()
+        encoded.has_demographics = has_demographics
+        encoded._tables = {("demographics", trait): table for trait, table in tables.items()}
+        encoded._tables.update({("custom_tags", trait): table for trait, table in (custom_tags or {}).items()})
+        return encoded
+
+    def __len__(self) -> int:
+        return len(self.has_demographics)
+
+    def table(self, trait: str, namespace: str = "demographics") -> TraitTable:
+        key = (namespace, trait)
+        if key not in self._tables:
+            if self._values["demographics"]:
+                self._tables[key] = TraitTable([d.get(trait) for d in self._values[namespace]])
+            else:
+                # Precomputed tables: a trait nobody carries reads as missing everywhere
+                missing = TraitTable()
+                missing.pad(len(self))
+                self._tables[key] = missing
+        return self._tables[key]
+
 class Matcher:
     def __init__(self):
         pass
@@ -17,20 +203,18 @@ class Matcher:
         """
         Calculates the weight (probability product) of matching a target to a candidate.
         Equation 1 from Alterity paper: Product P(d_jl = t_il)
+        Reference implementation for a single pair; see compute_log_weights for the batched form.
         """
         weight = 1.0
         candidate_demographics = candidate.get("demographics", {})
 
         # If candidate has no demographics, improved fallback or just 0
         if not candidate_demographics:
-            return 0.001
+            return NO_DEMOGRAPHICS_WEIGHT
 
-        for trait_key, target_value in target.items():
-            # Skip metadata keys
-            if trait_key in ["id", "custom_tags"]:
-                continue
-
-            cand_trait_data = candidate_demographics.get(trait_key)
+        # Demographic keys, plus the target's custom_tags against the candidate's (see target_traits)
+        for (namespace, trait_key), target_value in target_traits(target):
+            cand_trait_data = (candidate.get(namespace) or {}).get(trait_key)
             prob = 0.0
 
             # Handle Distribution (Dictionary)
@@ -42,35 +226,89 @@ class Matcher:
                 if str(cand_trait_data).lower() == str(target_value).lower():
                     prob = 1.0
                 else:
-                    prob = 0.01 # Small epsilon for soft matching
+                    prob = SOFT_MATCH_PROB # Small epsilon for soft matching
 
             weight *= prob
 
         return weight
 
-    def perform_matching(self, targets: List[Dict[str, Any]], candidates: List[Dict[str, Any]]) -> List[Tuple[Dict, Dict]]:
+    def compute_log_weights(self, targets: List[Dict[str, Any]], candidates: Union[List[Dict[str, Any]], EncodedCandidates]) -> np.ndarray:
+        """
+        Log of calculate_weight for every (target, candidate) pair, shape (n_targets, n_candidates).
+        Each trait is encoded once into integer codes and a per-trait probability table over the
+        distinct target values; the matrix is then a sum of gathered log-probabilities, so the
+        product of many small probabilities can't underflow to zero.
+        """
+        encoded = candidates if isinstance(candidates, EncodedCandidates) else EncodedCandidates(candidates)
+        log_weights = self._gather_log_weights(self._target_tables(targets, encoded), np.arange(len(targets)), encoded)
+        return log_weights.astype(np.float64)
+
+    def _target_tables(
+        self,
+        targets: List[Dict[str, Any]],
+        encoded: EncodedCandidates
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Per trait: (which targets have it, each target's distinct-value index, log-prob table
+        of shape (n_distinct, n_candidates)). Built once, so row blocks only gather from it.
+        """
+        wanted = [dict(target_traits(target)) for target in targets]
+        traits = []
+        for target in wanted:
+            for key in target:
+                if key not in traits:
+                    traits.append(key)
+
+        tables = []
+        for key in traits:
+            has_trait = np.array([key in t for t in wanted], dtype=bool)
+            values = [str(t[key]) for t in wanted if key in t]
+            distinct, inverse = np.unique(np.array(values, dtype=object), return_inverse=True)
+            value_index = np.zeros(len(targets), dtype=np.int64)
+            value_index[has_trait] = inverse.ravel()
+
+            namespace, trait = key
+            table = encoded.table(trait, namespace).log_prob_table(list(distinct)) # (n_candidates, n_distinct)
+            # float32 halves the memory traffic of the per-block gathers; log weights are small
+            tables.append((has_trait, value_index, np.ascontiguousarray(table.T, dtype=np.float32)))
+        return tables
+
+    def _gather_log_weights(
+        self,
+        tables: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+        rows: np.ndarray,
+        encoded: EncodedCandidates
+    ) -> np.ndarray:
+        """
+        float32 log weights for the target `rows`, shape (len(rows), n_candidates), from _target_tables.
+        """
+        log_weights = np.zeros((len(rows), len(encoded)), dtype=np.float32)
+        # Row by row, in place: no block-sized temporaries, and each row stays in cache
+        for out, row in zip(log_weights, rows):
+            for has_trait, value_index, table in tables:
+                if has_trait[row]:
+                    np.add(out, table[value_index[row]], out=out)
+        log_weights[:, ~encoded.has_demographics] = np.log(NO_DEMOGRAPHICS_WEIGHT)
+        return log_weights
+
+    def perform_matching(
+        self,
+        targets: List[Dict[str, Any]],
+        candidates: List[Dict[str, Any]],
+        encoded: Optional[EncodedCandidates] = None
+    ) -> List[Tuple[Dict, Dict]]:
         """
         Uses Hungarian Algorithm (Maximum Weight Matching) to find optimal assignment.
-        Since linear_sum_assignment finds minimum cost, we use Cost = -Weight.
+        Since linear_sum_assignment finds minimum cost, we use Cost = -log(Weight),
+        i.e. the assignment maximizes the product of pair weights.
         """
         if not targets or not candidates:
             return []
 
         # Cost matrix: Rows = Targets, Cols = Candidates
-        # We need a square matrix for standard assignment or rectangular is fine for scipy?
         # Scipy handles rectangular: "The method used is the Hungarian algorithm, also known as the Munkres algorithm."
         # It assigns min(n, m) elements.
-
-        n_targets = len(targets)
-        n_candidates = len(candidates)
-
-        # Initialize with high cost (effectively 0 weight)
-        cost_matrix = np.zeros((n_targets, n_candidates))
-
-        for i, target in enumerate(targets):
-            for j, candidate in enumerate(candidates):
-                w = self.calculate_weight(target, candidate)
-                cost_matrix[i, j] = -w  # Negate for maximization
+        cost_matrix = -self.compute_log_weights(targets, encoded if encoded is not None else candidates)
 
         row_ind, col_ind = linear_sum_assignment(cost_matrix)
 
@@ -82,32 +320,481 @@ class Matcher:
 
         return matches
 
-    def match_against_db(self, targets: List[Dict[str, Any]]) -> List[Tuple[Dict, Dict]]:
+    def sample_population(self, constraints: Dict[str, Any], size: int, seed: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Samples `size` target individuals from a demographic config.
+        Distribution-valued constraints ({value: prob}) are sampled independently per trait;
+        scalar constraints are copied to every individual, and so are the free-text traits
+        (as a `custom_tags` dict, see free_text_traits).
+        """
+        rng = np.random.default_rng(seed)
+        custom_tags = free_text_traits(constraints)
+        population = [{"id": i, "custom_tags": dict(custom_tags)} if custom_tags else {"id": i} for i in range(size)]
+        for trait, value in constraints.items():
+            if trait in METADATA_KEYS:
+                continue
+            if isinstance(value, dict) and value:
+                options = list(value.keys())
+                probs = np.asarray([float(p) for p in value.values()])
+                draws = rng.choice(len(options), size=size, p=probs / probs.sum())
+                for individual, draw in zip(population, draws):
+                    individual[trait] = options[draw]
+            else:
+                for individual in population:
+                    individual[trait] = value
+        return population
+
+    def match_population(
+        self,
+        targets: List[Dict[str, Any]],
+        candidates: List[Dict[str, Any]],
+        capacity: int = 1,
+        top_k: int = 50,
+        block_size: int = 2_000_000,
+        max_rounds: int = 4,
+        encoded: Optional[EncodedCandidates] = None
+    ) -> List[Tuple[Dict, Dict]]:
+        """
+        Capacitated matching for large populations, as a min-cost flow over a sparse graph.
+
+        Targets with identical traits are collapsed into profiles (supply = count). Each
+        profile keeps only its top-K candidate edges (plus enough extra to seat all its
+        members), computed block by block so the dense targets x candidates matrix is never
+        built. Every candidate can absorb up to `capacity` targets. A max-flow check (cheap,
+        no costs) finds profiles the edge set can't fully seat; those get a wider edge set,
+        up to `max_rounds` times. The min-cost problem is then solved once, exactly: as a
+        sparse assignment over (target, candidate seat) edges, or as a transportation LP with
+        HiGHS when that expansion would be too large. Leaving a target unmatched costs more
+        than any reshuffle of the others, so everyone the edges can seat is seated.
+        `encoded` may carry precomputed tables aligned with `candidates` (e.g. from the index).
+        """
+        if not targets or not candidates:
+            return []
+
+        capacity = max(1, capacity)
+        if encoded is None:
+            encoded = EncodedCandidates(candidates)
+        n_candidates = len(encoded)
+
+        # 1. Collapse targets into profiles
+        profile_members: Dict[Tuple, List[int]] = {}
+        for i, target in enumerate(targets):
+            key = tuple(sorted((k, str(v)) for k, v in target_traits(target)))
+            profile_members.setdefault(key, []).append(i)
+        profiles = list(profile_members.values())
+        supplies = np.array([len(members) for members in profiles])
+
+        # 2. Top-K edges per profile, widened for profiles the edges can't fully seat
+        n_profiles = len(profiles)
+        ks = np.minimum(n_candidates, top_k + -(-supplies // capacity))
+        edges: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        stale = list(range(n_profiles))
+        for _ in range(max_rounds):
+            edges.update(self._profile_edges(targets, profiles, stale, ks, encoded, block_size))
+            edge_profile, edge_candidate, edge_cost = self._edge_arrays(edges, n_profiles)
+            short = self._short_profiles(edge_profile, edge_candidate, supplies, capacity)
+            stale = [p for p in np.flatnonzero(short) if ks[p] < n_candidates]
+            if not stale:
+                break
+            ks[stale] = np.minimum(n_candidates, ks[stale] * 4)
+
+        # 3. One exact min-cost solve
+        if int(np.sum(supplies[edge_profile])) * capacity <= ASSIGNMENT_EDGE_LIMIT:
+            flows, unmatched_per_profile = self._solve_assignment(edge_profile, edge_candidate, edge_cost, supplies, capacity)
+        else:
+            flows, unmatched_per_profile = self._solve_transport(edge_profile, edge_candidate, edge_cost, supplies, capacity)
+
+        # 4. Expand profile-level flows back to individual targets
+        next_member = [0] * n_profiles
+        matches = []
+        for e in np.flatnonzero(flows):
+            p = edge_profile[e]
+            members = profiles[p]
+            for _ in range(flows[e]):
+                matches.append((targets[members[next_member[p]]], candidates[edge_candidate[e]]))
+                next_member[p] += 1
+
+        unmatched = len(targets) - len(matches)
+        if unmatched:
+            print(f"[Matcher] {unmatched} targets left unmatched (pool capacity exhausted).")
+        return matches
+
+    def _profile_edges(
+        self,
+        targets: List[Dict[str, Any]],
+        profiles: List[List[int]],
+        profile_ids: List[int],
+        ks: np.ndarray,
+        encoded: EncodedCandidates,
+        block_size: int
+    ) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
         """
-        Fetches all backstories from DB and matches against targets.
+        Top-k (candidate index, cost) edges for the given profiles, computed in row blocks
+        of at most `block_size` weights. The per-trait tables are built once for all the
+        profiles; each block only gathers its rows from them.
+        """
+        n_candidates = len(encoded)
+        rows_per_block = max(1, block_size // n_candidates)
+        tables = self._target_tables([targets[profiles[p][0]] for p in profile_ids], encoded)
+        edges = {}
+        for start in range(0, len(profile_ids), rows_per_block):
+            block = profile_ids[start:start + rows_per_block]
+            log_weights = self._gather_log_weights(tables, np.arange(start, start + len(block)), encoded)
+            for row, p in zip(log_weights, block):
+                k = int(ks[p])
+                # Copy: a slice would keep the whole n_candidates argpartition array alive
+                top = np.argpartition(-row, k - 1)[:k].copy() if k < n_candidates else np.arange(n_candidates)
+                edges[p] = (top, -row[top])
+        return edges
+
+    def _edge_arrays(
+        self,
+        edges: Dict[int, Tuple[np.ndarray, np.ndarray]],
+        n_profiles: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Flattens per-profile edges into (edge_profile, edge_candidate, edge_cost).
+        """
+        edge_profile = np.concatenate([np.full(len(edges[p][0]), p) for p in range(n_profiles)])
+        edge_candidate = np.concatenate([edges[p][0] for p in range(n_profiles)])
+        edge_cost = np.concatenate([edges[p][1] for p in range(n_profiles)]).astype(np.float64)
+        return edge_profile, edge_candidate, edge_cost
+
+    def _short_profiles(
+        self,
+        edge_profile: np.ndarray,
+        edge_candidate: np.ndarray,
+        supplies: np.ndarray,
+        capacity: int
+    ) -> np.ndarray:
+        """
+        Max flow source -> profile (supply) -> candidate (capacity) -> sink, ignoring costs.
+        Returns a mask of profiles the edge set can't fully seat in that flow.
+        """
+        n_profiles = len(supplies)
+        used_candidates, candidate_node = np.unique(edge_candidate, return_inverse=True)
+        n_used = len(used_candidates)
+        source, sink = n_profiles + n_used, n_profiles + n_used + 1
+        graph = sparse.csr_matrix(
+            (
+                np.concatenate([supplies, np.minimum(supplies[edge_profile], capacity), np.full(n_used, capacity)]).astype(np.int32),
+                (
+                    np.concatenate([np.full(n_profiles, source), edge_profile, n_profiles + np.arange(n_used)]),
+                    np.concatenate([np.arange(n_profiles), n_profiles + candidate_node, np.full(n_used, sink)])
+                )
+            ),
+            shape=(sink + 1, sink + 1)
+        )
+        result = maximum_flow(graph, source, sink)
+        if result.flow_value == supplies.sum():
+            return np.zeros(n_profiles, dtype=bool)
+        seated = np.asarray(result.flow.tocsr()[source].todense()).ravel()[:n_profiles]
+        return seated < supplies
+
+    def _unmatched_cost(self, edge_cost: np.ndarray, n_profiles: int) -> float:
+        """
+        Price of leaving one target unmatched: above the cost change of any augmenting path
+        (at most one target per profile on it), so seating someone always wins.
+        """
+        spread = float(edge_cost.max() - edge_cost.min()) + 1.0 if len(edge_cost) else 1.0
+        return spread * (n_profiles + 1)
+
+    def _solve_assignment(
+        self,
+        edge_profile: np.ndarray,
+        edge_candidate: np.ndarray,
+        edge_cost: np.ndarray,
+        supplies: np.ndarray,
+        capacity: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Min-cost matching with one row per target and one column per candidate seat, solved
+        with scipy's sparse LAPJV. Members of a profile share its edges; every row also gets a
+        private "unmatched" column, so a full matching always exists.
+        Returns (integer flow per edge, unmatched per profile).
+        """
+        n_profiles, n_edges = len(supplies), len(edge_cost)
+        used_candidates, candidate_col = np.unique(edge_candidate, return_inverse=True)
+        n_seats = len(used_candidates) * capacity
+
+        # Per edge: its seat columns; per profile: its edges repeated for every member
+        seat_cols = (candidate_col[:, None] * capacity + np.arange(capacity)).ravel()
+        seat_edges = np.repeat(np.arange(n_edges), capacity)
+        order = np.argsort(edge_profile[seat_edges], kind="stable")
+        seat_cols, seat_edges = seat_cols[order], seat_edges[order]
+        bounds = np.searchsorted(edge_profile[seat_edges], np.arange(n_profiles + 1))
+
+        rows, cols, entry_edges, row_profile = [], [], [], np.repeat(np.arange(n_profiles), supplies)
+        first_row = np.concatenate([[0], np.cumsum(supplies)])
+        for p in range(n_profiles):
+            span = slice(bounds[p], bounds[p + 1])
+            rows.append(np.repeat(np.arange(first_row[p], first_row[p + 1]), span.stop - span.start))
+            cols.append(np.tile(seat_cols[span], supplies[p]))
+            entry_edges.append(np.tile(seat_edges[span], supplies[p]))
+        n_rows = int(first_row[-1])
+        rows = np.concatenate(rows + [np.arange(n_rows)])
+        cols = np.concatenate(cols + [n_seats + np.arange(n_rows)])
+        entry_edges = np.concatenate(entry_edges + [np.full(n_rows, -1)])
+
+        # LAPJV ignores zero weights, so costs are shifted to start at 1 (a constant per row)
+        low = edge_cost.min() if n_edges else 0.0
+        weights = np.concatenate([edge_cost[entry_edges[:-n_rows]] - low + 1.0, np.full(n_rows, self._unmatched_cost(edge_cost, n_profiles))])
+        matrix = sparse.csr_matrix((weights, (rows, cols)), shape=(n_rows, n_seats + n_rows))
+        row_ind, col_ind = min_weight_full_bipartite_matching(matrix)
+
+        # Map each chosen (row, column) back to its edge
+        keys = rows.astype(np.int64) * (n_seats + n_rows) + cols
+        order = np.argsort(keys)
+        chosen = entry_edges[order[np.searchsorted(keys[order], row_ind.astype(np.int64) * (n_seats + n_rows) + col_ind)]]
+        flows = np.bincount(chosen[chosen >= 0], minlength=n_edges)
+        unmatched = np.bincount(row_profile[row_ind[chosen < 0]], minlength=n_profiles)
+        return flows, unmatched
+
+    def _solve_transport(
+        self,
+        edge_profile: np.ndarray,
+        edge_candidate: np.ndarray,
+        edge_cost: np.ndarray,
+        supplies: np.ndarray,
+        capacity: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Min-cost flow from profiles (supply = member count) to candidates (capacity each),
+        with one "unmatched" slack per profile priced above any reshuffle of real edges.
+            profile rows:   sum_j x_pj + u_p == supply_p
+            candidate rows: sum_p x_pj <= capacity
+        Solved with HiGHS (vertex solutions are integral).
+        Returns (integer flow per edge, unmatched per profile).
+        """
+        n_profiles = len(supplies)
+        n_edges = len(edge_cost)
+        n_vars = n_edges + n_profiles
+
+        used_candidates, candidate_row = np.unique(edge_candidate, return_inverse=True)
+        cost = np.concatenate([edge_cost, np.full(n_profiles, self._unmatched_cost(edge_cost, n_profiles))])
+
+        a_eq = sparse.csr_matrix(
+            (np.ones(n_vars), (np.concatenate([edge_profile, np.arange(n_profiles)]), np.arange(n_vars))),
+            shape=(n_profiles, n_vars)
+        )
+        a_ub = sparse.csr_matrix(
+            (np.ones(n_edges), (candidate_row, np.arange(n_edges))),
+            shape=(len(used_candidates), n_vars)
+        )
+        upper = np.concatenate([np.minimum(supplies[edge_profile], capacity), supplies])
+
+        solution = linprog(
+            cost,
+            A_ub=a_ub,
+            b_ub=np.full(len(used_candidates), capacity),
+            A_eq=a_eq,
+            b_eq=supplies,
+            bounds=np.column_stack([np.zeros(n_vars), upper]),
+            method="highs"
+        )
+        if not solution.success:
+            raise RuntimeError(f"[Matcher] Population matching failed: {solution.message}")
+
+        x = np.rint(solution.x).astype(int)
+        return x[:n_edges], x[n_edges:]
+
+    def _trait_predicate(self, trait: str, value: Any):
+        """
+        Predicate for "this backstory can carry `value` for `trait`" (see _trait_values_predicate).
+        """
+        return self._trait_values_predicate(trait, [value])
+
+    def _trait_values_predicate(self, trait: str, values: List[Any]):
+        """
+        One predicate for "this backstory can carry any of `values` for `trait`":
+        demographics->>trait IN (the values as given or lowercased), or a distribution
+        with one of the values as a key, checked by a single jsonpath.
+        """
+        value_strs = sorted({str(v) for v in values})
+        options = sorted({option for v in value_strs for option in (v, v.lower())})
+        keys = " || ".join(f"exists(@.{json.dumps(v)})" for v in value_strs)
+        path = f"$.{json.dumps(trait)} ? ({keys})"
+        return or_(
+            Backstory.demographics[trait].astext.in_(options),
+            Backstory.demographics.op("@?")(cast(path, JSONPATH))
+        )
+
+    def build_prefilter(self, targets: List[Dict[str, Any]], strict: bool = True):
+        """
+        Turns target constraints into a WHERE clause over backstories.demographics,
+        with one predicate per trait over the union of the values targets ask for
+        (so a sampled population with thousands of distinct profiles stays a short
+        statement). The exact scorer then handles the combinations.
+        Strict: a backstory must carry an allowed value for every trait that all targets constrain.
+        Relaxed: carrying an allowed value for any constrained trait is enough.
+        Returns None when the targets carry no constraints.
+        """
+        values: Dict[str, set] = {}
+        constrained = []
+        for target in targets:
+            traits = {
+                k for k, v in target.items()
+                if k not in METADATA_KEYS and not isinstance(v, (dict, list))
+            }
+            if not traits:
+                continue
+            constrained.append(traits)
+            for trait in traits:
+                values.setdefault(trait, set()).add(str(target[trait]))
+
+        if not values:
+            return None
+
+        if strict:
+            # A trait some target leaves open can't exclude anyone
+            shared = set.intersection(*constrained)
+            if not shared:
+                return None
+            return and_(*[self._trait_values_predicate(trait, values[trait]) for trait in sorted(shared)])
+        return or_(*[self._trait_values_predicate(trait, values[trait]) for trait in sorted(values)])
+
+    def fetch_candidates(
+        self,
+        db,
+        targets: List[Dict[str, Any]],
+        min_candidates: int,
+        candidate_ids: Optional[List[int]] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Loads matching candidates as {id, demographics, custom_tags} only, narrowing the pool in the database.
+        Falls back strict -> relaxed -> whole pool until at least `min_candidates` rows are found,
+        since soft matches (and the no-demographics fallback) remain valid assignments.
+        A `candidate_ids` shortlist (e.g. from semantic retrieval) replaces the prefilter.
+        """
+        if candidate_ids is not None:
+            rows = db.query(Backstory.id, Backstory.demographics, Backstory.custom_tags).filter(Backstory.id.in_(candidate_ids)).all()
+            return [{"id": row.id, "demographics": row.demographics or {}, "custom_tags": row.custom_tags or {}} for row in rows]
+
+        rows = []
+        for strict in (True, False):
+            clause = self.build_prefilter(targets, strict=strict)
+            if clause is None:
+                continue
+            rows = db.query(Backstory.id, Backstory.demographics, Backstory.custom_tags).filter(clause).all()
+            print(f"[Matcher] Prefilter ({'strict' if strict else 'relaxed'}) kept {len(rows)} candidates.")
+            if len(rows) >= min_candidates:
+                break
+
+        if len(rows) < min_candidates:
+            rows = db.query(Backstory.id, Backstory.demographics, Backstory.custom_tags).all()
+
+        return [{"id": row.id, "demographics": row.demographics or {}, "custom_tags": row.custom_tags or {}} for row in rows]
+
+    def match_against_db(
+        self,
+        targets: List[Dict[str, Any]],
+        capacity: int = 1,
+        top_k: int = 50,
+        candidate_factor: int = 5,
+        candidate_ids: Optional[List[int]] = None
+    ) -> List[Tuple[Dict, Dict]]:
+        """
+        Prefilters backstories in the DB (GIN-indexed JSONB queries, id + demographics + custom tags only),
+        matches against targets, then loads full content just for the matched backstories.
+        Aims for at least `candidate_factor` candidates per target seat before relaxing the prefilter.
+        Small one-to-one problems use the exact dense Hungarian solver; populations and
+        capacities above one go through the sparse min-cost-flow engine (match_population).
         """
         db = SessionLocal()
         try:
-            # Fetch all backstories
-            # In production this would be filtered or use vector search first
-            backstories_orm = db.query(Backstory).all()
+            min_candidates = -(-len(targets) * candidate_factor // max(1, capacity))
+            candidates = self.fetch_candidates(db, targets, min_candidates=min_candidates, candidate_ids=candidate_ids)
+        finally:
+            db.close()
 
-            if not backstories_orm:
-                print("[Matcher] No backstories found in DB.")
+        if not candidates:
+            print("[Matcher] No backstories found in DB.")
+            return []
+
+        return self._solve_and_hydrate(targets, candidates, capacity, top_k)
+
+    def match_against_index(
+        self,
+        targets: List[Dict[str, Any]],
+        capacity: int = 1,
+        top_k: int = 50
+    ) -> List[Tuple[Dict, Dict]]:
+        """
+        Same as match_against_db, but scores the whole pool from the long-lived in-memory
+        trait index (refreshed incrementally) instead of querying candidates per run.
+        """
+        from modules.backstory_index import backstory_index
+
+        index = backstory_index.get()
+        for attempt in range(2):
+            candidates = index.candidates()
+            if not candidates:
+                print("[Matcher] Backstory index is empty.")
                 return []
+            matches = self._solve(targets, candidates, capacity, top_k, encoded=index.encoded())
+            hydrated = self._hydrate(matches)
+
+            # Backstories deleted since the last reconciliation can't be hydrated: drop them
+            # from the index and match again rather than return a short population
+            gone = list({c["id"] for _, c in matches} - hydrated.keys())
+            if not gone or attempt:
+                break
+            print(f"[Matcher] {len(gone)} matched backstories no longer exist; re-matching without them.")
+            backstory_index.remove(gone)
+        return [(target, hydrated[c["id"]]) for target, c in matches if c["id"] in hydrated]
+
+    def _solve_and_hydrate(
+        self,
+        targets: List[Dict[str, Any]],
+        candidates: List[Dict[str, Any]],
+        capacity: int,
+        top_k: int,
+        encoded: Optional[EncodedCandidates] = None
+    ) -> List[Tuple[Dict, Dict]]:
+        matches = self._solve(targets, candidates, capacity, top_k, encoded=encoded)
+        hydrated = self._hydrate(matches)
+        return [(target, hydrated[c["id"]]) for target, c in matches if c["id"] in hydrated]
+
+    def _solve(
+        self,
+        targets: List[Dict[str, Any]],
+        candidates: List[Dict[str, Any]],
+        capacity: int,
+        top_k: int,
+        encoded: Optional[EncodedCandidates] = None
+    ) -> List[Tuple[Dict, Dict]]:
+        if capacity <= 1 and len(targets) * len(candidates) <= DENSE_MATCH_LIMIT:
+            return self.perform_matching(targets, candidates, encoded=encoded)
+        return self.match_population(targets, candidates, capacity=capacity, top_k=top_k, encoded=encoded)
+
+    def _hydrate(self, matches: List[Tuple[Dict, Dict]]) -> Dict[int, Dict[str, Any]]:
+        """
+        Lazily loads content / custom tags for the chosen backstories only, by id.
+        """
+        return {b["id"]: b for b in self.fetch_backstories(list({c["id"] for _, c in matches}))}
 
-            # Convert to dict format expected by logic
-            candidates = []
-            for b in backstories_orm:
-                candidates.append({
+    def fetch_backstories(self, backstory_ids: List[int]) -> List[Dict[str, Any]]:
+        """
+        Loads full backstories by id, preserving the order (and repeats) of `backstory_ids`.
+        Ids that no longer exist are dropped.
+        """
+        if not backstory_ids:
+            return []
+
+        db = SessionLocal()
+        try:
+            rows = db.query(Backstory).filter(Backstory.id.in_(set(backstory_ids))).all()
+            by_id = {
+                b.id: {
                     "id": b.id,
                     "content": b.content,
                     "demographics": b.demographics,
-                    "custom_tags": b.custom_tags
-                })
-
-            return self.perform_matching(targets, candidates)
-
+                    "custom_tags": b.custom_tags,
+                    "token_counts": b.token_counts
+                }
+                for b in rows
+            }
+            return [by_id[i] for i in backstory_ids if i in by_id]
         finally:
             db.close()
 
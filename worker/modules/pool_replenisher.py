@@ -0,0 +1,183 @@
+import sys
+import os
+import math
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import func
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SessionLocal, Backstory, SurveyRun, DemographicConfig
+from modules.config_manager import config_manager
+from modules.matcher import matcher, METADATA_KEYS
+from modules.backstory_generator import generator
+
+# A demographic cell is one (trait, value) pair, e.g. ("political_party", "Republican")
+Cell = Tuple[str, str]
+
+class PoolReplenisher:
+    """
+    Keeps the backstory pool stocked where recent demand is.
+
+    Each cycle:
+    1. Demand: for every recent ALTERITY run (and recently created demographic config),
+       the expected number of targets per cell (population size x probability).
+       A cell's demand is the largest single-source demand, since one run needs its
+       seats at the same time.
+    2. Coverage: backstories that can carry the cell's value, counted with the same
+       GIN-indexed JSONB predicates the matcher prefilters with.
+    3. Deficit: coverage_factor x demand - coverage. Targeted seeds (a persona sampled
+       from the config that drives the cell, with the short value pinned) are generated
+       for the largest deficits, within per-cycle and per-day budgets, and saved with
+       their intended demographics so they count towards coverage immediately.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        self.settings = settings or config_manager.get_pool_replenishment_settings()
+
+    def collect_demand(self, db) -> Tuple[Dict[Cell, float], Dict[Cell, Dict[str, Any]]]:
+        """
+        Returns (demand per cell, the constraints of the config that drives each cell).
+        """
+        since = datetime.now(timezone.utc) - timedelta(days=self.settings["lookback_days"])
+        default_size = int(self.settings["default_population_size"])
+
+        sources: List[Tuple[Dict[str, Any], int]] = []
+        runs = (
+            db.query(SurveyRun.run_config, DemographicConfig.constraints)
+            .join(DemographicConfig, SurveyRun.config_id == DemographicConfig.id)
+            .filter(SurveyRun.methodology == "ALTERITY", SurveyRun.created_at >= since)
+            .all()
+        )
+        for run_config, constraints in runs:
+            sources.append((constraints or {}, int((run_config or {}).get("population_size", default_size))))
+
+        # New configs that haven't been run yet are likely to be soon
+        for (constraints,) in db.query(DemographicConfig.constraints).filter(DemographicConfig.created_at >= since).all():
+            sources.append((constraints or {}, default_size))
+
+        demand: Dict[Cell, float] = {}
+        drivers: Dict[Cell, Dict[str, Any]] = {}
+        for constraints, size in sources:
+            for cell, expected in cell_demand(constraints, size).items():
+                if expected > demand.get(cell, 0.0):
+                    demand[cell] = expected
+                    drivers[cell] = constraints
+        return demand, drivers
+
+    def count_coverage(self, db, cells: List[Cell]) -> Dict[Cell, int]:
+        return {
+            cell: db.query(func.count(Backstory.id)).filter(matcher._trait_predicate(*cell)).scalar() or 0
+            for cell in cells
+        }
+
+    def generated_today(self, db) -> int:
+        since = datetime.now(timezone.utc) - timedelta(days=1)
+        return db.query(func.count(Backstory.id)).filter(
+            Backstory.custom_tags.contains({"replenished": True}),
+            Backstory.created_at >= since
+        ).scalar() or 0
+
+    def plan(self, db) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Works out which targeted seeds to generate this cycle.
+        """
+        demand, drivers = self.collect_demand(db)
+        if not demand:
+            return []
+
+        coverage = self.count_coverage(db, list(demand))
+        factor = float(self.settings["coverage_factor"])
+        deficits = {
+            cell: math.ceil(expected * factor) - coverage[cell]
+            for cell, expected in demand.items()
+        }
+        deficits = {cell: d for cell, d in deficits.items() if d > 0}
+        if not deficits:
+            print("[Replenisher] Pool covers current demand.")
+            return []
+
+        budget = min(
+            int(self.settings["max_backstories_per_cycle"]),
+            int(self.settings["max_backstories_per_day"]) - self.generated_today(db)
+        )
+        print(f"[Replenisher] {len(deficits)} short cells (total deficit {sum(deficits.values())}); budget {max(budget, 0)}.")
+        return plan_seeds(deficits, drivers, budget)
+
+    def run_cycle(self) -> int:
+        db = SessionLocal()
+        try:
+            seeds = self.plan(db)
+        finally:
+            db.close()
+
+        if not seeds:
+            return 0
+        saved = generator.run_pipeline(
+            model_name=self.settings["model_name"],
+            seeds=seeds,
+            custom_tags={"replenished": True}
+        )
+        print(f"[Replenisher] Generated {len(saved)} targeted backstories.")
+        return len(saved)
+
+    def run_forever(self):
+        print(f"[Replenisher] Watching pool coverage every {self.settings['interval_seconds']}s...")
+        while True:
+            try:
+                self.settings = config_manager.get_pool_replenishment_settings()
+                self.run_cycle()
+            except Exception as e:
+                print(f"[Replenisher Error] {e}")
+            time.sleep(float(self.settings["interval_seconds"]))
+
+def cell_demand(constraints: Dict[str, Any], population_size: int) -> Dict[Cell, float]:
+    """
+    Expected number of targets per cell for a population sampled from `constraints`.
+    """
+    demand = {}
+    for trait, value in constraints.items():
+        if trait in METADATA_KEYS:
+            continue
+        if isinstance(value, dict):
+            total = sum(float(p) for p in value.values()) or 1.0
+            for option, p in value.items():
+                demand[(trait, str(option))] = population_size * float(p) / total
+        elif not isinstance(value, list):
+            demand[(trait, str(value))] = float(population_size)
+    return demand
+
+def plan_seeds(
+    deficits: Dict[Cell, int],
+    drivers: Dict[Cell, Dict[str, Any]],
+    budget: int,
+    seed: Optional[int] = None
+) -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Greedy: each new persona pins the currently shortest cell and samples its other traits
+    from the config driving that cell; every cell it lands in is credited.
+    """
+    rng = np.random.default_rng(seed)
+    deficits = dict(deficits)
+    seeds = []
+    while len(seeds) < budget and deficits:
+        trait, value = max(deficits, key=deficits.get)
+        sample_seed = int(rng.integers(2**31))
+        persona = matcher.sample_population(drivers[(trait, value)], 1, seed=sample_seed)[0]
+        persona.pop("id", None)
+        persona[trait] = value
+        demographics = {k: str(v) for k, v in persona.items() if not isinstance(v, (dict, list))}
+
+        for cell in demographics.items():
+            if cell in deficits:
+                deficits[cell] -= 1
+                if deficits[cell] <= 0:
+                    del deficits[cell]
+
+        traits = "; ".join(f"{k.replace('_', ' ')}: {v}" for k, v in demographics.items())
+        seeds.append((f"A person with these characteristics: {traits}.", demographics))
+    return seeds
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+from typing import Any, Dict, Optional
+
+import redis
+from sqlalchemy import update
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SurveyRun
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+
+def progress_channel(run_id: int) -> str:
+    return f"run_progress:{run_id}"
+
+class RunProgress:
+    """
+    Live progress for a survey run.
+
+    - Publishes throttled JSON events on the Redis channel `run_progress:<run_id>`
+      (and keeps the latest one under `run_progress:<run_id>:latest` for late subscribers).
+    - Accumulates token usage and folds it into survey_runs.tokens_used in batches,
+      in the same transaction as each result chunk (see flush_tokens).
+    Publishing is best-effort: if Redis is unavailable the run carries on silently.
+    """
+
+    def __init__(
+        self,
+        run_id: int,
+        total_pairs: int,
+        completed_pairs: int = 0,
+        cost_so_far: float = 0.0,
+        tokens_so_far: int = 0,
+        publish_interval: float = 1.0,
+        redis_client: Optional[redis.Redis] = None,
+        estimate: Optional[Dict[str, Any]] = None
+    ):
+        self.run_id = run_id
+        self.total_pairs = total_pairs
+        self.completed_pairs = completed_pairs
+        self.tokens_so_far = tokens_so_far
+        self.cost_so_far = cost_so_far
+        self.publish_interval = publish_interval
+        self.estimate = estimate
+
+        self._started_at = time.monotonic()
+        self._session_completed = 0
+        self._pending_tokens = 0
+        self._last_published = 0.0
+        self._redis = redis_client
+        self._redis_failed = False
+
+    def record(self, usage: Dict[str, Any], cost: float):
+        """
+        Accounts for one completed pair and publishes if the throttle interval has passed.
+        """
+        tokens = usage.get("total_tokens", 0)
+        self.completed_pairs += 1
+        self._session_completed += 1
+        self.tokens_so_far += tokens
+        self._pending_tokens += tokens
+        self.cost_so_far += cost
+        self.publish()
+
+    def flush_tokens(self, db):
+        """
+        Adds the tokens accumulated since the last flush to survey_runs.tokens_used.
+        Does not commit; meant to ride along with the caller's chunk commit.
+        """
+        if not self._pending_tokens:
+            return
+        db.execute(
+            update(SurveyRun)
+            .where(SurveyRun.id == self.run_id)
+            .values(tokens_used=SurveyRun.tokens_used + self._pending_tokens)
+        )
+        self._pending_tokens = 0
+
+    def snapshot(self, status: str = "INFERENCE") -> Dict[str, Any]:
+        elapsed = time.monotonic() - self._started_at
+        return {
+            "run_id": self.run_id,
+            "status": status,
+            "completed_pairs": self.completed_pairs,
+            "total_pairs": self.total_pairs,
+            "tokens_used": self.tokens_so_far,
+            "cost": round(self.cost_so_far, 6),
+            "pairs_per_second": round(self._session_completed / elapsed, 3) if elapsed > 0 else 0.0,
+            "estimate": self.estimate,
+            "timestamp": time.time()
+        }
+
+    def publish(self, status: str = "INFERENCE", force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_published < self.publish_interval:
+            return
+        self._last_published = now
+        if self._redis_failed:
+            return
+        if self._redis is None:
+            self._redis = redis.from_url(REDIS_URL)
+        if not publish_event(self.run_id, self.snapshot(status), self._redis):
+            print(f"[Progress] Disabling progress events for run {self.run_id}.")
+            self._redis_failed = True
+
+def publish_status(run_id: int, status: str):
+    publish_event(run_id, {"run_id": run_id, "status": status, "timestamp": time.time()})
+
+def publish_event(run_id: int, event: Dict[str, Any], client: Optional[redis.Redis] = None) -> bool:
+    """
+    Publishes a progress/status event for a run. Never raises; returns whether it was sent.
+    """
+    try:
+        client = client or redis.from_url(REDIS_URL)
+        payload = json.dumps(event)
+        channel = progress_channel(run_id)
+        pipe = client.pipeline()
+        pipe.set(f"{channel}:latest", payload, ex=24 * 3600)
+        pipe.publish(channel, payload)
+        pipe.execute()
+        return True
+    except Exception as e:
+        print(f"[Progress Error] Failed to publish for run {run_id}: {e}")
+        return False
@@ -0,0 +1,133 @@
+import time
+import random
+import threading
+from typing import Dict, Optional
+
+from modules.config_manager import config_manager
+
+class _Bucket:
+    """
+    Continuous-refill token bucket. A capacity of None means unlimited.
+    The level may go negative when actual usage exceeds the reservation;
+    later callers then wait for the debt to be repaid.
+    """
+
+    def __init__(self, per_minute: Optional[float]):
+        self.capacity = per_minute
+        self.level = per_minute or 0.0
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity is None:
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60.0)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        if self.capacity is None:
+            return 0.0
+        # Never demand more than a full bucket, or oversized requests would wait forever
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def take(self, amount: float):
+        if self.capacity is not None:
+            self.level -= amount
+
+class ModelRateLimiter:
+    """
+    Per-model client-side limiter shared by every caller in the worker process.
+
+    - Budgets requests/minute and tokens/minute with token buckets.
+    - Caps in-flight requests with an adaptive (AIMD) concurrency limit: the limit
+      halves when the provider throttles us (429/503) and grows by one after a
+      window of successes, up to the configured maximum.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        min_concurrency: int = 1
+    ):
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency_limit = float(self.max_concurrency)
+
+        self._requests = _Bucket(requests_per_minute)
+        self._tokens = _Bucket(tokens_per_minute)
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, estimated_tokens: int = 0):
+        """
+        Blocks until a concurrency slot and enough request/token budget are available.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._requests.refill(now)
+                self._tokens.refill(now)
+
+                if self._in_flight < int(self.concurrency_limit):
+                    delay = max(self._requests.wait_time(1), self._tokens.wait_time(estimated_tokens))
+                    if delay <= 0:
+                        self._requests.take(1)
+                        self._tokens.take(estimated_tokens)
+                        self._in_flight += 1
+                        return
+                    self._cond.wait(timeout=delay)
+                else:
+                    self._cond.wait()
+
+    def release(self, estimated_tokens: int = 0, actual_tokens: Optional[int] = None, throttled: bool = False):
+        """
+        Returns the slot, reconciles the token reservation and adapts concurrency.
+        """
+        with self._cond:
+            self._in_flight -= 1
+            # Settle the difference between the reservation and what was really used
+            # (failed requests are refunded in full)
+            self._tokens.take((actual_tokens or 0) - estimated_tokens)
+
+            if throttled:
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                self._successes = 0
+                print(f"[RateLimiter] {self.model} throttled; concurrency limit -> {int(self.concurrency_limit)}")
+            elif actual_tokens is not None:
+                self._successes += 1
+                if self._successes >= int(self.concurrency_limit) and self.concurrency_limit < self.max_concurrency:
+                    self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1)
+                    self._successes = 0
+
+            self._cond.notify_all()
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: Optional[float] = None) -> float:
+    """
+    Exponential backoff with full jitter; a server-provided Retry-After wins if larger.
+    """
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after:
+        delay = max(delay, min(cap, retry_after))
+    return delay
+
+_limiters: Dict[str, ModelRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model: str) -> ModelRateLimiter:
+    with _limiters_lock:
+        if model not in _limiters:
+            limits = config_manager.get_rate_limits(model)
+            _limiters[model] = ModelRateLimiter(
+                model,
+                max_concurrency=config_manager.get_model_concurrency(model),
+                requests_per_minute=limits.get("requests_per_minute"),
+                tokens_per_minute=limits.get("tokens_per_minute")
+            )
+        return _limiters[model]
@@ -0,0 +1,202 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import openai
+
+from modules.config_manager import config_manager
+
+# Failures that say something about the replica rather than the request
+EJECT_STATUS_CODES = {500, 502, 503, 504}
+
+class Replica:
+    """
+    One vLLM server (an OpenAI-compatible base URL) and its live load/health state.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.client = openai.OpenAI(api_key="EMPTY", base_url=url, max_retries=0)
+        self.in_flight = 0
+        self.latency: Optional[float] = None # EWMA of request seconds
+        self.failures = 0 # consecutive
+        self.ejected_until: Optional[float] = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until is None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "latency": self.latency,
+            "failures": self.failures
+        }
+
+class ReplicaRouter:
+    """
+    Routes local-model requests across vLLM replicas.
+
+    - Endpoints per model come from the VLLM_ENDPOINTS config ({model: [base_url, ...]},
+      with an optional "default" list), falling back to the VLLM_BASE_URL env var.
+      A server listed for several models is one Replica, so its load is counted once.
+    - Each request goes to the healthy replica with the fewest requests in flight
+      (ties broken by recent latency). With prefix affinity, a request whose prompt
+      prefix (e.g. an interview's persona system prompt) was last served by a replica
+      goes back there while it is within `affinity_slack` requests of the least loaded,
+      so it hits that server's prefix cache.
+    - A connection error, timeout or 5xx ejects the replica for `eject_seconds`, doubling
+      per consecutive failure up to `max_eject_seconds`. A background thread probes
+      ejected replicas (GET /models) once their time is up and readmits those that answer.
+      If every replica is ejected, the one due back soonest is tried anyway.
+    """
+
+    def __init__(self, endpoints: Optional[Dict[str, List[str]]] = None, settings: Optional[Dict[str, Any]] = None):
+        self.endpoints = endpoints if endpoints is not None else config_manager.get_vllm_endpoints()
+        self.settings = settings or config_manager.get_replica_routing_settings()
+        self._replicas: Dict[str, Replica] = {}
+        self._affinity: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._health_thread: Optional[threading.Thread] = None
+
+    def urls_for(self, model: str) -> List[str]:
+        urls = self.endpoints.get(model) or self.endpoints.get("default")
+        if not urls and os.getenv("VLLM_BASE_URL"):
+            urls = [os.getenv("VLLM_BASE_URL")]
+        return list(urls or [])
+
+    def has_replicas(self, model: str) -> bool:
+        return bool(self.urls_for(model))
+
+    def replicas_for(self, model: str) -> List[Replica]:
+        with self._lock:
+            return [self._replica(url) for url in self.urls_for(model)]
+
+    def _replica(self, url: str) -> Replica:
+        if url not in self._replicas:
+            self._replicas[url] = Replica(url)
+        return self._replicas[url]
+
+    def pick(self, model: str, affinity_key: Optional[str] = None) -> Replica:
+        with self._lock:
+            return self._choose(model, affinity_key)
+
+    def _choose(self, model: str, affinity_key: Optional[str]) -> Replica:
+        urls = self.urls_for(model)
+        if not urls:
+            raise RuntimeError(f"Model {model} is local but no vLLM endpoints are configured.")
+
+        replicas = [self._replica(url) for url in urls]
+        healthy = [r for r in replicas if r.healthy]
+        if not healthy:
+            return min(replicas, key=lambda r: r.ejected_until)
+
+        best = min(healthy, key=lambda r: (r.in_flight, r.latency or 0.0))
+        if affinity_key and self.settings["prefix_affinity"]:
+            preferred = self._replicas.get(self._affinity.get(affinity_key))
+            if (
+                preferred in healthy
+                and preferred.in_flight <= best.in_flight + int(self.settings["affinity_slack"])
+            ):
+                return preferred
+        return best
+
+    def call(self, model: str, request: Callable[[openai.OpenAI], Any], affinity_key: Optional[str] = None) -> Any:
+        """
+        Sends one request (`request(client)`) to a replica picked for `model`, keeping
+        load, latency and health up to date. Errors propagate to the caller's retry loop,
+        which will pick again (and skip the replica if it was just ejected).
+        """
+        key = hashlib.sha256(affinity_key.encode()).hexdigest() if affinity_key else None
+        with self._lock:
+            replica = self._choose(model, key)
+            replica.in_flight += 1
+        start = time.monotonic()
+        try:
+            response = request(replica.client)
+        except Exception as e:
+            with self._lock:
+                replica.in_flight -= 1
+            if _is_replica_failure(e):
+                self.eject(replica, e)
+            raise
+
+        elapsed = time.monotonic() - start
+        alpha = float(self.settings["latency_alpha"])
+        with self._lock:
+            replica.in_flight -= 1
+            replica.latency = elapsed if replica.latency is None else (1 - alpha) * replica.latency + alpha * elapsed
+            replica.failures = 0
+            if key:
+                self._affinity[key] = replica.url
+                self._affinity.move_to_end(key)
+                while len(self._affinity) > int(self.settings["affinity_entries"]):
+                    self._affinity.popitem(last=False)
+        return response
+
+    def eject(self, replica: Replica, error: Optional[Exception] = None):
+        with self._lock:
+            replica.failures += 1
+            delay = min(
+                float(self.settings["eject_seconds"]) * 2 ** (replica.failures - 1),
+                float(self.settings["max_eject_seconds"])
+            )
+            replica.ejected_until = time.monotonic() + delay
+        print(f"[Router] Ejected {replica.url} for {delay:.0f}s ({type(error).__name__ if error else 'health check failed'}).")
+        self._ensure_health_checks()
+
+    def check_health(self):
+        """
+        Probes every ejected replica that is due and readmits the ones that respond.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [r for r in self._replicas.values() if r.ejected_until is not None and r.ejected_until <= now]
+        for replica in due:
+            try:
+                replica.client.with_options(timeout=float(self.settings["health_timeout"])).models.list()
+            except Exception as e:
+                self.eject(replica, e)
+                continue
+            with self._lock:
+                replica.ejected_until = None
+            print(f"[Router] {replica.url} passed its health check; back in rotation.")
+
+    def _ensure_health_checks(self):
+        with self._lock:
+            if self._health_thread is not None:
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            time.sleep(float(self.settings["health_check_interval"]))
+            try:
+                self.check_health()
+            except Exception as e:
+                print(f"[Router Error] Health check failed: {e}")
+
+    def status(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [replica.status() for replica in self._replicas.values()]
+
+def _is_replica_failure(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return getattr(error, "status_code", None) in EJECT_STATUS_CODES
+
+_router: Optional[ReplicaRouter] = None
+_router_lock = threading.Lock()
+
+def get_replica_router() -> ReplicaRouter:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ReplicaRouter()
+        return _router
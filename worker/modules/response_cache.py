@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import redis
+
+from modules.config_manager import config_manager
+
+class ResponseCache:
+    """
+    Content-addressed cache for chat completions.
+
+    Two tiers:
+      1. An in-process LRU bounded by entry count and total bytes.
+      2. A shared tier: Redis (default when REDIS_URL is set) or a directory on disk,
+         selected with RESPONSE_CACHE_BACKEND = redis | disk | none.
+    Every entry carries a TTL; expired entries are treated as misses and dropped.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 10_000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: int = 7 * 24 * 3600,
+        backend: Optional[str] = None,
+        redis_url: Optional[str] = None,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: int = 1024 * 1024 * 1024
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._lru: "OrderedDict[str, tuple]" = OrderedDict() # key -> (expires_at, size, payload)
+        self._lru_bytes = 0
+        self._lock = threading.Lock()
+
+        redis_url = redis_url or os.getenv("REDIS_URL")
+        backend = backend or os.getenv("RESPONSE_CACHE_BACKEND") or ("redis" if redis_url else "disk")
+
+        self._redis = None
+        self._disk_dir = None
+        self.disk_max_bytes = disk_max_bytes
+        self._disk_writes = 0
+        if backend == "redis" and redis_url:
+            self._redis = redis.from_url(redis_url)
+        elif backend == "disk":
+            self._disk_dir = disk_dir or os.getenv("RESPONSE_CACHE_DIR", "/tmp/alterity_response_cache")
+            os.makedirs(self._disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+        material = json.dumps(
+            {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry:
+                expires_at, size, payload = entry
+                if expires_at > now:
+                    self._lru.move_to_end(key)
+                    return json.loads(payload)
+                self._lru.pop(key)
+                self._lru_bytes -= size
+
+        payload = self._shared_get(key)
+        if payload is None:
+            return None
+        self._lru_put(key, payload, now + self.ttl_seconds)
+        return json.loads(payload)
+
+    def set(self, key: str, value: Dict[str, Any]):
+        payload = json.dumps(value, ensure_ascii=False)
+        self._lru_put(key, payload, time.time() + self.ttl_seconds)
+        self._shared_set(key, payload)
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._lru_bytes = 0
+
+    # --- In-process tier ---
+
+    def _lru_put(self, key: str, payload: str, expires_at: float):
+        size = len(payload)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._lru:
+                self._lru_bytes -= self._lru.pop(key)[1]
+            self._lru[key] = (expires_at, size, payload)
+            self._lru_bytes += size
+            while len(self._lru) > self.max_entries or self._lru_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._lru.popitem(last=False)
+                self._lru_bytes -= evicted_size
+
+    # --- Shared tier ---
+
+    def _shared_get(self, key: str) -> Optional[str]:
+        try:
+            if self._redis is not None:
+                payload = self._redis.get(f"llm_cache:{key}")
+                return payload.decode("utf-8") if payload else None
+            if self._disk_dir:
+                path = os.path.join(self._disk_dir, key)
+                if not os.path.exists(path):
+                    return None
+                if os.path.getmtime(path) + self.ttl_seconds < time.time():
+                    os.remove(path)
+                    return None
+                with open(path, "r", encoding="utf-8") as f:
+                    return f.read()
+        except Exception as e:
+            print(f"[ResponseCache Error] Shared tier read failed: {e}")
+        return None
+
+    def _shared_set(self, key: str, payload: str):
+        try:
+            if self._redis is not None:
+                # Size-based eviction for this tier is left to Redis' maxmemory policy
+                self._redis.setex(f"llm_cache:{key}", self.ttl_seconds, payload)
+            elif self._disk_dir:
+                tmp_path = os.path.join(self._disk_dir, f".{key}.{threading.get_ident()}")
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(payload)
+                os.replace(tmp_path, os.path.join(self._disk_dir, key))
+                # Directory scans are not free; only sweep every so often
+                self._disk_writes += 1
+                if self._disk_writes % 100 == 0:
+                    self._evict_disk()
+        except Exception as e:
+            print(f"[ResponseCache Error] Shared tier write failed: {e}")
+
+    def _evict_disk(self):
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self._disk_dir):
+            if name.startswith("."):
+                continue
+            path = os.path.join(self._disk_dir, name)
+            stat = os.stat(path)
+            if stat.st_mtime + self.ttl_seconds < now:
+                os.remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        # Oldest first until back under budget
+        for _, size, path in sorted(entries):
+            if total <= self.disk_max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache(**config_manager.get_response_cache_settings())
+        return _response_cache
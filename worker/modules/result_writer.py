@@ -0,0 +1,61 @@
+import sys
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Result
+
+class ResultWriter:
+    """
+    Streams results for a run into the `results` table.
+    Rows are buffered as plain dicts and flushed in chunks with a single
+    executemany INSERT (no ORM unit-of-work), and every chunk is committed,
+    so memory stays bounded and a crash only loses the current chunk.
+    """
+
+    def __init__(self, db: Session, run_id: int, chunk_size: int = 500, on_flush: Optional[Callable[[Session], None]] = None):
+        self.db = db
+        self.run_id = run_id
+        self.chunk_size = max(1, chunk_size)
+        # Extra writes (e.g. run counters) committed atomically with each chunk
+        self.on_flush = on_flush
+        self.written = 0
+        self._buffer: List[Dict[str, Any]] = []
+
+    def add(self, probe_id: int, backstory_id: Optional[int], response: Dict[str, Any], usage_cost: float):
+        self._buffer.append({
+            "run_id": self.run_id,
+            "probe_id": probe_id,
+            "backstory_id": backstory_id,
+            "response": response,
+            "usage_cost": usage_cost
+        })
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        self.db.execute(insert(Result.__table__), self._buffer)
+        if self.on_flush:
+            self.on_flush(self.db)
+        self.db.commit()
+        self.written += len(self._buffer)
+        self._buffer = []
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Persist whatever completed before an error too; the caller decides the run status
+        try:
+            self.flush()
+        except Exception as e:
+            if exc_type is None:
+                raise
+            print(f"[ResultWriter Error] Final flush failed: {e}")
@@ -1,19 +1,27 @@
 import sys
 import os
+from collections import Counter
 from datetime import datetime
-from typing import Dict, Any
+from sqlalchemy import func
+from functools import partial
+from typing import Dict, Any, List, Tuple
 
 # Add parent directory to path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from database import SessionLocal, SurveyRun, Result, Probe, DemographicConfig, Backstory
-from llm import chat_completion
-from .matcher import matcher
-from .matcher import matcher
-from .demographic_forcing import run_demographic_forcing
+from database import SessionLocal, SurveyRun, Result, Probe, DemographicConfig
+from llm import imap_chat_completions
+from .matcher import matcher, free_text_traits
+from .demographic_forcing import build_messages as build_demographic_messages
+from .result_writer import ResultWriter
+from .progress import RunProgress, publish_status
+from .vector_index import get_vector_index
+from .context_budget import plan_context, estimate_run
 from modules.config_manager import config_manager
 
 def calculate_cost(usage: Dict[str, int], model: str = "gpt-4-turbo") -> float:
+    # Response-cache hits report zero prompt/completion tokens (their original counts
+    # live under cached_prompt_tokens / cached_completion_tokens), so they cost nothing.
     pricing = config_manager.get_pricing()
 
     # Simple logic to find best match or default
@@ -23,6 +31,49 @@ def calculate_cost(usage: Dict[str, int], model: str = "gpt-4-turbo") -> float:
     output_cost = (usage.get("completion_tokens", 0) / 1000_000) * rates["output"]
     return input_cost + output_cost
 
+def build_alterity_messages(backstory_content: str, probe_content: str) -> List[Dict[str, str]]:
+    """
+    Constructs the contextual prompt: backstory transcript as system prompt, probe as user turn.
+    """
+    system_prompt = (
+        "You are the person described in the following backstory. "
+        "Answer the question as this person would, maintaining their tone, memories, and opinions.\n\n"
+        f"Backstory: {backstory_content}"
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": probe_content}
+    ]
+
+def load_completed_pairs(db, run_id: int) -> Counter:
+    """
+    Counts stored results per (probe_id, backstory_id) for a run.
+    Failed results are deleted instead, so a resume retries them.
+    """
+    db.query(Result).filter(
+        Result.run_id == run_id,
+        Result.response.has_key("error")
+    ).delete(synchronize_session=False)
+    db.commit()
+
+    rows = db.query(Result.probe_id, Result.backstory_id).filter(Result.run_id == run_id).all()
+    return Counter((probe_id, backstory_id) for probe_id, backstory_id in rows)
+
+def skip_completed(jobs: List[Tuple[int, Any, Any]], completed_pairs: Counter) -> List[Tuple[int, Any, Any]]:
+    """
+    Drops jobs whose (probe_id, backstory_id) pair already has a result.
+    Pairs are counted, so a backstory matched more than once still gets one result per match.
+    """
+    remaining = Counter(completed_pairs)
+    pending = []
+    for job in jobs:
+        pair = (job[0], job[1])
+        if remaining[pair] > 0:
+            remaining[pair] -= 1
+            continue
+        pending.append(job)
+    return pending
+
 def execute_run(payload: Dict[str, Any]):
     """
     Main entry point for executing a survey run.
@@ -38,9 +89,16 @@ def execute_run(payload: Dict[str, Any]):
         if not run:
             print(f"[Runner Error] Run ID {run_id} not found.")
             return
+        # Re-queued or restarted runs pick up where they left off. Re-running a
+        # completed run only retries pairs whose stored result is an error.
+        completed_pairs = load_completed_pairs(db, run_id)
+        resumed_count = sum(completed_pairs.values())
+        if resumed_count:
+            print(f"[Runner] Resuming Run {run_id}: {resumed_count} results already stored.")
 
         run.status = "MATCHING"
         db.commit()
+        publish_status(run_id, "MATCHING")
 
         # Fetch Related Data
         probes = db.query(Probe).filter(Probe.survey_id == run.survey_id).all()
@@ -48,102 +106,165 @@ def execute_run(payload: Dict[str, Any]):
 
         target_demographics = config.constraints if config else {}
 
-        results_count = 0
-
         # Extract Model Config
-        model_name = "gpt-4-turbo" # Default
-        if run.run_config and "model_name" in run.run_config:
-            model_name = run.run_config["model_name"]
+        run_config = run.run_config or {}
+        model_name = run_config.get("model_name", "gpt-4-turbo")
+        temperature = run_config.get("temperature", 0.7)
+        # Optional per-run cap on in-flight requests; the model's global limit still applies
+        concurrency = run_config.get("concurrency")
+        # None lets llm decide (prefix batching is on for vLLM-served models)
+        prefix_batching = run_config.get("prefix_batching")
+        # Opt in to serving repeated requests (e.g. temperature-0 replays) from the response cache
+        use_cache = bool(run_config.get("response_cache", False))
+        # Results are bulk-inserted and committed in chunks of this size
+        chunk_size = int(run_config.get("result_chunk_size", 500))
+        # Output cap per answer; prompts are planned to leave room for it
+        max_tokens = int(run_config.get("max_tokens", config_manager.get_context_budget_settings()["max_output_tokens"]))
+        probe_texts = [(probe.id, probe.content) for probe in probes]
 
         print(f"[Runner] Starting execution for Run ID: {run_id} with Model: {model_name}")
 
         if run.methodology == "DEMOGRAPHIC_FORCING":
             run.status = "INFERENCE"
             db.commit()
+            publish_status(run_id, "INFERENCE")
 
-            # Run Demographic Forcing
-            results_data = []
-            total_tokens_used = 0
-            total_cost = 0.0
-            for probe in probes:
-                # Generate system prompt based on demographics
-                response = run_demographic_forcing(probe.content, target_demographics, model=model_name)
-
-                results_data.append({
-                    "probe_id": probe.id,
-                    "response": response["content"],
-                    "usage": response.get("usage", {})
-                })
-
-                # Simple aggregation of cost (approx)
-                # In production, track per-model pricing
-                total_tokens_used += response.get("usage", {}).get("total_tokens", 0)
-
-                # Calculate cost (using generic GPT-4 rates for now as placeholder or map)
-                cost = calculate_cost(response.get("usage", {}), model=model_name)
-
-                total_cost += cost
-
-            # Save results... logic continues below
-            for item in results_data:
-                result = Result(
-                    run_id=run.id,
-                    probe_id=item["probe_id"],
-                    backstory_id=None,
-                    response={"text": item["response"]},
-                    usage_cost=total_cost / len(results_data) if results_data else 0 # Distribute total cost evenly for now
-                )
-                db.add(result)
-                results_count += 1
+            plan = plan_context(
+                model_name, probe_texts,
+                lambda _, probe_content: build_demographic_messages(probe_content, target_demographics),
+                max_output_tokens=max_tokens
+            )
+            # One request per probe, all with the same forced demographics
+            jobs = [
+                (probe.id, None, partial(build_demographic_messages, probe.content, target_demographics))
+                for probe in probes
+            ]
 
         elif run.methodology == "ALTERITY":
-            # 1. Matching
-            matches = matcher.match_against_db([target_demographics])
-            # Matches returns list of (target, candidate_dict) strings
-            # We assume we just want the best N matches for the population size
-            # For simplicity, let's take top 5 matches
-            top_matches = matches[:5]
+            # 1. Matching (persisted, so a resumed run reuses the same personas)
+            if run.matched_backstory_ids is not None:
+                backstories = matcher.fetch_backstories(run.matched_backstory_ids)
+                print(f"[Runner] Reusing {len(backstories)} matched backstories from checkpoint.")
+            else:
+                # Sample a target population from the config (distribution-valued traits are
+                # drawn per individual) and match it; a backstory may serve up to
+                # `backstory_capacity` individuals
+                targets = matcher.sample_population(
+                    target_demographics,
+                    int(run_config.get("population_size", 5)),
+                    seed=run_id
+                )
+                # Free-text traits shortlist the pool by embedding similarity before exact
+                # scoring, which weighs them against the labelled custom_tags: the run page
+                # saves one as a `custom_trait` string, API configs may carry several as a
+                # `custom_tags` dict
+                shortlist = None
+                custom_traits = free_text_traits(target_demographics)
+                if custom_traits:
+                    shortlist = get_vector_index().shortlist(
+                        custom_traits, int(run_config.get("semantic_shortlist", 2000))
+                    )
+
+                if shortlist is not None:
+                    match = partial(matcher.match_against_db, candidate_ids=shortlist)
+                # The in-memory trait index avoids re-reading the pool for every run
+                elif config_manager.is_flag_enabled("backstory_index", default=True):
+                    match = matcher.match_against_index
+                else:
+                    match = matcher.match_against_db
+                matches = match(
+                    targets,
+                    capacity=int(run_config.get("backstory_capacity", 1)),
+                    top_k=int(run_config.get("match_top_k", 50))
+                )
+                # Matches returns list of (target, candidate_dict) pairs
+                backstories = [backstory_data for _, backstory_data in matches]
+                run.matched_backstory_ids = [b['id'] for b in backstories]
 
             run.status = "INFERENCE"
             db.commit()
+            publish_status(run_id, "INFERENCE")
 
-            for target, backstory_data in top_matches:
-                # Re-fetch full backstory if needed, or use data
-                # Run inference
-                for probe in probes:
-                    # Construct Contextual Prompt
-                    system_prompt = (
-                        "You are the person described in the following backstory. "
-                        "Answer the question as this person would, maintaining their tone, memories, and opinions.\n\n"
-                        f"Backstory: {backstory_data['content']}"
-                    )
-                    messages = [
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": probe.content}
-                    ]
-
-                    response_data = chat_completion(messages)
-                    cost = calculate_cost(response_data.get("usage", {}), model=model_name)
-
-                    result = Result(
-                        run_id=run.id,
-                        probe_id=probe.id,
-                        backstory_id=backstory_data['id'],
-                        response={"text": response_data["content"]},
-                        usage_cost=cost
-                    )
-                    db.add(result)
-                    results_count += 1
+            # Every prompt is sized to the model's window up front (oversized backstories are
+            # compacted) instead of failing with context-length errors at dispatch
+            plan = plan_context(model_name, probe_texts, build_alterity_messages, backstories=backstories, max_output_tokens=max_tokens)
+
+            # The full (backstory, probe) grid is dispatched concurrently below.
+            # Messages are built lazily so the grid never holds a prompt copy per pair,
+            # and jobs stay backstory-major (a reused backstory's copies adjacent too)
+            # so each backstory's probes share a prefix batch.
+            jobs = [
+                (probe.id, backstory_data['id'], partial(build_alterity_messages, plan["contents"][backstory_data['id']], probe.content))
+                for backstory_data in sorted(backstories, key=lambda b: b['id'])
+                for probe in probes
+            ]
 
         else:
             print(f"[Error] Unknown methodology: {run.methodology}")
             run.status = "FAILED"
             db.commit()
+            publish_status(run_id, "FAILED")
             return
 
+        # Only issue LLM calls for pairs without a stored result
+        jobs = skip_completed(jobs, completed_pairs)
+
+        # Pre-run estimate for the pairs still to do: prompt tokens are planned exactly,
+        # completions are bounded by the output cap
+        estimate = estimate_run(plan, [(probe_id, backstory_id) for probe_id, backstory_id, _ in jobs])
+        estimate["max_cost"] = round(calculate_cost(
+            {"prompt_tokens": estimate["prompt_tokens"], "completion_tokens": estimate["max_completion_tokens"]},
+            model=model_name
+        ), 6)
+        print(f"[Runner] Estimate for Run {run_id}: {estimate}")
+
+        print(f"[Runner] Dispatching {len(jobs)} requests (concurrency: {concurrency or 'model default'})")
+
+        # Live progress; counters continue from whatever a previous attempt stored
+        resumed_cost = 0.0
+        if resumed_count:
+            resumed_cost = db.query(func.sum(Result.usage_cost)).filter(Result.run_id == run_id).scalar() or 0.0
+        progress = RunProgress(
+            run_id,
+            total_pairs=resumed_count + len(jobs),
+            completed_pairs=resumed_count,
+            cost_so_far=resumed_cost,
+            tokens_so_far=run.tokens_used or 0,
+            estimate=estimate
+        )
+        progress.publish(force=True)
+
+        responses = imap_chat_completions(
+            (build_messages() for _, _, build_messages in jobs),
+            model=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            max_concurrency=concurrency,
+            prefix_batching=prefix_batching,
+            use_cache=use_cache
+        )
+        # tokens_used is bumped in the same transaction as each result chunk
+        with ResultWriter(db, run_id, chunk_size=chunk_size, on_flush=progress.flush_tokens) as writer:
+            for index, response_data in responses:
+                probe_id, backstory_id, _ = jobs[index]
+                cost = calculate_cost(response_data.get("usage", {}), model=model_name)
+
+                if response_data.get("error"):
+                    # Failed after retries: record the failure, never the error text as an answer
+                    response = {"error": response_data["error"]}
+                else:
+                    response = {"text": response_data["content"]}
+                    if response_data.get("cached"):
+                        response["cached"] = True
+
+                writer.add(probe_id, backstory_id, response, cost)
+                progress.record(response_data.get("usage", {}), cost)
+        results_count = resumed_count + writer.written
+
         run.status = "COMPLETED"
         run.completed_at = datetime.utcnow()
         db.commit()
+        progress.publish(status="COMPLETED", force=True)
         print(f"[Runner] Completed Run {run_id} with {results_count} results.")
 
     except Exception as e:
@@ -155,6 +276,7 @@ def execute_run(payload: Dict[str, Any]):
            if run:
                run.status = "FAILED"
                db.commit()
+               publish_status(run_id, "FAILED")
         except:
             pass
     finally:
@@ -0,0 +1,98 @@
+from functools import lru_cache
+from typing import Dict, List
+
+try:
+    import tiktoken
+except ImportError: # Counting falls back to the character estimate
+    tiktoken = None
+
+# Rough average for English prose with OpenAI/Llama tokenizers
+CHARS_PER_TOKEN = 4
+
+# Model name prefix -> tokenizer family (tiktoken encoding). Anything else, including local
+# Llama models (whose 128k vocabulary is tiktoken-based and close to cl100k), is cl100k_base.
+TOKENIZER_FAMILIES = (
+    ("gpt-4o", "o200k_base"),
+    ("gpt-4.1", "o200k_base"),
+    ("o1", "o200k_base"),
+    ("o3", "o200k_base"),
+    ("o4", "o200k_base")
+)
+DEFAULT_TOKENIZER_FAMILY = "cl100k_base"
+
+# Chat formatting adds a few tokens around every message
+TOKENS_PER_MESSAGE = 4
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate (~4 characters per token) for budgeting, not billing.
+    """
+    return len(text or "") // CHARS_PER_TOKEN
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    return sum(estimate_tokens(m.get("content")) for m in messages)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cuts text to roughly `max_tokens`, preferring a sentence or word boundary.
+    """
+    limit = max(0, max_tokens) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    boundary = max(cut.rfind(". "), cut.rfind("! "), cut.rfind("? "))
+    if boundary > limit // 2:
+        return cut[:boundary + 1]
+    space = cut.rfind(" ")
+    return (cut[:space] if space > 0 else cut) + "..."
+
+def tokenizer_family(model: str) -> str:
+    name = model.split("/")[-1].lower()
+    for prefix, family in TOKENIZER_FAMILIES:
+        if name.startswith(prefix):
+            return family
+    return DEFAULT_TOKENIZER_FAMILY
+
+@lru_cache(maxsize=None)
+def _encoding(family: str):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(family)
+    except Exception as e: # e.g. encoding files not cached and no network
+        print(f"[Tokens Warning] Tokenizer {family} unavailable ({e}); estimating instead.")
+        return None
+
+def has_tokenizer(model: str) -> bool:
+    return _encoding(tokenizer_family(model)) is not None
+
+def count_tokens(text: str, model: str) -> int:
+    """
+    Exact token count with the model's tokenizer when available, otherwise estimate_tokens.
+    """
+    encoding = _encoding(tokenizer_family(model))
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text or "", disallowed_special=()))
+
+def count_message_tokens(messages: List[Dict[str, str]], model: str) -> int:
+    return sum(count_tokens(m.get("content"), model) + TOKENS_PER_MESSAGE for m in messages)
+
+def compact_to_tokens(text: str, max_tokens: int, model: str, marker: str = "\n[...]\n") -> str:
+    """
+    Fits text into `max_tokens` by cutting out the middle: the start (who the person is)
+    and the end (their latest answers) survive, joined by `marker`.
+    """
+    encoding = _encoding(tokenizer_family(model))
+    if encoding is None:
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        keep = max(0, max_tokens * CHARS_PER_TOKEN - len(marker))
+        return text[:keep // 2] + marker + text[len(text) - (keep - keep // 2):]
+
+    tokens = encoding.encode(text or "", disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    keep = max(0, max_tokens - len(encoding.encode(marker)))
+    head, tail = keep // 2, keep - keep // 2
+    return encoding.decode(tokens[:head]) + marker + (encoding.decode(tokens[-tail:]) if tail else "")
@@ -0,0 +1,117 @@
+import sys
+import os
+import json
+from typing import Any, Dict, List, Optional, Union
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import imap_chat_completions
+from modules.config_manager import config_manager
+from modules.tokens import truncate_to_tokens
+
+EXTRACTION_MODEL = "gpt-3.5-turbo"
+
+# Distribution entries below this are dropped; a value at or above CERTAIN becomes deterministic
+MIN_PROB = 0.02
+CERTAIN = 0.97
+
+class TraitExtractor:
+    """
+    Pulls all standard demographic traits out of a backstory in one JSON-mode call.
+    Output per trait is either a value or a {value: probability} distribution, i.e.
+    exactly what Matcher.calculate_weight accepts; traits the text gives no evidence
+    for are left out (the matcher then treats them as unknown).
+    """
+
+    def __init__(self, model_name: str = EXTRACTION_MODEL, max_context_tokens: int = 6000):
+        self.model_name = model_name
+        self.max_context_tokens = max_context_tokens
+
+    def _messages(self, transcript: str, traits: Dict[str, List[str]]) -> List[Dict[str, str]]:
+        schema = "\n".join(f'- "{trait}": one of {json.dumps(values)}' for trait, values in traits.items())
+        system_prompt = (
+            "You infer the demographics of the person speaking in an interview transcript.\n"
+            "For each trait below, give a probability distribution over its allowed values "
+            "based only on evidence in the text. Omit a trait if there is no evidence for it.\n"
+            f"{schema}\n"
+            'Respond with a JSON object only, e.g. {"age": {"25-34": 0.8, "35-44": 0.2}, "gender": {"Female": 1.0}}.'
+        )
+        # The system prompt is identical for every backstory, so it is a shared prefix
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": truncate_to_tokens(transcript, self.max_context_tokens)}
+        ]
+
+    def parse(self, content: str, traits: Dict[str, List[str]]) -> Dict[str, Union[str, Dict[str, float]]]:
+        """
+        Validates the model's JSON against the allowed values and normalizes each distribution.
+        """
+        try:
+            raw = json.loads(content)
+        except (TypeError, ValueError):
+            return {}
+        if not isinstance(raw, dict):
+            return {}
+
+        demographics = {}
+        for trait, allowed in traits.items():
+            value = raw.get(trait)
+            if isinstance(value, str):
+                value = {value: 1.0}
+            if not isinstance(value, dict):
+                continue
+
+            # Match allowed values case-insensitively, ignore anything else
+            canonical = {v.lower(): v for v in allowed}
+            dist: Dict[str, float] = {}
+            for option, prob in value.items():
+                key = canonical.get(str(option).strip().lower())
+                try:
+                    prob = float(prob)
+                except (TypeError, ValueError):
+                    continue
+                if key and prob > 0:
+                    dist[key] = dist.get(key, 0.0) + prob
+
+            total = sum(dist.values())
+            if not total:
+                continue
+            dist = {k: p / total for k, p in dist.items() if p / total >= MIN_PROB}
+            total = sum(dist.values())
+            best = max(dist, key=dist.get)
+            if dist[best] / total >= CERTAIN:
+                demographics[trait] = best
+            else:
+                demographics[trait] = {k: round(p / total, 4) for k, p in dist.items()}
+        return demographics
+
+    def extract_batch(self, transcripts: List[str], max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Extracts traits for a whole generation wave at once; failed calls yield {}.
+        """
+        traits = config_manager.get_standard_traits()
+        results: List[Dict[str, Any]] = [{} for _ in transcripts]
+        requests = [self._messages(transcript, traits) for transcript in transcripts]
+
+        for n, resp in imap_chat_completions(
+            requests,
+            model=self.model_name,
+            temperature=0.0,
+            max_tokens=500,
+            max_concurrency=max_concurrency,
+            response_format={"type": "json_object"}
+        ):
+            if resp.get("error"):
+                print(f"[TraitExtractor] Extraction failed: {resp['error']}")
+                continue
+            results[n] = self.parse(resp["content"], traits)
+
+        print(f"[TraitExtractor] Extracted traits for {sum(1 for r in results if r)}/{len(transcripts)} backstories.")
+        return results
+
+    def extract(self, transcript: str) -> Dict[str, Any]:
+        return self.extract_batch([transcript])[0]
+
+# Singleton
+trait_extractor = TraitExtractor()
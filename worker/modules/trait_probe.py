@@ -0,0 +1,158 @@
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from scipy.optimize import minimize
+
+# Rows per matrix product when scoring, so the pool is never copied whole
+SCORE_CHUNK_ROWS = 8192
+
+class LogisticProbe:
+    """
+    L2-regularized logistic regression over backstory embeddings, class-balanced so a
+    rare trait isn't drowned out by the negatives. Small enough to refit every round.
+    """
+
+    def __init__(self, l2: float = 0.1):
+        self.l2 = l2
+        self.mean: Optional[np.ndarray] = None
+        self.coef: Optional[np.ndarray] = None
+        self.bias = 0.0
+        self._coef32: Optional[np.ndarray] = None
+        self._offset = 0.0
+
+    def fit(self, X: np.ndarray, y: np.ndarray) -> "LogisticProbe":
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.mean = X.mean(axis=0)
+        Xc = X - self.mean
+        n_pos = max(y.sum(), 1.0)
+        n_neg = max(len(y) - y.sum(), 1.0)
+        weights = np.where(y > 0, len(y) / (2 * n_pos), len(y) / (2 * n_neg))
+
+        def loss(params: np.ndarray):
+            w, b = params[:-1], params[-1]
+            z = Xc @ w + b
+            # log(1 + e^z) - y z, computed stably
+            nll = np.sum(weights * (np.logaddexp(0.0, z) - y * z))
+            residual = weights * (_sigmoid(z) - y)
+            grad = np.append(Xc.T @ residual + self.l2 * w, residual.sum())
+            return nll + 0.5 * self.l2 * w @ w, grad
+
+        result = minimize(loss, np.zeros(X.shape[1] + 1), jac=True, method="L-BFGS-B", options={"maxiter": 200})
+        self.coef, self.bias = result.x[:-1], float(result.x[-1])
+        # (x - mean) @ coef + bias == x @ coef - (mean @ coef - bias), so scoring needs no centred copy
+        self._coef32 = self.coef.astype(np.float32)
+        self._offset = float(self.mean @ self.coef) - self.bias
+        return self
+
+    def predict_proba(self, X: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        P(Yes) for every row of X (or only `rows` of it), scored in float32 chunks.
+        """
+        return _sigmoid(chunked_dot(X, self._coef32, rows).astype(np.float64) - self._offset)
+
+def chunked_dot(X: np.ndarray, w: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    X @ w (or X[rows] @ w) in float32, SCORE_CHUNK_ROWS rows at a time.
+    """
+    w = np.asarray(w, dtype=np.float32)
+    n = len(X) if rows is None else len(rows)
+    out = np.empty(n, dtype=np.float32)
+    for start in range(0, n, SCORE_CHUNK_ROWS):
+        stop = min(start + SCORE_CHUNK_ROWS, n)
+        block = X[start:stop] if rows is None else X[rows[start:stop]]
+        out[start:stop] = np.asarray(block, dtype=np.float32) @ w
+    return out
+
+def _sigmoid(z: np.ndarray) -> np.ndarray:
+    return 0.5 * (1.0 + np.tanh(0.5 * z))
+
+def run_cascade(
+    vectors: np.ndarray,
+    ask_llm: Callable[[np.ndarray], List[str]],
+    settings: Dict[str, Any],
+    query: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+    rows: Optional[np.ndarray] = None
+) -> Dict[str, Any]:
+    """
+    Labels every row of `vectors` (or only `rows` of it) Yes/No, asking the LLM (`ask_llm(rows) -> answers`, None
+    for a failed call) only where the probe is unsure:
+
+    1. Seed: half the rows closest to `query` (so rare traits get positives), half random.
+    2. Rounds: fit the probe on all Yes/No answers so far, send the `round_size` least
+       confident rows to the LLM, add the answers, refit. Stops when every row is confident
+       or the LLM budget (`max_llm_share` of the rows) is spent.
+    3. Audit: a random sample of the probe's confident labels goes to the LLM too; the
+       agreement rate there is the estimated accuracy of the labels the LLM never saw.
+
+    Rows still unsure when the budget runs out, or whose LLM call failed, are left as None
+    (unlabelled), so the next pass picks them up. Returns {"labels", "llm_calls", "llm_share", "agreement"}.
+    `vectors` is read in place; positions in "labels" and those passed to `ask_llm` index `rows`.
+    """
+    rng = np.random.default_rng(seed)
+    if rows is None:
+        rows = np.arange(len(vectors))
+    n = len(rows)
+    labels: List[Optional[str]] = [None] * n
+    from_llm = np.zeros(n, dtype=bool)
+    budget = max(int(settings["max_llm_share"] * n), min(n, int(settings["seed_size"])))
+    confidence = float(settings["confidence"])
+
+    def ask(picked: np.ndarray):
+        picked = picked[:max(budget - int(from_llm.sum()), 0)]
+        for row, answer in zip(picked, ask_llm(picked)):
+            labels[row] = answer
+        from_llm[picked] = True
+
+    seed_size = min(n, int(settings["seed_size"]))
+    if query is not None and seed_size:
+        similar = np.argsort(-chunked_dot(vectors, query, rows))[:seed_size // 2]
+    else:
+        similar = np.empty(0, dtype=np.int64)
+    rest = np.setdiff1d(np.arange(n), similar)
+    ask(np.concatenate([similar, rng.choice(rest, size=min(len(rest), seed_size - len(similar)), replace=False)]))
+
+    proba = np.full(n, 0.5)
+    while True:
+        known = np.array([i for i in np.flatnonzero(from_llm) if labels[i] in ("Yes", "No")], dtype=np.int64)
+        targets = np.array([labels[i] == "Yes" for i in known], dtype=np.float64)
+        if len(set(targets)) == 2:
+            proba = LogisticProbe(settings["l2"]).fit(vectors[rows[known]], targets).predict_proba(vectors, rows)
+        else:
+            # One class only so far: nothing to learn from yet
+            proba = np.full(n, 0.5)
+
+        unsure = np.flatnonzero(~from_llm & (proba < confidence) & (proba > 1 - confidence))
+        if not len(unsure) or from_llm.sum() >= budget:
+            break
+        if len(set(targets)) == 2:
+            unsure = unsure[np.argsort(np.abs(proba[unsure] - 0.5))]
+        else:
+            unsure = rng.permutation(unsure)
+        ask(unsure[:int(settings["round_size"])])
+
+    confident = np.flatnonzero(~from_llm & ((proba >= confidence) | (proba <= 1 - confidence)))
+    for row in confident:
+        labels[row] = "Yes" if proba[row] >= 0.5 else "No"
+
+    # Audit outside the budget: it's what makes the classifier's labels trustworthy
+    agreement = None
+    audit = rng.choice(confident, size=min(len(confident), int(settings["audit_size"])), replace=False)
+    if len(audit):
+        predicted = [labels[row] for row in audit]
+        answers = ask_llm(audit)
+        checked = [(p, a) for p, a in zip(predicted, answers) if a in ("Yes", "No")]
+        agreement = sum(p == a for p, a in checked) / len(checked) if checked else None
+        for row, answer in zip(audit, answers):
+            if answer is not None:
+                labels[row] = answer
+        from_llm[audit] = True
+
+    llm_calls = int(from_llm.sum())
+    return {
+        "labels": labels,
+        "llm_calls": llm_calls,
+        "llm_share": llm_calls / n if n else 0.0,
+        "agreement": agreement
+    }
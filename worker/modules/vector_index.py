@@ -0,0 +1,200 @@
+import sys
+import os
+import time
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from sqlalchemy import text
+
+# Add parent directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm import get_embeddings
+from database import SessionLocal
+
+# Pools larger than this are searched approximately (IVF) unless told otherwise
+APPROXIMATE_THRESHOLD = 200_000
+
+# Vectors come back in pgvector's binary send format (int16 dim, int16 unused, then
+# big-endian float4s), so loading is a buffer copy rather than parsing text per number
+SELECT_EMBEDDINGS = text(
+    "SELECT id, vector_send(embedding) AS embedding FROM backstories "
+    "WHERE embedding IS NOT NULL AND id > :after ORDER BY id LIMIT :limit"
+)
+VECTOR_HEADER_BYTES = 4
+
+# get_vector_index() tops the index up at most this often
+REFRESH_INTERVAL_SECONDS = 30.0
+
+def decode_vectors(payloads: List[bytes]) -> np.ndarray:
+    """
+    Stacks pgvector binary payloads (all the same dimension) into a float32 matrix.
+    """
+    if not payloads:
+        return np.empty((0, 0), dtype=np.float32)
+    raw = np.frombuffer(b"".join(bytes(p) for p in payloads), dtype=np.uint8).reshape(len(payloads), -1)
+    return raw[:, VECTOR_HEADER_BYTES:].copy().view(">f4").astype(np.float32)
+
+def trait_query(trait: str, value: Any = True) -> Optional[str]:
+    """
+    Turns a free-text trait (custom tag) into a retrieval query, e.g.
+    owns_tesla=True -> "owns tesla". Negative traits can't be retrieved by similarity.
+    """
+    if value is False or value is None:
+        return None
+    phrase = trait.replace("_", " ").strip()
+    if isinstance(value, str) and value.strip():
+        phrase = f"{phrase}: {value.strip()}"
+    return phrase
+
+class VectorIndex:
+    """
+    Local nearest-neighbour index over backstories.embedding (cosine similarity).
+
+    Exact search is a NumPy matrix product over the unit-normalized vectors.
+    For large pools an IVF layer (k-means coarse centroids, searching the `n_probe`
+    closest lists) trades a little recall for scanning only a fraction of the rows.
+    `refresh()` appends newly embedded backstories (ids past the last one loaded).
+    """
+
+    def __init__(self, approximate: Optional[bool] = None, n_probe: int = 8):
+        self.approximate = approximate
+        self.n_probe = n_probe
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self._centroids: Optional[np.ndarray] = None
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def refresh(self, batch_size: int = 5000) -> int:
+        """
+        Loads embeddings for ids past the last one held, in keyset pages of binary vectors,
+        appending them to the matrix in one go.
+        """
+        db = SessionLocal()
+        ids, matrices = [], []
+        try:
+            after = int(self.ids[-1]) if len(self.ids) else 0
+            while True:
+                rows = db.execute(SELECT_EMBEDDINGS, {"after": after, "limit": batch_size}).all()
+                if not rows:
+                    break
+                ids.extend(row.id for row in rows)
+                matrices.append(decode_vectors([row.embedding for row in rows]))
+                after = rows[-1].id
+        finally:
+            db.close()
+
+        if ids:
+            self.add(ids, np.vstack(matrices))
+            print(f"[VectorIndex] Loaded {len(ids)} embeddings; index holds {len(self)}.")
+        return len(ids)
+
+    def add(self, ids: List[int], vectors: Union[np.ndarray, List[List[float]]]):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        with self._lock:
+            self.ids = np.concatenate([self.ids, np.asarray(ids, dtype=np.int64)])
+            self.vectors = matrix if not self.vectors.size else np.vstack([self.vectors, matrix])
+            if self._centroids is not None:
+                self._assignments = np.concatenate([self._assignments, self._nearest_lists(matrix, 1)[:, 0]])
+
+    def _use_ivf(self) -> bool:
+        if self.approximate is None:
+            return len(self) > APPROXIMATE_THRESHOLD
+        return self.approximate
+
+    def _nearest_lists(self, queries: np.ndarray, n: int) -> np.ndarray:
+        scores = queries @ self._centroids.T
+        n = min(n, scores.shape[1])
+        return np.argpartition(-scores, n - 1, axis=1)[:, :n]
+
+    def build_ivf(self, n_lists: Optional[int] = None, iterations: int = 10, sample_size: int = 100_000, seed: int = 0):
+        """
+        Trains sqrt(n) coarse centroids with spherical k-means on a sample, then assigns every row.
+        """
+        with self._lock:
+            n = len(self)
+            if not n:
+                return
+            n_lists = n_lists or max(1, int(np.sqrt(n)))
+            rng = np.random.default_rng(seed)
+            sample = self.vectors[rng.choice(n, size=min(n, sample_size), replace=False)]
+            centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)]
+
+            for _ in range(iterations):
+                labels = np.argmax(sample @ centroids.T, axis=1)
+                for c in range(len(centroids)):
+                    members = sample[labels == c]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+            self._centroids = centroids
+            self._assignments = self._nearest_lists(self.vectors, 1)[:, 0].astype(np.int32)
+        print(f"[VectorIndex] Built IVF with {len(centroids)} lists over {n} vectors.")
+
+    def search(self, query: List[float], k: int) -> List[Tuple[int, float]]:
+        """
+        Returns up to k (backstory_id, cosine similarity) pairs, best first.
+        """
+        if not len(self) or k <= 0:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        q /= max(np.linalg.norm(q), 1e-12)
+
+        if self._use_ivf() and self._centroids is None:
+            self.build_ivf()
+
+        with self._lock:
+            if self._use_ivf():
+                lists = self._nearest_lists(q[None, :], self.n_probe)[0]
+                rows = np.flatnonzero(np.isin(self._assignments, lists))
+            else:
+                rows = np.arange(len(self))
+
+            scores = self.vectors[rows] @ q
+            k = min(k, len(rows))
+            if not k:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self.ids[rows[i]]), float(scores[i])) for i in top]
+
+    def shortlist(self, traits: Dict[str, Any], k: int) -> Optional[List[int]]:
+        """
+        Backstory ids most similar to the given free-text traits (one query embedding
+        for all of them). Returns None when there is nothing to retrieve by, so callers
+        can fall back to their regular path.
+        """
+        queries = [q for q in (trait_query(trait, value) for trait, value in traits.items()) if q]
+        if not queries or not len(self):
+            return None
+        query = get_embeddings(["A person who " + "; ".join(queries)])[0]
+        return [backstory_id for backstory_id, _ in self.search(query, k)]
+
+_index: Optional[VectorIndex] = None
+_index_lock = threading.Lock()
+_last_refresh = 0.0
+
+def get_vector_index() -> VectorIndex:
+    """
+    Process-wide index, loaded on first use and topped up with new embeddings at most
+    every REFRESH_INTERVAL_SECONDS.
+    """
+    global _index, _last_refresh
+    with _index_lock:
+        if _index is None:
+            _index = VectorIndex()
+        now = time.monotonic()
+        if not _last_refresh or now - _last_refresh >= REFRESH_INTERVAL_SECONDS:
+            try:
+                _index.refresh()
+            except Exception as e:
+                print(f"[VectorIndex Error] Refresh failed: {e}")
+            _last_refresh = now
+        return _index
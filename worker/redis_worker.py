@@ -9,6 +9,8 @@ from dotenv import load_dotenv
 sys.path.append(os.getcwd())
 
 from modules.runner import execute_run
+from modules.embedder import embed_backstories
+from modules.context_budget import count_backstory_tokens
 
 load_dotenv()
 
@@ -33,6 +35,10 @@ def start_worker():
 
                     if payload.get("job_type") == "RUN_SURVEY":
                         execute_run(payload)
+                    elif payload.get("job_type") == "EMBED_BACKSTORIES":
+                        embed_backstories(limit=payload.get("limit"))
+                    elif payload.get("job_type") == "COUNT_TOKENS":
+                        count_backstory_tokens(payload.get("models", ["gpt-4o", "gpt-4-turbo"]), limit=payload.get("limit"))
                     else:
                         print(f"[Worker] Unknown job type: {payload.get('job_type')}")
 
@@ -0,0 +1,16 @@
+import os
+import sys
+from dotenv import load_dotenv
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+load_dotenv()
+
+from modules.pool_replenisher import PoolReplenisher
+
+if __name__ == "__main__":
+    try:
+        PoolReplenisher().run_forever()
+    except KeyboardInterrupt:
+        print("[Replenisher] Stopping...")
@@ -0,0 +1,233 @@
+"""
+Offline OpenAI-compatible stub backend.
+
+Serves /v1/chat/completions, /v1/embeddings and /v1/models with simulated latency,
+token counts, server errors and 429s, so the worker can be exercised end to end without
+network access or spend. Outputs are deterministic: the same request (model, messages,
+choice index) always gets the same text, logprobs or embedding. Latency and injected
+failures are drawn from a seeded random stream, so a load test is reproducible too.
+
+    python stub_llm_server.py --port 8010 --latency-ms 400 --rate-limit-rate 0.02
+    OPENAI_BASE_URL=http://127.0.0.1:8010/v1 OPENAI_API_KEY=stub python redis_worker.py
+
+GET /stats returns request, token and failure counters.
+"""
+import sys
+import os
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Add current directory to path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from modules.tokens import estimate_message_tokens, estimate_tokens
+
+STUB_DEFAULTS = {
+    "latency_ms": 300.0, # median time before the first token (lognormal)
+    "latency_sigma": 0.5,
+    "ms_per_token": 5.0, # decode time per output token
+    "output_tokens": 120, # mean completion length, capped by max_tokens
+    "output_tokens_sd": 40,
+    "error_rate": 0.0, # share of requests answered with a 500
+    "rate_limit_rate": 0.0, # share of requests answered with a 429
+    "retry_after": 1.0,
+    "embedding_dim": 1536,
+    "seed": 0
+}
+
+WORDS = (
+    "I grew up in a small town and my family worked hard for everything we had "
+    "these days I think about work money health and the people close to me "
+    "honestly it depends on the situation but I would probably say that matters most"
+).split()
+
+# First-token answers offered to single-token classifiers (see llm.classify)
+CLASSIFIER_TOKENS = ["Yes", "No", "Unknown"]
+
+def _request_rng(*parts: Any) -> np.random.Generator:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+    return np.random.default_rng(int(digest[:16], 16))
+
+class StubLLM:
+    """
+    The simulated backend behind the HTTP routes; usable directly in tests.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        self.settings = {**STUB_DEFAULTS, **(settings or {})}
+        self._rng = np.random.default_rng(self.settings["seed"])
+        self._lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "chat": 0,
+            "embeddings": 0,
+            "rate_limited": 0,
+            "errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0
+        }
+
+    def _count(self, **increments: int):
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def draw_failure(self) -> Optional[Tuple[int, Dict[str, Any], Dict[str, str]]]:
+        """
+        Injected failure for this request, as (status, body, headers), or None.
+        """
+        with self._lock:
+            roll = self._rng.random()
+            self.stats["requests"] += 1
+        if roll < self.settings["rate_limit_rate"]:
+            self._count(rate_limited=1)
+            body = {"error": {"message": "Rate limit reached (stub).", "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+            return 429, body, {"retry-after": str(self.settings["retry_after"])}
+        if roll < self.settings["rate_limit_rate"] + self.settings["error_rate"]:
+            self._count(errors=1)
+            return 500, {"error": {"message": "Internal server error (stub).", "type": "server_error"}}, {}
+        return None
+
+    def latency(self, completion_tokens: int) -> float:
+        with self._lock:
+            first_token = self._rng.lognormal(np.log(self.settings["latency_ms"] / 1000.0), self.settings["latency_sigma"])
+        return float(first_token) + completion_tokens * self.settings["ms_per_token"] / 1000.0
+
+    def _choice(self, body: Dict[str, Any], index: int) -> Tuple[Dict[str, Any], int]:
+        model, messages = body.get("model"), body.get("messages", [])
+        rng = _request_rng(model, messages, index)
+        max_tokens = int(body.get("max_tokens") or 4096)
+        logprobs = None
+
+        if body.get("logprobs"):
+            probs = rng.dirichlet(np.ones(len(CLASSIFIER_TOKENS)))
+            content = CLASSIFIER_TOKENS[int(np.argmax(probs))]
+            top = [
+                {"token": token, "logprob": float(np.log(p)), "bytes": list(token.encode())}
+                for token, p in sorted(zip(CLASSIFIER_TOKENS, probs), key=lambda item: -item[1])
+            ][:int(body.get("top_logprobs") or 1)]
+            logprobs = {"content": [{**top[0], "top_logprobs": top}]}
+            n_tokens = 1
+        elif (body.get("response_format") or {}).get("type") == "json_object":
+            content, n_tokens = "{}", 1
+        else:
+            wanted = int(round(rng.normal(self.settings["output_tokens"], self.settings["output_tokens_sd"])))
+            n_tokens = max(1, min(max_tokens, wanted))
+            content = " ".join(rng.choice(WORDS, size=n_tokens)).capitalize() + "."
+
+        finish_reason = "length" if n_tokens >= max_tokens else "stop"
+        choice = {
+            "index": index,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": finish_reason,
+            "logprobs": logprobs
+        }
+        return choice, n_tokens
+
+    def chat(self, body: Dict[str, Any]) -> Tuple[Dict[str, Any], float]:
+        """
+        Returns (chat.completion response, seconds the server should take).
+        """
+        choices = [self._choice(body, i) for i in range(int(body.get("n") or 1))]
+        prompt_tokens = estimate_message_tokens(body.get("messages", []))
+        completion_tokens = sum(n for _, n in choices)
+        self._count(chat=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+        response = {
+            "id": f"chatcmpl-stub-{self.stats['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [choice for choice, _ in choices],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+        # Choices decode in parallel, so the longest one sets the pace
+        return response, self.latency(max(n for _, n in choices))
+
+    def embeddings(self, body: Dict[str, Any]) -> Tuple[Dict[str, Any], float]:
+        texts = body.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            vector = _request_rng("embedding", body.get("model"), text).normal(size=int(self.settings["embedding_dim"]))
+            vector /= np.linalg.norm(vector)
+            data.append({"object": "embedding", "index": i, "embedding": [round(float(x), 6) for x in vector]})
+        prompt_tokens = sum(estimate_tokens(str(text)) for text in texts)
+        self._count(embeddings=1, prompt_tokens=prompt_tokens)
+        response = {
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}
+        }
+        return response, self.latency(0)
+
+def create_app(stub: StubLLM) -> FastAPI:
+    app = FastAPI(title="Alterity LLM Stub")
+
+    async def respond(request: Request, handler) -> JSONResponse:
+        body = await request.json()
+        failure = stub.draw_failure()
+        if failure:
+            status, error, headers = failure
+            await asyncio.sleep(stub.latency(0))
+            return JSONResponse(error, status_code=status, headers=headers)
+        response, seconds = handler(body)
+        await asyncio.sleep(seconds)
+        return JSONResponse(response)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await respond(request, stub.chat)
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        return await respond(request, stub.embeddings)
+
+    @app.get("/v1/models")
+    def models():
+        return {"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "stub"}]}
+
+    @app.get("/stats")
+    def stats():
+        return stub.stats
+
+    return app
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Offline OpenAI-compatible stub server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--latency-ms", type=float, default=STUB_DEFAULTS["latency_ms"], help="Median latency before the first token")
+    parser.add_argument("--latency-sigma", type=float, default=STUB_DEFAULTS["latency_sigma"], help="Lognormal shape of the latency")
+    parser.add_argument("--ms-per-token", type=float, default=STUB_DEFAULTS["ms_per_token"])
+    parser.add_argument("--output-tokens", type=int, default=STUB_DEFAULTS["output_tokens"])
+    parser.add_argument("--output-tokens-sd", type=int, default=STUB_DEFAULTS["output_tokens_sd"])
+    parser.add_argument("--error-rate", type=float, default=STUB_DEFAULTS["error_rate"])
+    parser.add_argument("--rate-limit-rate", type=float, default=STUB_DEFAULTS["rate_limit_rate"])
+    parser.add_argument("--retry-after", type=float, default=STUB_DEFAULTS["retry_after"])
+    parser.add_argument("--embedding-dim", type=int, default=STUB_DEFAULTS["embedding_dim"])
+    parser.add_argument("--seed", type=int, default=STUB_DEFAULTS["seed"])
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    settings = {key: getattr(args, key) for key in STUB_DEFAULTS}
+    print(f"[Stub] Serving on http://{args.host}:{args.port}/v1 with {settings}")
+    uvicorn.run(create_app(StubLLM(settings)), host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
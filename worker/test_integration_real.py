@@ -8,11 +8,14 @@ from unittest.mock import patch, MagicMock
 # Add current directory to path
 sys.path.append(os.getcwd())
 
+import llm
 from database import SessionLocal, Survey, SurveyRun, Probe, Result, get_db
 from modules.runner import execute_run
 from modules.backstory_generator import generator
 
-@patch('llm.openai_client.chat.completions.create')
+# Patch the real client object: test_worker replaces sys.modules['llm'] with a mock at
+# collection time, so a dotted-path patch would miss the client the runner actually uses.
+@patch.object(llm.openai_client.chat.completions, 'create')
 @patch('modules.runner.SessionLocal')
 def test_integration(mock_session_cls, mock_create):
     print("=== Starting Integration Test (Fully Mocked) ===")
@@ -35,17 +38,28 @@ def test_integration(mock_session_cls, mock_create):
     mock_run.status = "QUEUED"
     mock_run.methodology = "DEMOGRAPHIC_FORCING"
     mock_run.survey_id = 99
+    mock_run.run_config = {}
+    mock_run.tokens_used = 0
 
     mock_probe = MagicMock()
     mock_probe.id = 101
     mock_probe.content = "Test question"
     mock_probe.survey_id = 99
 
-    # Configure query results
-    # db.query(SurveyRun).filter(...).first() -> mock_run
-    mock_db.query.return_value.filter.return_value.first.return_value = mock_run
-    # db.query(Probe).filter(...).all() -> [mock_probe]
-    mock_db.query.return_value.filter.return_value.all.return_value = [mock_probe]
+    # Configure query results per queried entity
+    def query(*entities):
+        q = MagicMock()
+        if entities[0] is SurveyRun:
+            # db.query(SurveyRun).filter(...).first() -> mock_run
+            q.filter.return_value.first.return_value = mock_run
+        elif entities[0] is Probe:
+            # db.query(Probe).filter(...).all() -> [mock_probe]
+            q.filter.return_value.all.return_value = [mock_probe]
+        else:
+            # No results stored yet for this run
+            q.filter.return_value.all.return_value = []
+        return q
+    mock_db.query.side_effect = query
 
     try:
         # Execute Run directly
@@ -53,20 +67,24 @@ def test_integration(mock_session_cls, mock_create):
         payload = {"run_id": mock_run.id}
         execute_run(payload)
 
-        # 5. Verify Results being added to DB
+        # 5. Verify Results being bulk-inserted into DB
         print("\n[Step 5] Verifying DB interactions...")
-        # Check that db.add was called with a Result object
-        added_objs = [call[0][0] for call in mock_db.add.call_args_list]
-        result_objs = [obj for obj in added_objs if isinstance(obj, Result)]
+        # ResultWriter flushes chunks via db.execute(insert(results), [row, ...])
+        result_rows = [
+            row
+            for call in mock_db.execute.call_args_list
+            if len(call[0]) > 1 and isinstance(call[0][1], list)
+            for row in call[0][1]
+        ]
 
-        print(f"Found {len(result_objs)} generated results passed to db.add().")
+        print(f"Found {len(result_rows)} generated results passed to db.execute().")
 
-        if len(result_objs) > 0:
-            res = result_objs[0]
-            print(f"Sample Response: {res.response}")
+        if len(result_rows) > 0:
+            res = result_rows[0]
+            print(f"Sample Response: {res['response']}")
             # Calculate expected cost: 0.0005*(50/1000) + 0.0015*(20/1000) = 0.000025 + 0.000030 = 0.000055
-            print(f"Usage Cost: {res.usage_cost}")
-            if res.usage_cost > 0:
+            print(f"Usage Cost: {res['usage_cost']}")
+            if res['usage_cost'] > 0:
                 print("SUCCESS: Cost calculation working.")
             else:
                 print("WARNING: Cost is 0.")
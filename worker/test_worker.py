@@ -13,6 +13,18 @@ sys.modules['llm'] = MagicMock()
 from modules.demographic_forcing import run_demographic_forcing
 from modules.matcher import matcher
 from modules.dynamic_labeler import labeler
+from modules.backstory_generator import BackstoryGenerator, InterviewContext
+from modules.response_cache import ResponseCache
+from modules.rate_limiter import ModelRateLimiter
+from modules.runner import skip_completed
+from modules.context_budget import plan_context, estimate_run
+from modules.pool_replenisher import cell_demand, plan_seeds
+from modules.trait_extractor import TraitExtractor
+from modules.backstory_index import BackstoryIndex
+from modules.vector_index import VectorIndex, trait_query
+from modules.trait_probe import run_cascade
+from modules.replica_router import ReplicaRouter
+from stub_llm_server import StubLLM
 
 class TestWorkerModules(unittest.TestCase):
 
@@ -34,12 +46,578 @@ class TestWorkerModules(unittest.TestCase):
         self.assertEqual(matches[0][0]['id'], 1)
         self.assertEqual(matches[0][1]['id'], 101)
 
-    @patch('modules.dynamic_labeler.chat_completion')
-    def test_labeler(self, mock_chat):
+    def test_vectorized_weights_match_reference(self):
+        print("\nTesting Vectorized Weights...")
+        import numpy as np
+        targets = [
+            {"id": 1, "age": "30", "political_party": "Democrat"},
+            {"id": 2, "age": "45", "political_party": "Republican"}
+        ]
+        candidates = [
+            {"id": 101, "demographics": {"age": "30", "political_party": "democrat"}},
+            {"id": 102, "demographics": {"age": {"30": 0.25, "45": 0.75}, "political_party": "Republican"}},
+            {"id": 103, "demographics": {"political_party": {"Independent": 1.0}}},
+            {"id": 104, "demographics": {}}
+        ]
+        expected = np.array([[matcher.calculate_weight(t, c) for c in candidates] for t in targets])
+        log_weights = matcher.compute_log_weights(targets, candidates)
+        np.testing.assert_allclose(np.exp(log_weights), expected, atol=1e-9)
+
+    def test_population_matching_respects_capacity(self):
+        print("\nTesting Population Matching...")
+        from collections import Counter
+        targets = matcher.sample_population({"political_party": {"Democrat": 0.5, "Republican": 0.5}}, 6, seed=0)
+        candidates = [
+            {"id": 101, "demographics": {"political_party": "Democrat"}},
+            {"id": 102, "demographics": {"political_party": "Republican"}},
+            {"id": 103, "demographics": {"political_party": {"Democrat": 0.5, "Republican": 0.5}}}
+        ]
+        matches = matcher.match_population(targets, candidates, capacity=2, top_k=1)
+        self.assertEqual(len(matches), 6)
+        self.assertTrue(all(count <= 2 for count in Counter(c["id"] for _, c in matches).values()))
+        self.assertEqual(len({t["id"] for t, _ in matches}), 6)
+
+    def test_backstory_index_incremental_and_snapshot(self):
+        print("\nTesting Backstory Index...")
+        import tempfile
+        import numpy as np
+        from types import SimpleNamespace
+        from datetime import datetime
+        row = lambda i, demographics: SimpleNamespace(id=i, demographics=demographics, custom_tags={}, updated_at=datetime(2024, 1, 1))
+        targets = [{"id": 1, "age": "30", "political_party": "Democrat"}]
+
+        index = BackstoryIndex()
+        index._apply([row(101, {"age": "45"}), row(102, {"political_party": "Democrat"})])
+        # An update to an existing row plus a new row with a new trait value
+        index._apply([row(101, {"age": {"30": 0.5, "45": 0.5}}), row(103, {})])
+        candidates = [
+            {"id": 101, "demographics": {"age": {"30": 0.5, "45": 0.5}}},
+            {"id": 102, "demographics": {"political_party": "Democrat"}},
+            {"id": 103, "demographics": {}}
+        ]
+        expected = matcher.compute_log_weights(targets, candidates)
+        np.testing.assert_allclose(matcher.compute_log_weights(targets, index.encoded()), expected)
+
+        with tempfile.TemporaryDirectory() as directory:
+            index.save_snapshot(directory)
+            loaded = BackstoryIndex.load_snapshot(directory)
+            self.assertEqual([c["id"] for c in loaded.candidates()], [101, 102, 103])
+            np.testing.assert_allclose(matcher.compute_log_weights(targets, loaded.encoded()), expected)
+
+            # The superseded version stays on disk (grace period) for readers mid-load
+            index.save_snapshot(directory)
+            self.assertEqual(len([d for d in os.listdir(directory) if d.startswith("v")]), 2)
+
+        # Deleted backstories are dropped and the remaining rows stay aligned
+        self.assertEqual(loaded.remove([102]), 1)
+        self.assertEqual([c["id"] for c in loaded.candidates()], [101, 103])
+        np.testing.assert_allclose(
+            matcher.compute_log_weights(targets, loaded.encoded()),
+            matcher.compute_log_weights(targets, [candidates[0], candidates[2]])
+        )
+
+    def test_vector_index_search(self):
+        print("\nTesting Vector Index...")
+        import numpy as np
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(2000, 32))
+        query = vectors[42] + 0.01 * rng.normal(size=32)
+
+        exact = VectorIndex(approximate=False)
+        exact.add(list(range(1, 2001)), vectors)
+        results = exact.search(query, 5)
+        self.assertEqual(results[0][0], 43)
+        self.assertTrue(all(a[1] >= b[1] for a, b in zip(results, results[1:])))
+
+        approximate = VectorIndex(approximate=True, n_probe=4)
+        approximate.add(list(range(1, 2001)), vectors)
+        self.assertEqual(approximate.search(query, 1)[0][0], 43)
+
+        # Binary pgvector payloads (int16 dim, int16 unused, big-endian float4s)
+        import struct
+        from modules.vector_index import decode_vectors
+        payloads = [struct.pack(">hh3f", 3, 0, *vector) for vector in ([1.0, 2.0, 3.0], [0.5, -1.0, 0.0])]
+        np.testing.assert_array_equal(decode_vectors(payloads), np.array([[1.0, 2.0, 3.0], [0.5, -1.0, 0.0]], dtype=np.float32))
+
+        # The run page's free-text constraint is retrieval input, not a demographic trait
+        population = matcher.sample_population({"party": "Democrat", "custom_trait": "owns a Tesla"}, 3, seed=0)
+        self.assertTrue(all("custom_trait" not in target for target in population))
+
+        self.assertEqual(trait_query("owns_tesla"), "owns tesla")
+        self.assertIsNone(trait_query("owns_tesla", False))
+
+    def test_matching_benchmark_smoke(self):
+        print("\nTesting Matching Benchmark...")
+        from bench_matching import run_size
+        records = run_size(50, 20, "fake", trace=False)
+        steps = {r["step"]: r for r in records}
+        self.assertIn("assign_hungarian", steps)
+        self.assertEqual(steps["end_to_end_db"]["matched"], 20)
+
+    @patch('modules.backstory_generator.imap_classify')
+    @patch('modules.backstory_generator.imap_chat_completions')
+    def test_wave_parallel_interviews(self, mock_imap, mock_classify):
+        print("\nTesting Wave-Parallel Interviews...")
+        waves = []
+        rejected = set()
+
+        def fake_imap(requests, model, max_concurrency=None):
+            waves.append(len(requests))
+            for n, messages in enumerate(requests):
+                persona = "A" if "seed A" in str(messages) or "A-answer" in str(messages) else "B"
+                yield n, {"content": f"{persona}-answer {len(messages)}", "usage": {}}
+
+        def fake_classify(requests, labels, model, max_concurrency=None):
+            waves.append(len(requests))
+            for n, messages in enumerate(requests):
+                # The critic rejects persona B's first answer to each question once
+                text = messages[1]["content"]
+                if "B-answer" in text and text not in rejected:
+                    rejected.add(text)
+                    yield n, {"label": "NO", "probs": {"YES": 0.2, "NO": 0.8}, "usage": {}}
+                else:
+                    yield n, {"label": "YES", "probs": {"YES": 0.9, "NO": 0.1}, "usage": {}}
+
+        mock_imap.side_effect = fake_imap
+        mock_classify.side_effect = fake_classify
+        generator = BackstoryGenerator()
+        generator.questions = generator.questions[:2]
+        transcripts = generator.generate_interviews(["seed A", "seed B"])
+
+        self.assertEqual(len(transcripts), 2)
+        self.assertIn("A-answer", transcripts[0])
+        self.assertNotIn("B-answer", transcripts[0])
+        self.assertEqual(transcripts[1].count("Participant: B-answer"), 2)
+        # Per question: one wave for both personas, then a retry wave for persona B only
+        self.assertEqual(waves, [2, 2, 1, 1] * 2)
+
+    @patch('modules.backstory_generator.chat_completion')
+    def test_speculative_candidates(self, mock_chat):
+        print("\nTesting Speculative Candidates...")
+
+        def fake_chat(messages, model, n=1, max_tokens=1000):
+            if model == "gpt-3.5-turbo":
+                return {"content": "1: NO\n2: YES\n3: YES", "usage": {}}
+            return {
+                "content": "short",
+                "choices": ["short", "a longer answer", "third"],
+                "usage": {"completion_tokens": 20}
+            }
+
+        mock_chat.side_effect = fake_chat
+        generator = BackstoryGenerator(speculative_candidates=3)
+        generator.questions = generator.questions[:1]
+        transcript = generator.generate_interview("seed")
+
+        self.assertIn("Participant: a longer answer", transcript)
+        # One generation and one batched critic call per question
+        self.assertEqual(mock_chat.call_count, 2)
+        self.assertEqual(generator.speculation_stats["candidates"], 3)
+        self.assertEqual(generator.speculation_stats["extra_completion_tokens"], 8)
+
+    def test_interview_context_is_bounded(self):
+        print("\nTesting Interview Context...")
+        from modules.tokens import estimate_tokens
+        context = InterviewContext("A nurse from Ohio.", critic_budget=300)
+        context.add_turn("Tell me your story.", "I was born in 1984 and I grew up in Dayton, Ohio. " + "Long story. " * 200)
+        prefix = context.messages_for("Next?")[0]
+        for n in range(20):
+            context.add_turn(f"Question {n}?", "Another long answer. " * 100)
+
+        view = context.critic_view()
+        self.assertLessEqual(estimate_tokens(view), 300)
+        self.assertIn("birth_year: 1984", view)
+        self.assertIn("location: Dayton", view)
+        self.assertIn("Question 19?", view)
+        # The system prompt (and every earlier turn) is unchanged, so the prefix can be cached
+        self.assertEqual(context.messages_for("Last?")[0], prefix)
+        self.assertEqual(len(context.messages_for("Last?")), 1 + 2 * 21 + 1)
+
+    def test_replenisher_targets_short_cells(self):
+        print("\nTesting Pool Replenisher...")
+        constraints = {"political_party": {"Democrat": 0.5, "Republican": 0.5}, "state": "Ohio"}
+        demand = cell_demand(constraints, 10)
+        self.assertEqual(demand[("political_party", "Republican")], 5.0)
+        self.assertEqual(demand[("state", "Ohio")], 10.0)
+
+        deficits = {("political_party", "Republican"): 3, ("state", "Ohio"): 2}
+        drivers = {cell: constraints for cell in deficits}
+        seeds = plan_seeds(deficits, drivers, budget=10, seed=0)
+        # Every persona pins a short cell and lands in Ohio, so 3 seeds clear both deficits
+        self.assertEqual(len(seeds), 3)
+        self.assertTrue(all(d["political_party"] == "Republican" and d["state"] == "Ohio" for _, d in seeds))
+        self.assertIn("political party: Republican", seeds[0][0])
+        self.assertEqual(len(plan_seeds(deficits, drivers, budget=1)), 1)
+
+    def test_trait_extraction_parsing(self):
+        print("\nTesting Trait Extraction...")
+        traits = {"age": ["25-34", "35-44"], "gender": ["Male", "Female"], "region": ["South", "West"]}
+        parsed = TraitExtractor().parse(
+            '{"age": {"25-34": 3, "35-44": 1, "99+": 5}, "gender": {"female": 0.99, "Male": 0.01}, "region": "Mars"}',
+            traits
+        )
+        self.assertEqual(parsed["age"], {"25-34": 0.75, "35-44": 0.25})
+        self.assertEqual(parsed["gender"], "Female")
+        self.assertNotIn("region", parsed)
+        self.assertEqual(TraitExtractor().parse("not json", traits), {})
+
+        # The output plugs straight into the matcher
+        weight = matcher.calculate_weight({"age": "25-34", "gender": "Female"}, {"demographics": parsed})
+        self.assertAlmostEqual(weight, 0.75)
+
+    @patch('modules.dynamic_labeler.classify')
+    def test_labeler(self, mock_classify):
         print("\nTesting Labeler...")
-        mock_chat.return_value = "Yes"
+        mock_classify.return_value = {"label": "Yes", "probs": {"Yes": 0.9, "No": 0.05, "Unknown": 0.05}, "usage": {}}
         result = labeler.check_trait("content", "owns_gov")
         self.assertEqual(result, "Yes")
 
+    def test_logprob_classification(self):
+        print("\nTesting Logprob Classification...")
+        import importlib.util
+        import math
+        spec = importlib.util.spec_from_file_location("llm_under_test", os.path.join(os.path.dirname(os.path.abspath(__file__)), "llm.py"))
+        llm_module = importlib.util.module_from_spec(spec)
+        # llm.py builds its OpenAI client at import time; keep the test free of credentials
+        with patch("openai.OpenAI"):
+            spec.loader.exec_module(llm_module)
+
+        top = [("No", math.log(0.6)), (" Unknown", math.log(0.2)), ("Y", math.log(0.1)), ("Sure", math.log(0.1))]
+        probs = llm_module.label_probabilities(top, ["Yes", "No", "Unknown"])
+        # "No" is not counted towards "Unknown"; mass on unrelated tokens is dropped
+        self.assertAlmostEqual(probs["No"], 0.6 / 0.9)
+        self.assertAlmostEqual(probs["Yes"], 0.1 / 0.9)
+        sharpened = llm_module.label_probabilities(top, ["Yes", "No", "Unknown"], temperature=0.5)
+        self.assertGreater(sharpened["No"], probs["No"])
+        self.assertEqual(llm_module.label_probabilities([("Maybe", 0.0)], ["YES", "NO"]), {})
+
+        from modules.dynamic_labeler import trait_tag
+        self.assertIs(trait_tag({"Yes": 0.99, "No": 0.01, "Unknown": 0.0}), True)
+        self.assertEqual(trait_tag({"Yes": 0.6, "No": 0.3, "Unknown": 0.1}), {"True": 0.6667, "False": 0.3333})
+        self.assertEqual(trait_tag({}), "Unknown")
+        weight = matcher.calculate_weight({"owns_tesla": True}, {"demographics": {"owns_tesla": trait_tag({"Yes": 0.6, "No": 0.3})}})
+        self.assertAlmostEqual(weight, 0.6667)
+
+        # A failed call leaves the trait out, so the row is retried instead of stored as Unknown
+        responses = [{"label": "Yes", "probs": {"Yes": 0.99, "No": 0.01}}, {"label": None, "probs": {}, "error": "429"}]
+        with patch('modules.dynamic_labeler.imap_classify', return_value=enumerate(responses)):
+            self.assertEqual(labeler.classify_probabilities(["a", "b"], ["owns_tesla"]), [{"owns_tesla": True}, {}])
+
+    @patch('modules.dynamic_labeler.imap_chat_completions')
+    def test_batched_labeler(self, mock_imap):
+        print("\nTesting Batched Labeler...")
+        traits = ["owns_tesla", "has pets"]
+        self.assertEqual(
+            labeler.parse_labels('{"Text 2": {"Owns Tesla": "yes."}, "text_1": {"has_pets": false}}', 2, traits),
+            [{"owns_tesla": "Unknown", "has pets": "No"}, {"owns_tesla": "Yes", "has pets": "Unknown"}]
+        )
+        self.assertEqual(labeler.parse_labels('{"owns_tesla": "No"}', 1, traits)[0]["owns_tesla"], "No")
+        self.assertEqual(labeler.parse_labels("garbage", 1, traits)[0]["has pets"], "Unknown")
+
+        calls = []
+        def fake_imap(requests, **kwargs):
+            for i, messages in enumerate(requests):
+                calls.append(messages[1]["content"].count("Text "))
+                if i == 2:
+                    yield i, {"content": "[Error generating response: 429]", "usage": {}, "error": "429"}
+                    continue
+                yield i, {"content": '{"1": {"owns_tesla": "Yes", "has pets": "No"}}', "usage": {}}
+        mock_imap.side_effect = fake_imap
+
+        labels = labeler.classify_batch(["short", "short", "x" * 1000, "short"], traits, pack_size=2)
+        # Short texts packed two at a time (2 + 1), the long one on its own
+        self.assertEqual(sorted(calls), [1, 1, 2])
+        self.assertEqual(labels[2], {"owns_tesla": "Yes", "has pets": "No"})
+        self.assertEqual(labels[1]["owns_tesla"], "Unknown")
+        # Unknown is written too, so the row drops out of the next pass's `?` filter
+        self.assertEqual(
+            labeler._tag_updates([7, 8], [labels[2], labels[1]])[1],
+            {"b_id": 8, "tags": {"owns_tesla": "Unknown", "has pets": "Unknown"}}
+        )
+        # A failed request leaves its rows unlabelled, so the next pass retries them
+        self.assertIsNone(labels[3])
+        self.assertEqual([update["b_id"] for update in labeler._tag_updates([7, 9], [labels[2], labels[3]])], [7])
+
+    def test_cascade_labeler(self):
+        print("\nTesting Cascade Labeler...")
+        import numpy as np
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(2000, 32)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        truth = np.where(vectors[:, 0] > 0.2, "Yes", "No")
+        asked = []
+        def ask_llm(rows):
+            asked.extend(rows)
+            return [truth[row] for row in rows]
+
+        settings = {"seed_size": 100, "round_size": 100, "confidence": 0.9, "max_llm_share": 0.3, "audit_size": 50, "l2": 0.1}
+        query = np.eye(32, dtype=np.float32)[0]
+        stats = run_cascade(vectors, ask_llm, settings, query=query, seed=0)
+        self.assertEqual(stats["llm_calls"], len(set(asked)))
+        self.assertLess(stats["llm_share"], 0.35)
+        labelled = [(label, t) for label, t in zip(stats["labels"], truth) if label is not None]
+        self.assertGreater(len(labelled), 1900)
+        self.assertGreater(np.mean([label == t for label, t in labelled]), 0.97)
+        self.assertGreater(stats["agreement"], 0.9)
+
+        # Scoring a subset of the pool in place matches scoring a copy of it
+        rows = np.arange(0, 2000, 3)
+        subset = run_cascade(vectors, lambda picked: [truth[rows[i]] for i in picked], settings, query=query, seed=0, rows=rows)
+        copied = run_cascade(vectors[rows], lambda picked: [truth[rows[i]] for i in picked], settings, query=query, seed=0)
+        self.assertEqual(subset["labels"], copied["labels"])
+
+    def test_replica_router(self):
+        print("\nTesting Replica Router...")
+        import openai
+        settings = {
+            "prefix_affinity": True, "affinity_slack": 1, "affinity_entries": 100, "latency_alpha": 0.5,
+            "eject_seconds": 0, "max_eject_seconds": 0, "health_check_interval": 3600, "health_timeout": 1
+        }
+        router = ReplicaRouter({"llama": ["http://a/v1", "http://b/v1"], "mistral": ["http://b/v1"]}, settings)
+        a, b = router.replicas_for("llama")
+        self.assertIs(router.replicas_for("mistral")[0], b)
+
+        # Least outstanding: b is busy serving another model
+        b.in_flight = 3
+        self.assertIs(router.pick("llama"), a)
+        served = router.call("llama", lambda client: client.base_url, affinity_key="persona 1")
+        self.assertIn("//a", str(served))
+        # Affinity keeps the prefix on a while it is within the slack of the least loaded
+        b.in_flight = 0
+        a.in_flight = 1
+        self.assertIn("//a", str(router.call("llama", lambda client: client.base_url, affinity_key="persona 1")))
+        a.in_flight = 2
+        self.assertIn("//b", str(router.call("llama", lambda client: client.base_url, affinity_key="persona 1")))
+        a.in_flight = 0
+
+        def fail(client):
+            raise openai.APIConnectionError(request=MagicMock())
+        with patch.object(router, "_ensure_health_checks"):
+            with self.assertRaises(openai.APIConnectionError):
+                router.call("mistral", fail)
+        self.assertFalse(b.healthy)
+        self.assertEqual(b.in_flight, 0)
+        self.assertIs(router.pick("llama"), a)
+        # Only replica left for mistral: still tried rather than failing outright
+        self.assertIs(router.pick("mistral"), b)
+
+        b.client = MagicMock()
+        router.check_health()
+        self.assertTrue(b.healthy)
+        b.client.with_options.return_value.models.list.assert_called_once()
+
+    def test_llm_stub(self):
+        print("\nTesting LLM Stub...")
+        body = {"model": "gpt-4-turbo", "messages": [{"role": "user", "content": "How are you?"}], "max_tokens": 50}
+        stub = StubLLM({"latency_ms": 100, "ms_per_token": 1, "output_tokens": 30})
+        first, seconds = stub.chat(body)
+        again, _ = StubLLM({"output_tokens": 30, "seed": 7}).chat(body)
+        # Deterministic text regardless of the server's latency/failure stream
+        self.assertEqual(first["choices"][0]["message"]["content"], again["choices"][0]["message"]["content"])
+        self.assertLessEqual(first["usage"]["completion_tokens"], 50)
+        self.assertGreater(seconds, first["usage"]["completion_tokens"] / 1000)
+
+        scored, _ = stub.chat({**body, "max_tokens": 1, "logprobs": True, "top_logprobs": 2})
+        self.assertEqual(len(scored["choices"][0]["logprobs"]["content"][0]["top_logprobs"]), 2)
+        embedded, _ = StubLLM({"embedding_dim": 8}).embeddings({"model": "e", "input": ["a", "b"]})
+        self.assertEqual(len(embedded["data"][1]["embedding"]), 8)
+
+        limited = StubLLM({"rate_limit_rate": 1.0}).draw_failure()
+        self.assertEqual(limited[0], 429)
+        self.assertIn("retry-after", limited[2])
+        self.assertIsNone(stub.draw_failure())
+        self.assertEqual(stub.stats["requests"], 1)
+
+    def test_response_cache(self):
+        print("\nTesting Response Cache...")
+        cache = ResponseCache(max_entries=2, ttl_seconds=60, backend="none")
+        messages = [{"role": "user", "content": "Question"}]
+        key = ResponseCache.make_key("gpt-3.5-turbo", messages, 0.0, 100)
+        self.assertEqual(key, ResponseCache.make_key("gpt-3.5-turbo", list(messages), 0.0, 100))
+        self.assertNotEqual(key, ResponseCache.make_key("gpt-3.5-turbo", messages, 0.7, 100))
+
+        cache.set(key, {"content": "Answer", "usage": {"prompt_tokens": 5}})
+        self.assertEqual(cache.get(key)["content"], "Answer")
+
+        # LRU eviction by entry count
+        cache.set("b", {"content": "B"})
+        cache.set("c", {"content": "C"})
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.get("c")["content"], "C")
+
+    def test_rate_limiter_adapts_concurrency(self):
+        print("\nTesting Rate Limiter...")
+        limiter = ModelRateLimiter("test-model", max_concurrency=4)
+        limiter.acquire(10)
+        limiter.release(10, throttled=True)
+        self.assertEqual(int(limiter.concurrency_limit), 2)
+
+        # A full window of successes grows the limit back by one
+        for _ in range(2):
+            limiter.acquire(10)
+            limiter.release(10, actual_tokens=12)
+        self.assertEqual(int(limiter.concurrency_limit), 3)
+
+    def test_resume_skips_completed_pairs(self):
+        print("\nTesting Resume...")
+        from collections import Counter
+        jobs = [(1, 10, None), (2, 10, None), (1, 11, None), (1, 11, None)]
+        pending = skip_completed(jobs, Counter({(1, 10): 1, (1, 11): 1}))
+        self.assertEqual([(p, b) for p, b, _ in pending], [(2, 10), (1, 11)])
+
+    @patch('modules.context_budget.has_tokenizer', return_value=False)
+    @patch('modules.context_budget.config_manager')
+    def test_context_budget_plan(self, mock_config, _):
+        print("\nTesting Context Budget...")
+        mock_config.get_context_budget_settings.return_value = {"max_output_tokens": 100, "safety_margin": 0}
+        mock_config.get_context_window.return_value = 300
+        build = lambda backstory, probe: [{"role": "system", "content": backstory}, {"role": "user", "content": probe}]
+        family = "o200k_base"
+        backstories = [
+            {"id": 1, "content": "short", "token_counts": {family: 2}},
+            {"id": 2, "content": "x" * 2000, "token_counts": {}}
+        ]
+        plan = plan_context("gpt-4o", [(7, "q" * 40)], build, backstories=backstories)
+
+        self.assertEqual(plan["contents"][1], "short")
+        self.assertEqual(plan["compacted"], [2])
+        budget = 300 - 100 - plan["overhead"] - plan["probe_tokens"][7]
+        self.assertLessEqual(len(plan["contents"][2]), budget * 4)
+        self.assertIn("[...]", plan["contents"][2])
+
+        estimate = estimate_run(plan, [(7, 1), (7, 2)])
+        self.assertEqual(estimate["prompt_tokens"], 2 * (plan["overhead"] + plan["probe_tokens"][7]) + 2 + budget)
+        self.assertEqual(estimate["max_completion_tokens"], 200)
+
+    def test_config_lookups_are_cached(self):
+        print("\nTesting Config Cache...")
+        from modules.config_manager import config_manager
+        config_manager.clear_cache()
+        with patch('modules.config_manager.SessionLocal') as mock_session:
+            mock_session.return_value.query.return_value.filter.return_value.first.return_value = MagicMock(value={"max_retries": 2})
+            for _ in range(3):
+                self.assertEqual(config_manager.get_retry_settings()["max_retries"], 2)
+            self.assertEqual(mock_session.call_count, 1)
+        config_manager.clear_cache()
+
+    def test_prefilter_is_per_trait(self):
+        print("\nTesting Prefilter...")
+        from sqlalchemy import Column, Integer
+        from sqlalchemy.orm import declarative_base
+        from sqlalchemy.dialects import postgresql
+        # `database` is mocked here; a stand-in table gives the clause real columns to compile
+        class Backstory(declarative_base()):
+            __tablename__ = "backstories"
+            id = Column(Integer, primary_key=True)
+            demographics = Column(postgresql.JSONB)
+
+        targets = [{"age": str(age), "political_party": party} for age in range(18, 90) for party in ("Democrat", "Republican")]
+        with patch('modules.matcher.Backstory', Backstory):
+            sql = str(matcher.build_prefilter(targets).compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+            open_trait = matcher.build_prefilter([{"age": "30", "political_party": "Democrat"}, {"age": "45"}])
+        # One IN list and one jsonpath per trait, however many distinct profiles there are
+        self.assertEqual(sql.count("->>"), 2)
+        self.assertEqual(sql.count("@?"), 2)
+        self.assertIn("'democrat'", sql)
+        # A trait left open by some target doesn't constrain the strict filter
+        self.assertNotIn("political_party", str(open_trait.compile(dialect=postgresql.dialect())))
+
+    def test_population_solvers_agree(self):
+        print("\nTesting Population Solvers...")
+        import numpy as np
+        rng = np.random.default_rng(1)
+        supplies = rng.integers(1, 6, 40)
+        edges = {p: (rng.choice(60, 8, replace=False), rng.random(8) * 5) for p in range(40)}
+        edge_profile, edge_candidate, edge_cost = matcher._edge_arrays(edges, 40)
+        for capacity in (1, 2, 3):
+            flows, unmatched = matcher._solve_assignment(edge_profile, edge_candidate, edge_cost, supplies, capacity)
+            lp_flows, lp_unmatched = matcher._solve_transport(edge_profile, edge_candidate, edge_cost, supplies, capacity)
+            self.assertEqual(unmatched.sum(), lp_unmatched.sum())
+            self.assertAlmostEqual(flows @ edge_cost, lp_flows @ edge_cost)
+            self.assertTrue((np.bincount(edge_candidate, weights=flows, minlength=60) <= capacity).all())
+            # Everyone the edges can seat is seated (the max-flow check agrees)
+            self.assertEqual(unmatched.sum() == 0, not matcher._short_profiles(edge_profile, edge_candidate, supplies, capacity).any())
+
+    def test_labeler_only_fills_missing_traits(self):
+        print("\nTesting Labeler Missing Traits...")
+        from types import SimpleNamespace
+        rows = [
+            SimpleNamespace(id=1, content="a", custom_tags={"owns_tesla": {"True": 0.7, "False": 0.3}}),
+            SimpleNamespace(id=2, content="b", custom_tags=None)
+        ]
+        with patch('modules.dynamic_labeler.SessionLocal') as mock_session, \
+             patch.object(labeler, '_missing'), \
+             patch('modules.dynamic_labeler.Backstory') as mock_backstory, \
+             patch.object(labeler, 'classify_batch', side_effect=lambda contents, traits, **kw: [{t: "Yes" for t in traits} for _ in contents]) as mock_classify, \
+             patch.object(labeler, 'save_labels', side_effect=lambda db, ids, labels: len(labels)) as mock_save:
+            mock_backstory.id.__gt__.return_value = True
+            mock_session.return_value.query.return_value.filter.return_value.order_by.return_value.limit.return_value.all.side_effect = [rows, []]
+            self.assertEqual(labeler.label_traits_in_db(["owns_tesla", "has_pets"]), 2)
+
+        self.assertEqual(sorted(tuple(call.args[1]) for call in mock_classify.call_args_list), [("has_pets",), ("owns_tesla", "has_pets")])
+        _, ids, labels = mock_save.call_args.args
+        # The stored distribution is left alone; only the missing trait is merged
+        self.assertEqual(dict(zip(ids, labels)), {1: {"has_pets": "Yes"}, 2: {"owns_tesla": "Yes", "has_pets": "Yes"}})
+
+    def test_matcher_scores_labelled_custom_tags(self):
+        print("\nTesting Labeler To Matcher...")
+        import numpy as np
+        from types import SimpleNamespace
+        from datetime import datetime
+        from modules.dynamic_labeler import trait_tag
+        # Tags as the labeller merges them into custom_tags: a distribution, a certain No, Unknown
+        labels = [{"owns a Tesla": trait_tag(probs)} for probs in ({"Yes": 0.6, "No": 0.3}, {"Yes": 0.0, "No": 0.9}, {"Unknown": 0.9})]
+        stored = {update["b_id"]: update["tags"] for update in labeler._tag_updates([101, 102, 103], labels)}
+        candidates = [{"id": i, "demographics": {"party": "Democrat"}, "custom_tags": stored[i]} for i in (101, 102, 103)]
+
+        targets = matcher.sample_population({"party": "Democrat", "custom_trait": "owns a Tesla"}, 2, seed=0)
+        self.assertEqual(targets[0]["custom_tags"], {"owns a Tesla": True})
+        weights = np.exp(matcher.compute_log_weights(targets, candidates))
+        np.testing.assert_allclose(weights[0], [0.6667, 0.01, 0.01], atol=1e-6)
+        np.testing.assert_allclose(weights[0], [matcher.calculate_weight(targets[0], c) for c in candidates], atol=1e-6)
+        self.assertEqual(matcher.perform_matching(targets[:1], candidates)[0][1]["id"], 101)
+
+        # The in-memory index scores the same tags
+        index = BackstoryIndex()
+        index._apply([SimpleNamespace(id=c["id"], demographics=c["demographics"], custom_tags=c["custom_tags"], updated_at=datetime(2024, 1, 1)) for c in candidates])
+        np.testing.assert_allclose(np.exp(matcher.compute_log_weights(targets, index.encoded())), weights, atol=1e-6)
+
+    def test_cascade_commits_each_round(self):
+        print("\nTesting Cascade Round Commits...")
+        import numpy as np
+        open_sessions = []
+        def new_session():
+            session = MagicMock()
+            session.query.return_value.filter.return_value.order_by.return_value.all.return_value = [(10,), (20,), (30,), (40,)]
+            session.query.return_value.filter.return_value.all.return_value = [(10, "a"), (20, "b"), (30, "c"), (40, "d")]
+            session.close.side_effect = lambda: open_sessions.remove(session)
+            open_sessions.append(session)
+            return session
+        def classify(contents, traits, **kw):
+            self.assertEqual(open_sessions, [])
+            return [{"owns_tesla": "Yes"}, None][:len(contents)]
+        def cascade(vectors, ask_llm, settings, query=None, rows=None):
+            ask_llm(np.array([0, 1]))
+            return {"labels": ["Yes", None, "No", "No"], "llm_calls": 2, "llm_share": 0.5, "agreement": None}
+
+        class Index(list):
+            pass
+        pool = Index(range(4))
+        pool.ids, pool.vectors = np.array([10, 20, 30, 40]), np.zeros((4, 2), dtype=np.float32)
+        with patch('modules.dynamic_labeler.SessionLocal', side_effect=new_session), \
+             patch.object(labeler, '_missing'), \
+             patch('modules.dynamic_labeler.Backstory'), \
+             patch('modules.dynamic_labeler.get_vector_index', return_value=pool), \
+             patch('modules.dynamic_labeler.trait_query', return_value=None), \
+             patch('modules.dynamic_labeler.run_cascade', side_effect=cascade), \
+             patch.object(labeler, 'classify_batch', side_effect=classify), \
+             patch.object(labeler, 'save_labels', side_effect=lambda db, ids, labels: len(labels)) as mock_save:
+            stats = labeler.cascade_label_in_db("owns_tesla", {"write_batch_size": 100})
+
+        # The LLM's answer is saved in its round; the final write holds only the classifier's labels
+        self.assertEqual([call.args[1] for call in mock_save.call_args_list], [[10], [30, 40]])
+        self.assertEqual(stats["labelled"], 3)
+        self.assertEqual(open_sessions, [])
+
 if __name__ == "__main__":
     unittest.main()